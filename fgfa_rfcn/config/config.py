@@ -50,6 +50,8 @@ config.dataset.test_image_set = 'VID_val_videos'
 config.dataset.root_path = './data'
 config.dataset.dataset_path = './data/ILSVRC2015'
 config.dataset.motion_iou_path = './lib/dataset/imagenet_vid_groundtruth_motion_iou.mat'
+# index written by fgfa_rfcn/pack_frames.py, frames are read from the JPEGs if empty
+config.dataset.frame_store_path = ''
 config.dataset.enable_detailed_eval = True
 config.dataset.NUM_CLASSES = 31
 
@@ -74,6 +76,16 @@ config.TRAIN.RESUME = False
 config.TRAIN.FLIP = True
 # whether shuffle image
 config.TRAIN.SHUFFLE = True
+# batches PrefetchingIter loads ahead of training
+config.TRAIN.PREFETCH_DEPTH = 4
+# processes assembling AnchorLoader batches in shared memory, LOADER_SLOTS ready batches each, 0 to load in-process
+# worker i seeds python and numpy random with LOADER_SEED + i, so workers change the random streams of in-process loading
+config.TRAIN.LOADER_WORKERS = 0
+config.TRAIN.LOADER_SLOTS = 2
+config.TRAIN.LOADER_SEED = 0
+# shared memory LRU cache of decoded and resized frames for get_triple_image, 0 to disable
+# it is allocated up front, size it to the memory the host can spare
+config.TRAIN.FRAME_CACHE_MB = 0
 # whether use OHEM
 config.TRAIN.ENABLE_OHEM = False
 # size of images for each device, 2 for rcnn, 1 for rpn and e2e
@@ -130,6 +142,8 @@ config.TEST = edict()
 # use rpn to generate proposal
 config.TEST.HAS_RPN = False
 # size of images for each device
+# the aggregation network detects the center frames of BATCH_IMAGES videos in one forward,
+# frames are then padded to the largest of SCALES so that the windows of all videos stack
 config.TEST.BATCH_IMAGES = 1
 
 # RPN proposal
@@ -146,6 +160,21 @@ config.TEST.max_per_image = 300
 #
 config.TEST.KEY_FRAME_INTERVAL = 9
 config.TEST.SEQ_NMS = False
+# online Seq-NMS finalizes frame t once frame t + SEQ_NMS_LOOKAHEAD arrived instead of waiting for the whole video
+config.TEST.SEQ_NMS_ONLINE = False
+config.TEST.SEQ_NMS_LOOKAHEAD = 9
+config.TEST.SEQ_NMS_HISTORY = 9
+# run FlowNet once per adjacent frame pair and compose center-to-neighbor flows from the cached pairs
+config.TEST.COMPOSE_FLOW = False
+# composing is an approximation, also test the model with direct flows and log the mAP difference, doubles the test time
+config.TEST.COMPOSE_FLOW_REFERENCE = False
+# frames waiting for the post-processing worker of pred_eval
+config.TEST.POST_QUEUE_SIZE = 4
+# TestLoader decodes up to LOADER_PREFETCH frames ahead on LOADER_THREADS threads
+config.TEST.LOADER_THREADS = 4
+config.TEST.LOADER_PREFETCH = 8
+# videos are evaluated as soon as they are complete, the running mAP is logged every EVAL_INTERVAL videos (0: never)
+config.TEST.EVAL_INTERVAL = 50
 
 
 # Test Model Epoch
@@ -14,16 +14,29 @@ from mxnet import ndarray as nd
 from mxnet.io import DataDesc
 from mxnet.executor_manager import _split_input_slice
 
+from config.config import config
+from utils.image import image_to_tensor
+
+
+def _copy_to(src, dst):
+    """copy src into dst, uint8 images are normalized on the device of dst"""
+    if src is dst:
+        # the input was written into the executor array in place, see MutableModule.get_input_arrays
+        return
+    if src.dtype == np.uint8 and dst.dtype != np.uint8:
+        image_to_tensor(src.as_in_context(dst.context), config.network.PIXEL_MEANS).copyto(dst)
+    else:
+        src.copyto(dst)
 
 
 def _load_general(data, targets, major_axis):
     """Load a list of arrays into a list of arrays specified by slices"""
     for d_src, d_targets in zip(data, targets):
         if isinstance(d_targets, nd.NDArray):
-            d_src.copyto(d_targets)
+            _copy_to(d_src, d_targets)
         elif isinstance(d_src, (list, tuple)):
             for src, dst in zip(d_src, d_targets):
-                src.copyto(dst)
+                _copy_to(src, dst)
         else:
             raise NotImplementedError
 
@@ -46,6 +46,28 @@ class Speedometer(object):
             self.tic = time.time()
 
 
+def prefetch_stats(prefetch_iter):
+    def _callback(iter_no, sym, arg, aux):
+        stats = prefetch_iter.stats()
+        s = "Epoch[%d] Prefetch: mean occupancy %.2f/%d\tstarved %.1f%%\twait %.2fs" % (
+            iter_no, stats['mean_occupancy'], stats['depth'], stats['starved'] * 100, stats['wait_time'])
+        logging.info(s)
+        print(s)
+        prefetch_iter.reset_stats()
+    return _callback
+
+
+def frame_cache_stats(frame_cache):
+    def _callback(iter_no, sym, arg, aux):
+        stats = frame_cache.stats()
+        s = "Epoch[%d] Frame cache: hit rate %.1f%%\thits %d\tmisses %d\tslots %s" % (
+            iter_no, stats['hit_rate'] * 100, stats['hits'], stats['misses'], stats['slots'])
+        logging.info(s)
+        print(s)
+        frame_cache.reset_stats()
+    return _callback
+
+
 def do_checkpoint(prefix, means, stds):
     def _callback(iter_no, sym, arg, aux):
         weight = arg['rfcn_bbox_weight']
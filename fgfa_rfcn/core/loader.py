@@ -8,31 +8,105 @@
 
 import numpy as np
 import mxnet as mx
+import multiprocessing as mp
+import random
+import threading
+import traceback
+import Queue
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from mxnet.executor_manager import _split_input_slice
 
 from config.config import config
-from utils.image import tensor_vstack
+from utils.image import tensor_vstack, tensor_shape, set_frame_cache, set_frame_store, pad_to_shape
+from utils.frame_cache import SharedFrameCache
+from utils.frame_store import FrameStore
+from utils.shared_batch import SharedBatchSlots
 from rpn.rpn import get_rpn_testbatch, get_rpn_triple_batch, assign_anchor
 from rcnn import get_rcnn_testbatch, get_rcnn_batch
 
+def to_ndarray(arr):
+    """ uint8 images stay uint8 and are normalized on the device, everything else is float32 """
+    return mx.nd.array(arr, dtype=np.uint8 if arr.dtype == np.uint8 else np.float32)
+
+
+def test_canvas(cfg):
+    """
+    shape every test frame is padded to when the windows of TEST.BATCH_IMAGES videos are stacked
+    :return: (height, width), the largest of cfg.SCALES rounded up to IMAGE_STRIDE
+    """
+    height = max([v[0] for v in cfg.SCALES])
+    width = max([v[1] for v in cfg.SCALES])
+    stride = cfg.network.IMAGE_STRIDE
+    if stride > 0:
+        height = int(np.ceil(height / float(stride)) * stride)
+        width = int(np.ceil(width / float(stride)) * stride)
+    return height, width
+
+
+def load_test_frame(roidb_rec, frameid, cfg, canvas=None):
+    """
+    read and preprocess one frame of a video roidb entry
+    :param canvas: (height, width) to pad the frame to, im_info keeps the size of the frame itself
+    :return: data, im_info as returned by get_rpn_testbatch
+    """
+    cur_roidb = roidb_rec.copy()
+    cur_roidb['image'] = cur_roidb['pattern'] % frameid
+    data, label, im_info = get_rpn_testbatch([cur_roidb], cfg)
+    if canvas is not None:
+        # uint8 [1, height, width, channel] in BGR, padded with the pixel means so that it becomes 0 on the device
+        data[0]['data'] = pad_to_shape(data[0]['data'][0], canvas[0], canvas[1],
+                                       np.round(cfg.network.PIXEL_MEANS))[np.newaxis]
+    return data, im_info
+
+
+class VideoQueue(object):
+    """
+    videos shared by the TestLoaders of all GPUs, a loader takes the next video when it runs out of frames
+    the longest videos are handed out first so that no GPU is left with a long video at the end
+    """
+    def __init__(self, roidb):
+        self.roidb = sorted(roidb, key=lambda x: -x['frame_seg_len'])
+        self.size = int(np.sum([x['frame_seg_len'] for x in roidb]))
+        self.lock = threading.Lock()
+        self.cur = 0
+
+    def get(self):
+        """
+        :return: roidb entry of the next video, None once all are taken
+        """
+        with self.lock:
+            if self.cur == len(self.roidb):
+                return None
+            self.cur += 1
+            return self.roidb[self.cur - 1]
+
+
 class TestLoader(mx.io.DataIter):
     def __init__(self, roidb, config, batch_size=1, shuffle=False,
-                 has_rpn=False):
+                 has_rpn=False, video_queue=None):
+        """
+        :param roidb: videos to test, or None to take them one by one from video_queue
+        :param video_queue: VideoQueue shared with the loaders of other GPUs
+        """
         super(TestLoader, self).__init__()
 
         # save parameters as properties
         self.cfg = config
-        self.roidb = roidb
+        self.video_queue = video_queue
+        self.roidb = [] if video_queue is not None else roidb
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.has_rpn = has_rpn
 
-        # infer properties from roidb
-        self.size = np.sum([x['frame_seg_len'] for x in self.roidb])
+        # infer properties from roidb, with a video queue the size is an upper bound
+        self.size = video_queue.size if video_queue is not None else np.sum([x['frame_seg_len'] for x in self.roidb])
         self.index = np.arange(self.size)
 
         # decide data and label names (only for training)
-        self.data_name = ['data', 'im_info', 'data_cache', 'feat_cache']
+        self.data_name = ['data', 'im_info', 'center_index', 'data_cache', 'feat_cache']
+        if self.cfg.TEST.COMPOSE_FLOW:
+            self.data_name.append('flow_cache')
         self.label_name = None
 
         #
@@ -47,13 +121,23 @@ class TestLoader(mx.io.DataIter):
         self.label = []
         self.im_info = None
 
+        # frames are decoded ahead on a thread pool, results are consumed in submission order
+        self.prefetch = max(self.cfg.TEST.LOADER_PREFETCH, 1)
+        self.pool = ThreadPool(processes=max(self.cfg.TEST.LOADER_THREADS, 1))
+        self.pending = deque()
+        self.prefetch_roidb_index = 0
+        self.prefetch_frameid = 0
+        # the aggregation network stacks the windows of TEST.BATCH_IMAGES videos, which needs a common frame shape
+        self.canvas = test_canvas(self.cfg) if self.cfg.TEST.BATCH_IMAGES > 1 else None
+        set_frame_store(FrameStore(self.cfg.dataset.frame_store_path) if self.cfg.dataset.frame_store_path else None)
+
         # get first batch to fill in provide_data and provide_label
         self.reset()
         self.get_init_batch()
 
     @property
     def provide_data(self):
-        return [[(k, v.shape) for k, v in zip(self.data_name, idata)] for idata in self.data]
+        return [[(k, tensor_shape(v)) for k, v in zip(self.data_name, idata)] for idata in self.data]
 
     @property
     def provide_label(self):
@@ -61,19 +145,53 @@ class TestLoader(mx.io.DataIter):
 
     @property
     def provide_data_single(self):
-        return [(k, v.shape) for k, v in zip(self.data_name, self.data[0])]
+        return [(k, tensor_shape(v)) for k, v in zip(self.data_name, self.data[0])]
 
     @property
     def provide_label_single(self):
         return None
 
+    def close(self):
+        """ stop the decode threads, the loader can not be used afterwards """
+        self.pool.close()
+        self.pool.join()
+        self.pending.clear()
+
     def reset(self):
         self.cur = 0
         if self.shuffle:
             np.random.shuffle(self.index)
+        # restart prefetching from the current frame
+        self.pending.clear()
+        self.prefetch_roidb_index = self.cur_roidb_index
+        self.prefetch_frameid = self.cur_frameid
 
     def iter_next(self):
-        return self.cur < self.size
+        return self.cur_roidb_index < len(self.roidb) or self.take_video()
+
+    def take_video(self):
+        """
+        append the next video of the video queue to roidb
+        :return: False if there is none left
+        """
+        if self.video_queue is None:
+            return False
+        roidb_rec = self.video_queue.get()
+        if roidb_rec is None:
+            return False
+        self.roidb.append(roidb_rec)
+        return True
+
+    def fill_prefetch(self):
+        while len(self.pending) < self.prefetch and \
+                (self.prefetch_roidb_index < len(self.roidb) or self.take_video()):
+            roidb_rec = self.roidb[self.prefetch_roidb_index]
+            job = self.pool.apply_async(load_test_frame, (roidb_rec, self.prefetch_frameid, self.cfg, self.canvas))
+            self.pending.append(((self.prefetch_roidb_index, self.prefetch_frameid), job))
+            self.prefetch_frameid += 1
+            if self.prefetch_frameid == roidb_rec['frame_seg_len']:
+                self.prefetch_roidb_index += 1
+                self.prefetch_frameid = 0
 
     def next(self):
         if self.iter_next():
@@ -100,10 +218,12 @@ class TestLoader(mx.io.DataIter):
             return 0
 
     def get_batch(self):
-        cur_roidb = self.roidb[self.cur_roidb_index].copy()
-        cur_roidb['image'] = cur_roidb['pattern'] % self.cur_frameid
-        self.cur_seg_len = cur_roidb['frame_seg_len']
-        data, label, im_info = get_rpn_testbatch([cur_roidb], self.cfg)
+        self.cur_seg_len = self.roidb[self.cur_roidb_index]['frame_seg_len']
+        self.fill_prefetch()
+        frame, job = self.pending.popleft()
+        assert frame == (self.cur_roidb_index, self.cur_frameid), 'prefetched frames out of order'
+        data, im_info = job.get()
+        self.fill_prefetch()
         if self.cur_frameid == 0: # new video
                 self.key_frame_flag = 0
         else:       # normal frame
@@ -111,31 +231,62 @@ class TestLoader(mx.io.DataIter):
 
         extend_data = [{'data': data[0]['data'] ,
                         'im_info': data[0]['im_info'],
+                        'center_index': np.zeros((1,)),
                         'data_cache': data[0]['data'],
-                        'feat_cache': data[0]['data']}]
-        self.data = [[mx.nd.array(extend_data[i][name]) for name in self.data_name] for i in xrange(len(data))]
+                        'feat_cache': data[0]['data'],
+                        'flow_cache': data[0]['data']}]
+        self.data = [[to_ndarray(extend_data[i][name]) for name in self.data_name] for i in xrange(len(data))]
         self.im_info = im_info
 
     def get_init_batch(self):
-        cur_roidb = self.roidb[self.cur_roidb_index].copy()
-        cur_roidb['image'] = cur_roidb['pattern'] % self.cur_frameid
+        # shapes only, the first video of the queue is not taken
+        cur_roidb = (self.video_queue.roidb[0] if self.video_queue is not None else self.roidb[self.cur_roidb_index]).copy()
         self.cur_seg_len = cur_roidb['frame_seg_len']
-        data, label, im_info = get_rpn_testbatch([cur_roidb], self.cfg)
+        data, im_info = load_test_frame(cur_roidb, self.cur_frameid, self.cfg, self.canvas)
         if self.cur_frameid == 0: # new frame
                 self.key_frame_flag = 0
         else:       # normal frame
             self.key_frame_flag = 2
 
+        # the aggregation network takes the stacked windows of TEST.BATCH_IMAGES videos
+        num_windows = self.cfg.TEST.BATCH_IMAGES
         feat_stride = float(self.cfg.network.RCNN_FEAT_STRIDE)
         extend_data = [{'data': data[0]['data'] ,
-                        'im_info': data[0]['im_info'],
-                        'data_cache': np.zeros((19, 3, max([v[0] for v in self.cfg.SCALES]), max([v[1] for v in self.cfg.SCALES]))),
-                        'feat_cache': np.zeros((19, self.cfg.network.FGFA_FEAT_DIM,
+                        'im_info': np.tile(data[0]['im_info'], (num_windows, 1)),
+                        'center_index': np.zeros((num_windows,)),
+                        'data_cache': np.zeros((19 * num_windows, 3, max([v[0] for v in self.cfg.SCALES]), max([v[1] for v in self.cfg.SCALES]))),
+                        'feat_cache': np.zeros((19 * num_windows, self.cfg.network.FGFA_FEAT_DIM,
+                                                np.ceil(max([v[0] for v in self.cfg.SCALES]) / feat_stride).astype(np.int),
+                                                np.ceil(max([v[1] for v in self.cfg.SCALES]) / feat_stride).astype(np.int))),
+                        'flow_cache': np.zeros((19 * num_windows, 2,
                                                 np.ceil(max([v[0] for v in self.cfg.SCALES]) / feat_stride).astype(np.int),
                                                 np.ceil(max([v[1] for v in self.cfg.SCALES]) / feat_stride).astype(np.int)))}]
-        self.data = [[mx.nd.array(extend_data[i][name]) for name in self.data_name] for i in xrange(len(data))]
+        self.data = [[to_ndarray(extend_data[i][name]) for name in self.data_name] for i in xrange(len(data))]
         self.im_info = im_info
 
+def _anchor_loader_worker(loader, worker_id, jobs, results):
+    """
+    process entry of an AnchorLoader worker, assembles complete batches in the shared slots of the loader
+    python and numpy random are seeded per worker and every worker gets a fixed share of the batches,
+    so the sampled scales and neighbor frame offsets are the same on every run
+    """
+    seed = loader.cfg.TRAIN.LOADER_SEED + worker_id
+    random.seed(seed)
+    np.random.seed(seed)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        batch_id, slot, slices = job
+        try:
+            rst = [loader.parfetch([loader.roidb[i] for i in inds]) for inds in slices]
+            arrays = [r['data'][key] for r in rst for key in loader.data_name] + \
+                     [r['label'][key] for r in rst for key in loader.label_name]
+            results.put((batch_id, loader.batch_slots.pack(slot, arrays), None))
+        except Exception:
+            results.put((batch_id, None, traceback.format_exc()))
+
+
 class AnchorLoader(mx.io.DataIter):
 
     def __init__(self, feat_sym, roidb, cfg, batch_size=1, shuffle=False, ctx=None, work_load_list=None,
@@ -194,13 +345,33 @@ class AnchorLoader(mx.io.DataIter):
         self.data = None
         self.label = None
 
+        # decoded frames shared by all samples (and loader workers) of this loader
+        self.frame_cache = None
+        if self.cfg.TRAIN.FRAME_CACHE_MB > 0:
+            stride = max(self.cfg.network.IMAGE_STRIDE, 1)
+            max_area = max([int(np.ceil(h / float(stride)) * stride) * int(np.ceil(w / float(stride)) * stride)
+                            for h, w in self.cfg.SCALES])
+            self.frame_cache = SharedFrameCache(self.cfg.TRAIN.FRAME_CACHE_MB, (max_area, 1, 3))
+        set_frame_cache(self.frame_cache)
+        set_frame_store(FrameStore(self.cfg.dataset.frame_store_path) if self.cfg.dataset.frame_store_path else None)
+        self.feat_shapes = {}
+
+        # worker processes assembling batches in shared memory, forked before the first batch touches mxnet
+        self.workers = []
+        self.batch_slots = None
+        self.num_submitted = 0
+        self.num_received = 0
+        self.submit_cur = 0
+        if self.cfg.TRAIN.LOADER_WORKERS > 0:
+            self.start_workers(self.cfg.TRAIN.LOADER_WORKERS, max(self.cfg.TRAIN.LOADER_SLOTS, 1))
+
         # get first batch to fill in provide_data and provide_label
         self.reset()
         self.get_batch_individual()
 
     @property
     def provide_data(self):
-        return [[(k, v.shape) for k, v in zip(self.data_name, self.data[i])] for i in xrange(len(self.data))]
+        return [[(k, tensor_shape(v)) for k, v in zip(self.data_name, self.data[i])] for i in xrange(len(self.data))]
 
     @property
     def provide_label(self):
@@ -208,7 +379,7 @@ class AnchorLoader(mx.io.DataIter):
 
     @property
     def provide_data_single(self):
-        return [(k, v.shape) for k, v in zip(self.data_name, self.data[0])]
+        return [(k, tensor_shape(v)) for k, v in zip(self.data_name, self.data[0])]
 
     @property
     def provide_label_single(self):
@@ -216,6 +387,7 @@ class AnchorLoader(mx.io.DataIter):
 
     def reset(self):
         self.cur = 0
+        self.drain_workers()
         if self.shuffle:
             if self.aspect_grouping:
                 widths = np.array([r['width'] for r in self.roidb])
@@ -238,7 +410,12 @@ class AnchorLoader(mx.io.DataIter):
 
     def next(self):
         if self.iter_next():
-            self.get_batch_individual()
+            if self.workers:
+                self.submit_jobs()
+                self.receive_batch()
+                self.submit_jobs()
+            else:
+                self.get_batch_individual()
             self.cur += self.batch_size
             return mx.io.DataBatch(data=self.data, label=self.label,
                                    pad=self.getpad(), index=self.getindex(),
@@ -304,7 +481,7 @@ class AnchorLoader(mx.io.DataIter):
         new_label_list = []
         for data, label in zip(data_list, label_list):
             # infer label shape
-            data_shape = {k: v.shape for k, v in data.items()}
+            data_shape = {k: tensor_shape(v) for k, v in data.items()}
             del data_shape['im_info']
             _, feat_shape, _ = self.feat_sym.infer_shape(**data_shape)
             feat_shape = [int(i) for i in feat_shape[0]]
@@ -328,37 +505,47 @@ class AnchorLoader(mx.io.DataIter):
             pad = -1 if key == 'label' else 0
             all_label[key] = tensor_vstack([batch[key] for batch in new_label_list], pad=pad)
 
-        self.data = [mx.nd.array(all_data[key]) for key in self.data_name]
+        self.data = [to_ndarray(all_data[key]) for key in self.data_name]
         self.label = [mx.nd.array(all_label[key]) for key in self.label_name]
 
-    def get_batch_individual(self):
-        cur_from = self.cur
-        cur_to = min(cur_from + self.batch_size, self.size)
-        roidb = [self.roidb[self.index[i]] for i in range(cur_from, cur_to)]
-        # decide multi device slice
+    def device_slices(self):
+        """ decide multi device slice """
         work_load_list = self.work_load_list
         ctx = self.ctx
         if work_load_list is None:
             work_load_list = [1] * len(ctx)
         assert isinstance(work_load_list, list) and len(work_load_list) == len(ctx), \
             "Invalid settings for work load. "
-        slices = _split_input_slice(self.batch_size, work_load_list)
+        return _split_input_slice(self.batch_size, work_load_list)
+
+    def get_batch_individual(self):
+        cur_from = self.cur
+        cur_to = min(cur_from + self.batch_size, self.size)
+        roidb = [self.roidb[self.index[i]] for i in range(cur_from, cur_to)]
+        slices = self.device_slices()
         rst = []
         for idx, islice in enumerate(slices):
             iroidb = [roidb[i] for i in range(islice.start, islice.stop)]
             rst.append(self.parfetch(iroidb))
         all_data = [_['data'] for _ in rst]
         all_label = [_['label'] for _ in rst]
-        self.data = [[mx.nd.array(data[key]) for key in self.data_name] for data in all_data]
+        self.data = [[to_ndarray(data[key]) for key in self.data_name] for data in all_data]
         self.label = [[mx.nd.array(label[key]) for key in self.label_name] for label in all_label]
 
+    def infer_feat_shape(self, data_shape):
+        """ feat_sym.infer_shape memoized by data shape, which only takes a few values """
+        key = tuple(sorted(data_shape.items()))
+        if key not in self.feat_shapes:
+            _, feat_shape, _ = self.feat_sym.infer_shape(**data_shape)
+            self.feat_shapes[key] = [int(i) for i in feat_shape[0]]
+        return self.feat_shapes[key]
+
     def parfetch(self, iroidb):
         # get testing data for multigpu
         data, label = get_rpn_triple_batch(iroidb, self.cfg)
-        data_shape = {k: v.shape for k, v in data.items()}
+        data_shape = {k: tensor_shape(v) for k, v in data.items()}
         del data_shape['im_info']
-        _, feat_shape, _ = self.feat_sym.infer_shape(**data_shape)
-        feat_shape = [int(i) for i in feat_shape[0]]
+        feat_shape = self.infer_feat_shape(data_shape)
 
         # add gt_boxes to data for e2e
         data['gt_boxes'] = label['gt_boxes'][np.newaxis, :, :]
@@ -370,3 +557,94 @@ class AnchorLoader(mx.io.DataIter):
                               self.normalize_target, self.bbox_mean, self.bbox_std)
         return {'data': data, 'label': label}
 
+    def max_batch_bytes(self):
+        """ upper bound of the bytes of one batch (all devices) at the largest of SCALES, in either orientation """
+        stride = max(self.cfg.network.IMAGE_STRIDE, 1)
+        num_anchors = len(self.anchor_scales) * len(self.anchor_ratios)
+        image_bytes = 0
+        for h, w in self.cfg.SCALES:
+            h = int(np.ceil(h / float(stride)) * stride)
+            w = int(np.ceil(w / float(stride)) * stride)
+            for shape in [(h, w), (w, h)]:
+                feat_shape = self.infer_feat_shape(dict([(k, (1, 3) + shape) for k in ['data', 'data_bef', 'data_aft']]))
+                feat_area = feat_shape[-2] * feat_shape[-1]
+                # images, then label, bbox_target and bbox_weight, then im_info, gt_boxes and alignment
+                image_bytes = max(image_bytes, 3 * h * w * 3 + 9 * num_anchors * feat_area * 4 + 64 * 1024)
+        return self.batch_size * image_bytes
+
+    def start_workers(self, num_workers, num_slots):
+        """
+        fork num_workers processes that assemble batches, each with num_slots shared batch slots
+        batch i of an epoch goes to worker i % num_workers, batches are consumed in order
+        """
+        self.num_slots = num_slots
+        self.batch_slots = SharedBatchSlots(num_workers * num_slots, self.max_batch_bytes())
+        self.job_queues = [mp.Queue() for _ in range(num_workers)]
+        self.result_queues = [mp.Queue() for _ in range(num_workers)]
+        self.workers = [mp.Process(target=_anchor_loader_worker, args=(self, i, self.job_queues[i], self.result_queues[i]))
+                        for i in range(num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def batch_slot(self, batch_id):
+        num_workers = len(self.workers)
+        return (batch_id % num_workers) * self.num_slots + (batch_id // num_workers) % self.num_slots
+
+    def submit_jobs(self):
+        """ hand the next batches of the epoch to the workers, as long as they have free slots """
+        slices = self.device_slices()
+        while self.num_submitted - self.num_received < len(self.workers) * self.num_slots and \
+                self.submit_cur + self.batch_size <= self.size:
+            batch_id = self.num_submitted
+            inds = [[self.index[self.submit_cur + i] for i in range(islice.start, islice.stop)] for islice in slices]
+            self.job_queues[batch_id % len(self.workers)].put((batch_id, self.batch_slot(batch_id), inds))
+            self.num_submitted += 1
+            self.submit_cur += self.batch_size
+
+    def get_result(self):
+        worker = self.num_received % len(self.workers)
+        while True:
+            try:
+                result = self.result_queues[worker].get(timeout=1.0)
+                break
+            except Queue.Empty:
+                if not self.workers[worker].is_alive():
+                    raise RuntimeError('AnchorLoader worker {} died'.format(worker))
+        self.num_received += 1
+        return result
+
+    def receive_batch(self):
+        """ take the next batch from its worker and wrap it as NDArrays """
+        batch_id = self.num_received
+        _, descs, error = self.get_result()
+        if error is not None:
+            raise RuntimeError('AnchorLoader worker {} failed:\n{}'.format(batch_id % len(self.workers), error))
+        arrays = self.batch_slots.unpack(self.batch_slot(batch_id), descs)
+        num_slices = len(self.device_slices())
+        data = arrays[:num_slices * len(self.data_name)]
+        label = arrays[num_slices * len(self.data_name):]
+        # the NDArrays are filled by a synchronous copy, the slot can be reused as soon as they exist
+        self.data = [[to_ndarray(arr) for arr in data[i * len(self.data_name):(i + 1) * len(self.data_name)]]
+                     for i in range(num_slices)]
+        self.label = [[mx.nd.array(arr) for arr in label[i * len(self.label_name):(i + 1) * len(self.label_name)]]
+                      for i in range(num_slices)]
+
+    def drain_workers(self):
+        """ drop the batches still in flight, e.g. on reset """
+        while self.num_received < self.num_submitted:
+            self.get_result()
+        self.num_submitted = 0
+        self.num_received = 0
+        self.submit_cur = 0
+
+    def close(self):
+        """ stop the worker processes """
+        if not self.workers:
+            return
+        self.drain_workers()
+        for jobs in self.job_queues:
+            jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
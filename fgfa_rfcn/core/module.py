@@ -1007,9 +1007,8 @@ class MutableModule(BaseModule):
             train_data.reset()
 
 
-    def forward(self, data_batch, is_train=None):
-        assert self.binded and self.params_initialized
-
+    def _switch_module(self, provide_data, provide_label, is_train=None):
+        """bind a module for the input shapes if they differ from the current ones, it shares the memory of the current one"""
         # get current_shapes
         if self._curr_module.label_shapes is not None:
             current_shapes = [dict(self._curr_module.data_shapes[i] + self._curr_module.label_shapes[i]) for i in xrange(len(self._context))]
@@ -1018,9 +1017,9 @@ class MutableModule(BaseModule):
 
         # get input_shapes
         if is_train:
-            input_shapes = [dict(data_batch.provide_data[i] + data_batch.provide_label[i]) for i in xrange(len(self._context))]
+            input_shapes = [dict(provide_data[i] + provide_label[i]) for i in xrange(len(self._context))]
         else:
-            input_shapes = [dict(data_batch.provide_data[i]) for i in xrange(len(data_batch.provide_data))]
+            input_shapes = [dict(provide_data[i]) for i in xrange(len(provide_data))]
 
         # decide if shape changed
         shape_changed = len(current_shapes) != len(input_shapes)
@@ -1032,14 +1031,28 @@ class MutableModule(BaseModule):
         if shape_changed:
             # self._curr_module.reshape(data_batch.provide_data, data_batch.provide_label)
             module = Module(self._symbol, self._data_names, self._label_names,
-                            logger=self.logger, context=[self._context[i] for i in xrange(len(data_batch.provide_data))],
+                            logger=self.logger, context=[self._context[i] for i in xrange(len(provide_data))],
                             work_load_list=self._work_load_list,
                             fixed_param_names=self._fixed_param_names)
-            module.bind(data_batch.provide_data, data_batch.provide_label, self._curr_module.for_training,
+            module.bind(provide_data, provide_label, self._curr_module.for_training,
                         self._curr_module.inputs_need_grad, force_rebind=False,
                         shared_module=self._curr_module)
             self._curr_module = module
 
+    def get_input_arrays(self, provide_data):
+        """
+        input arrays of the executor on the first device, inputs written there in place are not copied by forward
+        :param provide_data: input shapes of the following forward calls
+        :return: dict of data name -> NDArray, valid until the input shapes change
+        """
+        assert self.binded and self.params_initialized
+        self._switch_module(provide_data, [None for _ in provide_data])
+        exec_ = self._curr_module._exec_group.execs[0]
+        return dict((name, exec_.arg_dict[name]) for name in self._data_names if name in exec_.arg_dict)
+
+    def forward(self, data_batch, is_train=None):
+        assert self.binded and self.params_initialized
+        self._switch_module(data_batch.provide_data, data_batch.provide_label, is_train)
         self._curr_module.forward(data_batch, is_train=is_train)
 
     def backward(self, out_grads=None):
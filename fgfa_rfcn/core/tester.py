@@ -9,17 +9,20 @@
 from multiprocessing.pool import ThreadPool as Pool
 import cPickle
 import os
+import sys
 import time
+import threading
+import Queue
 import mxnet as mx
 import numpy as np
-import dill
 from module import MutableModule
+from config.config import config
 from utils import image
+from utils.image import tensor_shape, image_to_tensor
 from bbox.bbox_transform import bbox_pred, clip_boxes
-from nms.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper
-from nms.seq_nms import seq_nms
+from nms.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper, cpu_batched_nms_wrapper
+from nms.seq_nms import OnlineSeqNMS
 from utils.PrefetchingIter import PrefetchingIter
-from collections import deque
 
 
 class Predictor(object):
@@ -37,6 +40,14 @@ class Predictor(object):
         # [dict(zip(self._mod.output_names, _)) for _ in zip(*self._mod.get_outputs(merge_multi_context=False))]
         return [dict(zip(self._mod.output_names, _)) for _ in zip(*self._mod.get_outputs(merge_multi_context=False))]
 
+    @property
+    def data_names(self):
+        return self._mod.data_names
+
+    def get_input_arrays(self, provide_data):
+        """ input arrays of the bound network, see MutableModule.get_input_arrays """
+        return self._mod.get_input_arrays(provide_data)
+
 
 def im_proposal(predictor, data_batch, data_names, scales):
     output_all = predictor.predict(data_batch)
@@ -132,12 +143,244 @@ def get_resnet_output(predictor, data_batch, data_names):
         feat = output_all[0]['conv_embed_output']
     else:
         feat = None
-    return data_dict_all[0]['data'], feat.copy()
+    # feat is the executor output and is overwritten by the next forward,
+    # FeatureRingBuffer.append copies it into its slot
+    return data_dict_all[0]['data'], feat
+
+
+class WindowStorage(object):
+    """
+    the windows of batch_size videos stacked along the first axis of the input arrays of the aggregation executor
+    the window of a video is a view of its rows, frames are written there in place and are not copied again by forward
+    """
+    def __init__(self, predictor, batch_size=1):
+        """
+        :param predictor: Predictor of the aggregation network, on a single device
+        """
+        self.predictor = predictor
+        self.batch_size = batch_size
+        self.provide_data = None
+        self.arrays = {}
+
+    def bind(self, window_shapes):
+        """
+        reshape the aggregation network for the windows, the arrays are only fetched again when the shapes change
+        :param window_shapes: dict of input name -> shape of one window, the rows slot * shape[0]:(slot + 1) * shape[0]
+        """
+        shapes = dict((name, (shape[0] * self.batch_size,) + tuple(shape[1:])) for name, shape in window_shapes.items())
+        # the current frame is fed as is, it has the shape of one image of the window
+        shapes['data'] = (1,) + shapes['data_cache'][1:]
+        provide_data = [[(name, shapes[name]) for name in self.predictor.data_names]]
+        if provide_data == self.provide_data:
+            return
+        # rebinding drops the windows of the other slots
+        assert self.provide_data is None or self.batch_size == 1, \
+            'stacked windows must share their shape, got {} instead of {}'.format(provide_data, self.provide_data)
+        arrays = self.predictor.get_input_arrays(provide_data)
+        self.arrays = dict((name, arrays[name]) for name in window_shapes)
+        self.provide_data = provide_data
+
+    def view(self, name, slot):
+        """
+        :return: NDArray view of the window of slot
+        """
+        arr = self.arrays[name]
+        rows = arr.shape[0] // self.batch_size
+        return arr[slot * rows:(slot + 1) * rows]
+
+    def fill_batch(self, data_batch):
+        """ point the inputs of data_batch at the executor arrays """
+        data_names = [k[0] for k in data_batch.provide_data[0]]
+        for name, arr in self.arrays.items():
+            pos = data_names.index(name)
+            data_batch.data[0][pos] = arr
+            data_batch.provide_data[0][pos] = (name, arr.shape)
+
+
+class FeatureRingBuffer(object):
+    """
+    buffer in the aggregation network inputs holding the images and feature maps of the 2K+1 frames window
+    a new frame overwrites the oldest slot in place, the aggregation symbol picks the
+    center frame through center_index instead of relying on a concatenated, ordered cache
+    """
+    def __init__(self, key_frame_interval, storage, slot=0):
+        """
+        :param storage: WindowStorage, possibly shared with the windows of other videos
+        :param slot: slot of this window in storage
+        """
+        self.key_frame_interval = key_frame_interval
+        self.capacity = key_frame_interval * 2 + 1
+        self.storage = storage
+        self.slot = slot
+        self.data = None
+        self.feat = None
+        self.center_index = None
+        self.im_info = None
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def window_shapes(self, image, feat):
+        """ shapes of the aggregation inputs that make up one window """
+        return {'data_cache': (self.capacity,) + tensor_shape(image)[1:],
+                'feat_cache': (self.capacity,) + feat.shape[1:],
+                'center_index': (1,),
+                'im_info': (1, 3)}
+
+    def reset(self, image, feat):
+        """
+        start a new video, the network is only reshaped when the frame shape changes
+        :param image: image of the first frame, [1, 3, height, width] or uint8 [1, height, width, 3]
+        :param feat: [1, c, feat_height, feat_width] feature map of the first frame
+        """
+        self.storage.bind(self.window_shapes(image, feat))
+        self.data = self.storage.view('data_cache', self.slot)
+        self.feat = self.storage.view('feat_cache', self.slot)
+        self.center_index = self.storage.view('center_index', self.slot)
+        self.im_info = self.storage.view('im_info', self.slot)
+        self.head = 0
+        self.size = 0
+
+    def append(self, image, feat):
+        if image.dtype == np.uint8:
+            # normalized once when the frame enters the window, the cache is fed as is on every forward
+            image = image_to_tensor(image.as_in_context(self.data.context), config.network.PIXEL_MEANS)
+        self.data[self.head:self.head + 1] = image
+        self.feat[self.head:self.head + 1] = feat
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def repeat(self):
+        """ append another copy of the newest frame, pads the window after the last frame of a video """
+        newest = (self.head - 1) % self.capacity
+        self.append(self.data[newest:newest + 1], self.feat[newest:newest + 1])
+
+    @property
+    def center(self):
+        """ slot of the center frame, i.e. the key_frame_interval-th oldest frame """
+        oldest = (self.head - self.size) % self.capacity
+        return (oldest + self.key_frame_interval) % self.capacity
+
+    def center_data(self):
+        return self.data[self.center:self.center + 1]
+
+    def fill_batch(self, data_batch):
+        """ point the cache inputs of data_batch at the ring buffer """
+        # center_index is a row of the caches of all stacked windows
+        self.center_index[:] = self.slot * self.capacity + self.center
+        self.storage.fill_batch(data_batch)
+
+
+def get_pair_flow(predictor, image, prev_image):
+    """
+    run FlowNet on the newest frame and its predecessor
+    :return: [2, 2, feat_height, feat_width] flows, [0]: newest -> previous, [1]: previous -> newest
+    """
+    data_batch = mx.io.DataBatch(data=[[image, prev_image]], label=[], pad=0, index=0,
+                                 provide_data=[[('data', tensor_shape(image)), ('data_prev', tensor_shape(prev_image))]],
+                                 provide_label=[None])
+    output_all = predictor.predict(data_batch)
+    return output_all[0]['flow_output']
+
+
+class FlowRingBuffer(FeatureRingBuffer):
+    """
+    FeatureRingBuffer that also caches the flows between adjacent frames of the window
+    center-to-neighbor flows are composed from them by warp-and-add, so FlowNet runs on
+    one frame pair per new frame instead of on all 2K+1 (center, neighbor) pairs
+    """
+    def __init__(self, key_frame_interval, flow_predictor, storage, slot=0):
+        super(FlowRingBuffer, self).__init__(key_frame_interval, storage, slot)
+        self.flow_predictor = flow_predictor
+        self.flow_next = None       # flow_next[i]: frame in slot i -> next newer frame
+        self.flow_prev = None       # flow_prev[i]: frame in slot i -> next older frame
+        self.flow_cache = None
+        self.last_image = None
+
+    def window_shapes(self, image, feat):
+        shapes = super(FlowRingBuffer, self).window_shapes(image, feat)
+        shapes['flow_cache'] = (self.capacity, 2) + feat.shape[2:]
+        return shapes
+
+    def reset(self, image, feat):
+        super(FlowRingBuffer, self).reset(image, feat)
+        flow_shape = (self.capacity, 2) + feat.shape[2:]
+        if self.flow_next is None or self.flow_next.shape != flow_shape or self.flow_next.context != self.feat.context:
+            self.flow_next = mx.nd.zeros(flow_shape, self.feat.context)
+            self.flow_prev = mx.nd.zeros(flow_shape, self.feat.context)
+        self.flow_cache = self.storage.view('flow_cache', self.slot)
+        self.last_image = None
+
+    def append(self, image, feat):
+        prev = (self.head - 1) % self.capacity
+        cur = self.head
+        super(FlowRingBuffer, self).append(image, feat)
+        # padding copies of the same frame do not move
+        if self.last_image is None or image is self.last_image:
+            self.flow_prev[cur:cur + 1] = 0
+            self.flow_next[prev:prev + 1] = 0
+        else:
+            flow = get_pair_flow(self.flow_predictor, self.data[cur:cur + 1], self.data[prev:prev + 1])
+            self.flow_prev[cur:cur + 1] = flow[0:1]
+            self.flow_next[prev:prev + 1] = flow[1:2]
+        self.last_image = image
+
+    def repeat(self):
+        # the same frame again, its flows are zero
+        newest = (self.head - 1) % self.capacity
+        self.append(self.last_image, self.feat[newest:newest + 1])
+
+    def compose_flow(self):
+        """ fill flow_cache with the center-to-neighbor flows of a full window, in slot order """
+        center = self.center
+        self.flow_cache[center:center + 1] = 0
+        # flow[0]: center -> k-th newer frame, flow[1]: center -> k-th older frame
+        flow = mx.nd.zeros((2,) + self.flow_cache.shape[1:], self.flow_cache.context)
+        for k in range(1, self.key_frame_interval + 1):
+            newer = (center + k) % self.capacity
+            older = (center - k) % self.capacity
+            newer_prev = (newer - 1) % self.capacity
+            older_prev = (older + 1) % self.capacity
+            # warp the adjacent flow along the current flow and add it up
+            step = mx.nd.concatenate([self.flow_next[newer_prev:newer_prev + 1],
+                                      self.flow_prev[older_prev:older_prev + 1]], axis=0)
+            grid = mx.nd.GridGenerator(data=flow, transform_type='warp')
+            flow = flow + mx.nd.BilinearSampler(data=step, grid=grid)
+            self.flow_cache[newer:newer + 1] = flow[0:1]
+            self.flow_cache[older:older + 1] = flow[1:2]
+
+    def fill_batch(self, data_batch):
+        self.compose_flow()
+        super(FlowRingBuffer, self).fill_batch(data_batch)
 
 
 def im_detect(predictor, data_batch, data_names, scales, cfg):
     output_all = predictor.predict(data_batch)
     data_dict_all = [dict(zip(data_names, data_batch.data[i])) for i in xrange(len(data_batch.data))]
+    return decode_detections(output_all, data_dict_all, scales, cfg)
+
+
+def im_detect_async(predictor, data_batch, data_names, cfg):
+    """
+    run the network and keep private copies of its detection outputs, which are decoded later by decode_detections
+    :return: output_all, data_dict_all
+    """
+    output_all = predictor.predict(data_batch)
+    data_dict_all = [dict(zip(data_names, data_batch.data[i])) for i in xrange(len(data_batch.data))]
+    # executor outputs are overwritten by the next forward
+    output_names = ['cls_prob_reshape_output', 'bbox_pred_reshape_output']
+    if cfg.TEST.HAS_RPN:
+        output_names.append('rois_output')
+    output_all = [dict((name, output[name].copy()) for name in output_names) for output in output_all]
+    for output in output_all:
+        for name in output_names:
+            output[name].wait_to_read()
+    return output_all, data_dict_all
+
+
+def decode_detections(output_all, data_dict_all, scales, cfg):
     scores_all = []
     pred_boxes_all = []
     for output, data_dict, scale in zip(output_all, data_dict_all, scales):
@@ -145,14 +388,15 @@ def im_detect(predictor, data_batch, data_names, scales, cfg):
             rois = output['rois_output'].asnumpy()[:, 1:]
         else:
             rois = data_dict['rois'].asnumpy().reshape((-1, 5))[:, 1:]
-        im_shape = data_dict['data'].shape
+        # size of the image itself, data may be padded or a uint8 [batch, height, width, channel] image
+        im_shape = data_dict['im_info'].asnumpy()[0, :2]
 
         # save output
         scores = output['cls_prob_reshape_output'].asnumpy()[0]
         bbox_deltas = output['bbox_pred_reshape_output'].asnumpy()[0]
         # post processing
         pred_boxes = bbox_pred(rois, bbox_deltas)
-        pred_boxes = clip_boxes(pred_boxes, im_shape[-2:])
+        pred_boxes = clip_boxes(pred_boxes, im_shape)
 
         # we used scaled image & roi to train, so it is necessary to transform them back
         pred_boxes = pred_boxes / scale
@@ -162,253 +406,411 @@ def im_detect(predictor, data_batch, data_names, scales, cfg):
     return zip(scores_all, pred_boxes_all, data_dict_all)
 
 
-def im_batch_detect(predictor, data_batch, data_names, scales, cfg):
+def decode_batch_detections(output, im_infos, cfg):
+    """
+    decode the detections of all images of one forward, rois of image i carry batch index i
+    :param output: outputs of one device, with rois_output
+    :param im_infos: [batch, 3] height, width and scale of every image
+    :return: list of (scores, pred_boxes), one per image
+    """
+    rois = output['rois_output'].asnumpy()
+    scores = output['cls_prob_reshape_output'].asnumpy()
+    scores = scores.reshape((-1, scores.shape[-1]))
+    bbox_deltas = output['bbox_pred_reshape_output'].asnumpy()
+    bbox_deltas = bbox_deltas.reshape((-1, bbox_deltas.shape[-1]))
+    results = []
+    for im_idx in xrange(im_infos.shape[0]):
+        bb_idxs = np.where(rois[:, 0] == im_idx)[0]
+
+        # post processing
+        pred_boxes = bbox_pred(rois[bb_idxs, 1:], bbox_deltas[bb_idxs, :])
+        pred_boxes = clip_boxes(pred_boxes, im_infos[im_idx, :2])
+
+        # we used scaled image & roi to train, so it is necessary to transform them back
+        pred_boxes = pred_boxes / im_infos[im_idx, 2]
+
+        results.append((scores[bb_idxs, :], pred_boxes))
+    return results
+
+
+def im_batch_detect(predictor, data_batch, data_names, cfg):
     output_all = predictor.predict(data_batch)
 
     data_dict_all = [dict(zip(data_names, data_batch.data[i])) for i in xrange(len(data_batch.data))]
     scores_all = []
     pred_boxes_all = []
-    for output, data_dict, scale in zip(output_all, data_dict_all, scales):
-        im_infos = data_dict['im_info'].asnumpy()
-        # save output
-        scores = output['cls_prob_reshape_output'].asnumpy()[0]
-        bbox_deltas = output['bbox_pred_reshape_output'].asnumpy()[0]
-        rois = output['rois_output'].asnumpy()
-        for im_idx in xrange(im_infos.shape[0]):
-            bb_idxs = np.where(rois[:,0] == im_idx)[0]
-            im_shape = im_infos[im_idx, :2].astype(np.int)
-
-            # post processing
-            pred_boxes = bbox_pred(rois[bb_idxs, 1:], bbox_deltas[bb_idxs, :])
-            pred_boxes = clip_boxes(pred_boxes, im_shape)
-
-            # we used scaled image & roi to train, so it is necessary to transform them back
-            pred_boxes = pred_boxes / scale[im_idx]
-
-            scores_all.append(scores[bb_idxs, :])
+    for output, data_dict in zip(output_all, data_dict_all):
+        for scores, pred_boxes in decode_batch_detections(output, data_dict['im_info'].asnumpy(), cfg):
+            scores_all.append(scores)
             pred_boxes_all.append(pred_boxes)
 
     return scores_all, pred_boxes_all, data_dict_all
 
-def pred_eval_seqnms(gpu_id,imdb):
+class PostProcessWorker(object):
+    """
+    post-processing stage of pred_eval, consumes jobs from a bounded queue on a worker thread
+    jobs run in submission order, so the worker may keep per-video state (e.g. online Seq-NMS)
+    """
+    def __init__(self, process, queue_size):
+        self.process = process
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.post_time = 0.0
+        self.num_done = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if self.error is not None:
+                # keep draining so that submit never blocks forever
+                continue
+            t = time.time()
+            try:
+                self.process(*job)
+            except Exception:
+                self.error = sys.exc_info()
+            self.post_time += time.time() - t
+            self.num_done += 1
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def submit(self, *job):
+        """
+        queue a job, blocks while the queue is full
+        :return: time spent waiting for a free slot
+        """
+        self._check()
+        t = time.time()
+        self.queue.put(job)
+        return time.time() - t
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
 
-    det_file = os.path.join(imdb.result_path, imdb.name + '_' + str(gpu_id) + '_raw')
-    print 'det_file=', det_file
-    if os.path.exists(det_file):
-        with open(det_file, 'rb') as fid:
-            all_boxes, frame_ids = dill.load(fid)
 
-        res=[all_boxes, frame_ids]
-        imdb.evaluate_detections_multiprocess_seqnms(res, gpu_id)
+class VideoStream(object):
+    """
+    one of the cfg.TEST.BATCH_IMAGES videos pred_eval aggregates together
+    frames come from the stream's own loader, its window is a slot of the shared WindowStorage
+    """
+    def __init__(self, test_data, feat_ring):
+        # roidb grows as videos are taken, a video is in there before its first frame comes out of the loader
+        self.roidb = test_data.roidb
+        self.test_data = test_data if isinstance(test_data, PrefetchingIter) else PrefetchingIter(test_data)
+        self.ring = feat_ring
+        self.roidb_idx = -1
+        self.video_start = 0        # image index of the first frame of the current video, None until reserved
+        self.num_frames = 0         # frames of the current video
+        self.num_detected = 0       # center frames of the current video detected so far
+        self.num_repeats = 0        # copies of the last frame still to be appended
+        self.im_info = None
+        self.data_batch = None
+        self.load_time = 0.0
+        self.done = False
+
+    def advance(self, feat_predictor, data_names):
+        """
+        put the next frame of the video into the window, after the last frame that frame is repeated
+        :return: True if the center frame of the window is to be detected
+        """
+        if self.num_repeats > 0:
+            self.ring.repeat()
+            self.num_repeats -= 1
+            return True
 
-def pred_eval(gpu_id, feat_predictors, aggr_predictors, test_data, imdb, cfg, vis=False, thresh=1e-3, logger=None, ignore_cache=True):
+        t = time.time()
+        try:
+            im_info, key_frame_flag, self.data_batch = self.test_data.next()
+        except StopIteration:
+            self.done = True
+            return False
+        self.load_time += time.time() - t
+        self.im_info = im_info[0]
+
+        image, feat = get_resnet_output(feat_predictor, self.data_batch, data_names)
+        key_frame_interval = self.ring.key_frame_interval
+        if key_frame_flag == 0 or self.num_detected == self.num_frames:
+            # new video, init the ring buffer and append KEY_FRAME_INTERVAL + 1 padding images in the front
+            # the only frame of a single frame video comes with key_frame_flag 1
+            self.roidb_idx += 1
+            self.num_frames = self.roidb[self.roidb_idx]['frame_seg_len']
+            self.num_detected = 0
+            self.video_start = None
+            self.ring.reset(image, feat)
+            while len(self.ring) < key_frame_interval + 1:
+                self.ring.append(image, feat)
+            if key_frame_flag == 0:
+                return False
+        else:
+            self.ring.append(image, feat)
+        if key_frame_flag == 1:
+            # last frame of a video, the window of a video shorter than KEY_FRAME_INTERVAL is padded to full
+            # with copies of it, then one more copy is appended for each center frame still to be detected
+            while len(self.ring) < self.ring.capacity:
+                self.ring.repeat()
+            self.num_repeats = self.num_frames - self.num_detected - 1
+            return True
+        # do not predict until the window is full
+        return len(self.ring) == self.ring.capacity
+
+    def frame_id(self):
+        return self.roidb[self.roidb_idx]['frame_id']
+
+
+def pred_eval(gpu_id, feat_predictors, aggr_predictors, test_data, imdb, cfg, vis=False, thresh=1e-3, logger=None, ignore_cache=True,
+              flow_predictors=None, evaluator=None):
     """
     wrapper for calculating offline validation for faster data analysis
     in this example, all threshold are set by hand
     :param predictor: Predictor
-    :param test_data: data iterator, must be non-shuffle
+    :param flow_predictors: Predictor of adjacent frame flows, required by cfg.TEST.COMPOSE_FLOW
+    :param test_data: data iterator, must be non-shuffle, or a list of cfg.TEST.BATCH_IMAGES of them
+                      whose videos are aggregated together, typically sharing a VideoQueue
     :param imdb: image database
     :param vis: controls visualization
     :param thresh: valid detection threshold
+    :param evaluator: VIDMotionEvaluator fed with the final detections of every video once it is complete
     :return:
     """
 
     det_file = os.path.join(imdb.result_path, imdb.name + '_'+ str(gpu_id))
-    if cfg.TEST.SEQ_NMS == True:
+    if cfg.TEST.SEQ_NMS == True and not cfg.TEST.SEQ_NMS_ONLINE:
         det_file += '_raw'
     print 'det_file=',det_file
     if os.path.exists(det_file) and not ignore_cache:
         with open(det_file, 'rb') as fid:
             all_boxes, frame_ids = cPickle.load(fid)
+        if evaluator is not None:
+            evaluator.add_detections(all_boxes, frame_ids)
         return all_boxes, frame_ids
 
 
-    assert vis or not test_data.shuffle
-    data_names = [k[0] for k in test_data.provide_data[0]]
-    num_images = test_data.size
-    roidb_frame_ids = [x['frame_id'] for x in test_data.roidb]
-
-    if not isinstance(test_data, PrefetchingIter):
-        test_data = PrefetchingIter(test_data)
+    test_datas = test_data if isinstance(test_data, list) else [test_data]
+    assert len(test_datas) == cfg.TEST.BATCH_IMAGES, \
+        'the aggregation network takes {} videos, got {} iterators'.format(cfg.TEST.BATCH_IMAGES, len(test_datas))
+    assert cfg.TEST.HAS_RPN, 'video testing takes the rois of the aggregation network'
+    for data in test_datas:
+        assert vis or not data.shuffle
+    data_names = [k[0] for k in test_datas[0].provide_data[0]]
+    # videos may be taken from a queue shared with other iterators while testing, so num_images is an upper bound
+    if test_datas[0].video_queue is not None:
+        num_images = test_datas[0].size
+    else:
+        num_images = sum([data.size for data in test_datas])
 
-    nms = py_nms_wrapper(cfg.TEST.NMS)
     # limit detections to max_per_image over all classes
     max_per_image = cfg.TEST.max_per_image
+    # per-class nms and the max_per_image cap of all classes in one call
+    nms = cpu_batched_nms_wrapper(cfg.TEST.NMS, max_per_image)
 
     # all detections are collected into:
     #    all_boxes[cls][image] = N x 5 array of detections in
     #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(imdb.num_classes)]
+    # every video reserves the indices of its images when it starts, so they stay contiguous
+    all_boxes = [[] for _ in range(imdb.num_classes)]
     frame_ids = np.zeros(num_images, dtype=np.int)
 
-    roidb_idx = -1
-    roidb_offset = -1
-    idx = 0
-    all_frame_interval = cfg.TEST.KEY_FRAME_INTERVAL * 2 + 1
+    # the windows of all videos are stacked into the inputs of one aggregation forward
+    batch_size = len(test_datas)
+    storage = WindowStorage(aggr_predictors, batch_size)
+    streams = []
+    for slot, data in enumerate(test_datas):
+        if cfg.TEST.COMPOSE_FLOW:
+            assert flow_predictors is not None, 'cfg.TEST.COMPOSE_FLOW requires flow predictors'
+            feat_ring = FlowRingBuffer(cfg.TEST.KEY_FRAME_INTERVAL, flow_predictors, storage=storage, slot=slot)
+        else:
+            feat_ring = FeatureRingBuffer(cfg.TEST.KEY_FRAME_INTERVAL, storage=storage, slot=slot)
+        streams.append(VideoStream(data, feat_ring))
+    if cfg.TEST.SEQ_NMS and cfg.TEST.SEQ_NMS_ONLINE:
+        seq_nms_online = [OnlineSeqNMS(cfg.TEST.SEQ_NMS_LOOKAHEAD, cfg.TEST.SEQ_NMS_HISTORY) for _ in streams]
+        seq_nms_post = py_nms_wrapper(0.3)
+    else:
+        seq_nms_online = None
+
+    def post_process(output_all, im_infos, images):
+        if output_all is None:
+            # images[1]:images[2] make up the complete video of slot images[0],
+            # finalize the frames still waiting for lookahead
+            slot, start, end = images
+            if seq_nms_online is not None:
+                online_seq_nms_result(seq_nms_online[slot], seq_nms_post, all_boxes, None, imdb.num_classes)
+                seq_nms_online[slot].reset()
+            if evaluator is not None:
+                evaluate_video(evaluator, all_boxes, frame_ids, start, end, cfg.TEST.EVAL_INTERVAL, logger)
+            return
+        pred_result = decode_batch_detections(output_all[0], im_infos, cfg)
+        for slot, idx, center_image in images:
+            scores, boxes = pred_result[slot]
+            process_pred_result([(scores, boxes, None)], imdb, thresh, cfg, nms, all_boxes, idx, max_per_image, vis,
+                                center_image.asnumpy() if vis else None, [im_infos[slot, 2]])
+            if seq_nms_online is not None:
+                online_seq_nms_result(seq_nms_online[slot], seq_nms_post, all_boxes, idx, imdb.num_classes)
+
+    # load -> network -> post-process, the network of the next frame overlaps the post-processing of this one
+    post_worker = PostProcessWorker(post_process, cfg.TEST.POST_QUEUE_SIZE)
 
-    data_time, net_time, post_time,seq_time = 0.0, 0.0, 0.0,0.0
+    idx = 0
+    num_reserved = 0
+    im_infos = np.zeros((batch_size, 3), dtype=np.float32)
+    net_time, wait_time = 0.0, 0.0
     t = time.time()
 
-    # loop through all the test data
-    for im_info, key_frame_flag, data_batch in test_data:
-        t1 = time.time() - t
-        t = time.time()
-
-        #################################################
-        # new video                                     #
-        #################################################
-        # empty lists and append padding images
-        # do not do prediction yet
-        if key_frame_flag == 0:
-            roidb_idx += 1
-            roidb_offset = -1
-            # init data_lsit and feat_list for a new video
-            data_list = deque(maxlen=all_frame_interval)
-            feat_list = deque(maxlen=all_frame_interval)
-            image, feat = get_resnet_output(feat_predictors, data_batch, data_names)
-            # append cfg.TEST.KEY_FRAME_INTERVAL+1 padding images in the front (first frame)
-            while len(data_list) < cfg.TEST.KEY_FRAME_INTERVAL+1:
-                data_list.append(image)
-                feat_list.append(feat)
-
-        #################################################
-        # main part of the loop                         #
-        #################################################
-        elif key_frame_flag == 2:
-            # keep appending data to the lists without doing prediction until the lists contain 2 * cfg.TEST.KEY_FRAME_INTERVAL objects
-            if len(data_list) < all_frame_interval - 1:
-                image, feat = get_resnet_output(feat_predictors, data_batch, data_names)
-                data_list.append(image)
-                feat_list.append(feat)
-
-            else:
-                scales = [iim_info[0, 2] for iim_info in im_info]
-
-                image, feat = get_resnet_output(feat_predictors, data_batch, data_names)
-                data_list.append(image)
-                feat_list.append(feat)
-                prepare_data(data_list, feat_list, data_batch)
-                pred_result = im_detect(aggr_predictors, data_batch, data_names, scales, cfg)
-
-                roidb_offset += 1
-                frame_ids[idx] = roidb_frame_ids[roidb_idx] + roidb_offset
-
-                t2 = time.time() - t
-                t = time.time()
-                process_pred_result(pred_result, imdb, thresh, cfg, nms, all_boxes, idx, max_per_image, vis,
-                                    data_list[cfg.TEST.KEY_FRAME_INTERVAL].asnumpy(), scales)
-                idx += test_data.batch_size
-
-                t3 = time.time() - t
-                t = time.time()
-                data_time += t1
-                net_time += t2
-                post_time += t3
-                print 'testing {}/{} data {:.4f}s net {:.4f}s post {:.4f}s'.format(idx, num_images,
-                                                                                      data_time / idx * test_data.batch_size,
-                                                                                      net_time / idx * test_data.batch_size,
-                                                                                      post_time / idx * test_data.batch_size)
-                if logger:
-                    logger.info('testing {}/{} data {:.4f}s net {:.4f}s post {:.4f}s'.format(idx, num_images,
-                                                                                             data_time / idx * test_data.batch_size,
-                                                                                             net_time / idx * test_data.batch_size,
-                                                                                             post_time / idx * test_data.batch_size))
-        #################################################
-        # end part of a video                           #
-        #################################################
-        elif key_frame_flag == 1:       # last frame of a video
-            end_counter = 0
-            image, feat = get_resnet_output(feat_predictors, data_batch, data_names)
-            while end_counter < cfg.TEST.KEY_FRAME_INTERVAL + 1:
-                data_list.append(image)
-                feat_list.append(feat)
-                prepare_data(data_list, feat_list, data_batch)
-                pred_result = im_detect(aggr_predictors, data_batch, data_names, scales, cfg)
-
-                roidb_offset += 1
-                frame_ids[idx] = roidb_frame_ids[roidb_idx] + roidb_offset
-
-                t2 = time.time() - t
-                t = time.time()
-                process_pred_result(pred_result, imdb, thresh, cfg, nms, all_boxes, idx, max_per_image, vis, data_list[cfg.TEST.KEY_FRAME_INTERVAL].asnumpy(), scales)
-                idx += test_data.batch_size
-                t3 = time.time() - t
-                t = time.time()
-                data_time += t1
-                net_time += t2
-                post_time += t3
-
-                print 'testing {}/{} data {:.4f}s net {:.4f}s post {:.4f}s'.format(idx, num_images,
-                                                                                   data_time / idx * test_data.batch_size,
-                                                                                   net_time / idx * test_data.batch_size,
-                                                                                   post_time / idx * test_data.batch_size)
-                if logger:
-                    logger.info('testing {}/{} data {:.4f}s net {:.4f}s post {:.4f}s'.format(idx, num_images,
-                                                                                             data_time / idx * test_data.batch_size,
-                                                                                             net_time / idx * test_data.batch_size,
-                                                                                             post_time / idx * test_data.batch_size))
-                end_counter += 1
+    def log_speed(idx):
+        num_done = max(post_worker.num_done, 1)
+        data_time = sum([stream.load_time for stream in streams])
+        info = 'testing {}/{} data {:.4f}s net {:.4f}s post {:.4f}s wait {:.4f}s'.format(
+            idx, num_images, data_time / idx, (net_time - data_time) / idx,
+            post_worker.post_time / num_done, wait_time / idx)
+        print info
+        if logger:
+            logger.info(info)
+
+    try:
+        # loop through all the test data, every stream moves one frame ahead per step
+        while not all([stream.done for stream in streams]):
+            ready = []
+            for stream in streams:
+                if stream.done:
+                    continue
+                if stream.advance(feat_predictors, data_names):
+                    ready.append(stream)
+                if stream.video_start is None:
+                    # a new video reserves the indices of all its images
+                    stream.video_start = num_reserved
+                    num_reserved += stream.num_frames
+                    frame_ids[stream.video_start:num_reserved] = stream.frame_id() + np.arange(stream.num_frames)
+                    for cls_boxes in all_boxes:
+                        cls_boxes.extend([[] for _ in range(stream.num_frames)])
+            if len(ready) == 0:
+                continue
 
+            #################################################
+            # aggregate the windows of all ready videos      #
+            #################################################
+            data_batch = ready[0].data_batch
+            for stream in ready:
+                im_infos[stream.ring.slot] = stream.im_info[0]
+                stream.ring.im_info[:] = stream.im_info
+                stream.ring.fill_batch(data_batch)
+            # the other slots repeat the first ready window, their detections are dropped
+            first = ready[0].ring.slot
+            for slot in set(range(batch_size)) - set([stream.ring.slot for stream in ready]):
+                for name in ['center_index', 'im_info']:
+                    storage.arrays[name][slot:slot + 1] = storage.arrays[name][first:first + 1]
+                im_infos[slot] = im_infos[first]
+
+            output_all, data_dict_all = im_detect_async(aggr_predictors, data_batch, data_names, cfg)
+
+            images = []
+            for stream in ready:
+                images.append((stream.ring.slot, stream.video_start + stream.num_detected,
+                               stream.ring.center_data().copy() if vis else None))
+                stream.num_detected += 1
+            net_time += time.time() - t
+            wait_time += post_worker.submit(output_all, im_infos.copy(), images)
+            for stream in ready:
+                if stream.num_detected == stream.num_frames and (seq_nms_online is not None or evaluator is not None):
+                    post_worker.submit(None, None, (stream.ring.slot, stream.video_start,
+                                                    stream.video_start + stream.num_frames))
+            idx += len(ready)
+            t = time.time()
+            log_speed(idx)
+    finally:
+        # all_boxes is complete once the worker has drained its queue
+        post_worker.close()
+        for stream in streams:
+            stream.test_data.close()
+
+    frame_ids = frame_ids[:num_reserved]
     with open(det_file, 'wb') as f:
         cPickle.dump((all_boxes, frame_ids), f, protocol=cPickle.HIGHEST_PROTOCOL)
 
     return all_boxes, frame_ids
 
-def run_dill_encode(payload):
-    fun,args=dill.loads(payload)
-    return fun(*args)
-    
-def apply_async(pool,fun,args):
-    payload=dill.dumps((fun,args))
-    return pool.apply_async(run_dill_encode,(payload,))
+def evaluate_video(evaluator, all_boxes, frame_ids, start, end, interval, logger=None):
+    """
+    add the images start:end of a complete video to the evaluator, log the running mAP every interval videos
+    """
+    num_videos = evaluator.add_detections(all_boxes, frame_ids, start, end)
+    if interval > 0 and num_videos % interval == 0:
+        ap = evaluator.ap(final=False)
+        info = 'running eval: {} videos {} frames, mAP'.format(num_videos, evaluator.num_frames())
+        for motion_range, ap_range in zip(evaluator.motion_ranges, ap[:, 0]):
+            info += ' motion [{:.1f} {:.1f}] {:.4f}'.format(motion_range[0], motion_range[1],
+                                                           np.mean(ap_range[ap_range >= 0]))
+        print info
+        if logger:
+            logger.info(info)
+
+
+def merge_detections(detections, num_classes):
+    """
+    :param detections: list of (all_boxes, frame_ids)
+    :return: all_boxes, frame_ids of all images, ordered by frame id
+    """
+    frame_ids = np.concatenate([d[1] for d in detections])
+    order = np.argsort(frame_ids, kind='mergesort')
+    all_boxes = []
+    for j in range(num_classes):
+        cls_boxes = [dets for d in detections for dets in d[0][j]]
+        all_boxes.append([cls_boxes[i] for i in order])
+    return all_boxes, frame_ids[order]
 
-def pred_eval_multiprocess(gpu_num, key_predictors, cur_predictors, test_datas, imdb, cfg, vis=False, thresh=1e-3, logger=None, ignore_cache=True):
 
-    if cfg.TEST.SEQ_NMS==False:
-        if gpu_num == 1:
-            res = [pred_eval(0, key_predictors[0], cur_predictors[0], test_datas[0], imdb, cfg, vis, thresh, logger,
-                             ignore_cache), ]
-        else:
-            from multiprocessing.pool import ThreadPool as Pool
-            pool = Pool(processes=gpu_num)
-            multiple_results = [pool.apply_async(pred_eval, args=(
-            i, key_predictors[i], cur_predictors[i], test_datas[i], imdb, cfg, vis, thresh, logger, ignore_cache)) for i
-                                in range(gpu_num)]
-            pool.close()
-            pool.join()
-            res = [res.get() for res in multiple_results]
-        info_str = imdb.evaluate_detections_multiprocess(res)
+def pred_eval_multiprocess(gpu_num, key_predictors, cur_predictors, test_datas, imdb, cfg, vis=False, thresh=1e-3, logger=None, ignore_cache=True,
+                           flow_predictors=None, seq_nms_pool=None):
+    """
+    :param seq_nms_pool: process Pool of offline Seq-NMS, forked before MXNet and any threads were started
+    :return: ap of all videos, see VIDMotionEvaluator.ap
+    """
+    if flow_predictors is None:
+        flow_predictors = [None] * gpu_num
 
+    # detections are evaluated video by video while testing, offline Seq-NMS needs all of them first
+    evaluator = imdb.vid_evaluator()
+    streaming = not (cfg.TEST.SEQ_NMS and not cfg.TEST.SEQ_NMS_ONLINE)
+    stream_evaluator = evaluator if streaming else None
 
-    else :
+    try:
         if gpu_num == 1:
-            res = [pred_eval(0, key_predictors[0], cur_predictors[0], test_datas[0], imdb, cfg, vis, thresh, logger, ignore_cache),]
-
+            res = [pred_eval(0, key_predictors[0], cur_predictors[0], test_datas[0], imdb, cfg, vis, thresh, logger,
+                             ignore_cache, flow_predictors[0], stream_evaluator), ]
         else:
             from multiprocessing.pool import ThreadPool as Pool
-
             pool = Pool(processes=gpu_num)
             multiple_results = [pool.apply_async(pred_eval, args=(
-            i, key_predictors[i], cur_predictors[i], test_datas[i], imdb, cfg, vis, thresh, logger, ignore_cache)) for i in
-                                range(gpu_num)]
+            i, key_predictors[i], cur_predictors[i], test_datas[i], imdb, cfg, vis, thresh, logger, ignore_cache,
+            flow_predictors[i], stream_evaluator)) for i
+                                in range(gpu_num)]
             pool.close()
             pool.join()
             res = [res.get() for res in multiple_results]
-
-
-        from multiprocessing import Pool as Pool
-        pool = Pool(processes=gpu_num)
-        jobs = []
-        res=[]
-        for i in range(gpu_num):
-            job = apply_async(pool, pred_eval_seqnms, (i, imdb))
-            jobs.append(job)
-        for job in jobs:
-            res.append(job.get())
-        info_str = imdb.do_python_eval_gen(gpu_num)
+    finally:
+        # stop the decode threads of all loaders
+        for test_data in test_datas:
+            for loader in (test_data if isinstance(test_data, list) else [test_data]):
+                loader.close()
+    # videos were spread over the GPUs at run time, put them back in image set order
+    res = [merge_detections(res, imdb.num_classes)]
+
+    # online Seq-NMS already rescored detections in pred_eval
+    if not streaming:
+        imdb.seq_nms_multiprocess(res, pool=seq_nms_pool)
+        for all_boxes, frame_ids in res:
+            evaluator.add_detections(all_boxes, frame_ids)
+    info_str = imdb.evaluate_detections_online(evaluator, res)
     if logger:
         logger.info('evaluate detections: \n{}'.format(info_str))
+    return evaluator.ap()
 
 
 
@@ -477,18 +879,25 @@ def draw_all_detection(im_array, detections, class_names, scale, cfg, threshold=
                         color=color_white, fontFace=cv2.FONT_HERSHEY_COMPLEX, fontScale=0.5)
     return im
 
-def prepare_data(data_list, feat_list, data_batch):
-    concat_feat = mx.ndarray.concatenate(list(feat_list), axis=0)
-    concat_data = mx.ndarray.concatenate(list(data_list), axis=0)
-
-    data_batch.data[0][-2] = concat_data
-    data_batch.provide_data[0][-2] = ('data_cache', concat_data.shape)
-    data_batch.data[0][-1] = concat_feat
-    data_batch.provide_data[0][-1] = ('feat_cache', concat_feat.shape)
+def online_seq_nms_result(seq_nms_online, nms, all_boxes, idx, num_classes):
+    """
+    feed the raw detections of image idx to the online Seq-NMS, idx None flushes the video
+    the frames it finalizes are written back to all_boxes after nms
+    """
+    if idx is None:
+        finalized = seq_nms_online.flush()
+    else:
+        finalized = seq_nms_online.push([all_boxes[j][idx] for j in range(1, num_classes)], idx)
+    for frame_idx, dets_frame in finalized:
+        for j in range(1, num_classes):
+            dets = dets_frame[j - 1]
+            keep = nms(dets)
+            all_boxes[j][frame_idx] = dets[keep, :]
 
 
 def process_pred_result(pred_result, imdb, thresh, cfg, nms, all_boxes, idx, max_per_image, vis, center_image, scales):
     for delta, (scores, boxes, data_dict) in enumerate(pred_result):
+        dets_list = []
         for j in range(1, imdb.num_classes):
             indexes = np.where(scores[:, j] > thresh)[0]
             cls_scores = scores[indexes, j, np.newaxis]
@@ -497,17 +906,12 @@ def process_pred_result(pred_result, imdb, thresh, cfg, nms, all_boxes, idx, max
             if cfg.TEST.SEQ_NMS:
                 all_boxes[j][idx+delta]=cls_dets
             else:
-                keep = nms(cls_dets)
-                all_boxes[j][idx + delta] = cls_dets[keep, :]
+                dets_list.append(cls_dets)
 
-        if cfg.TEST.SEQ_NMS==False and  max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][idx + delta][:, -1]
-                                      for j in range(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in range(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][idx + delta][:, -1] >= image_thresh)[0]
-                    all_boxes[j][idx + delta] = all_boxes[j][idx + delta][keep, :]
+        if cfg.TEST.SEQ_NMS==False:
+            # nms already applies max_per_image over all classes
+            for j, (cls_dets, keep) in enumerate(zip(dets_list, nms(dets_list)), 1):
+                all_boxes[j][idx + delta] = cls_dets[keep, :]
 
         if vis:
             boxes_this_image = [[]] + [all_boxes[j][idx + delta] for j in range(1, imdb.num_classes)]
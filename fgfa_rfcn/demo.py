@@ -20,7 +20,6 @@ from config.config import config as cfg
 from config.config import update_config
 from utils.image import resize, transform
 import numpy as np
-from collections import deque
 
 
 # get config
@@ -33,12 +32,12 @@ update_config(cur_path + '/../experiments/fgfa_rfcn/cfgs/fgfa_rfcn_vid_demo.yaml
 sys.path.insert(0, os.path.join(cur_path, '../external/mxnet/', cfg.MXNET_VERSION))
 import mxnet as mx
 import time
-from core.tester import im_detect, Predictor, get_resnet_output, prepare_data, draw_all_detection
+from core.tester import im_detect, Predictor, get_resnet_output, WindowStorage, FeatureRingBuffer, FlowRingBuffer, draw_all_detection
 from symbols import *
-from nms.seq_nms import seq_nms
+from nms.seq_nms import seq_nms, OnlineSeqNMS
 from utils.load_model import load_param
 from utils.tictoc import tic, toc
-from nms.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper
+from nms.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper, cpu_batched_nms_wrapper
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Show Flow-Guided Feature Aggregation demo')
@@ -52,6 +51,7 @@ args = parse_args()
 
 def process_pred_result(classes, pred_result, num_classes, thresh, cfg, nms, all_boxes, idx, max_per_image, vis, center_image, scales):
     for delta, (scores, boxes, data_dict) in enumerate(pred_result):
+        dets_list = []
         for j in range(1,num_classes):
             indexes = np.where(scores[:, j] > thresh)[0]
             cls_scores = scores[indexes, j, np.newaxis]
@@ -60,18 +60,12 @@ def process_pred_result(classes, pred_result, num_classes, thresh, cfg, nms, all
             if cfg.TEST.SEQ_NMS:
                 all_boxes[j][idx+delta]=cls_dets
             else:
-                cls_dets=np.float32(cls_dets)
-                keep = nms(cls_dets)
-                all_boxes[j][idx + delta] = cls_dets[keep, :]
+                dets_list.append(np.float32(cls_dets))
 
-        if cfg.TEST.SEQ_NMS==False and  max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][idx + delta][:, -1]
-                                      for j in range(1, num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in range(1, num_classes):
-                    keep = np.where(all_boxes[j][idx + delta][:, -1] >= image_thresh)[0]
-                    all_boxes[j][idx + delta] = all_boxes[j][idx + delta][keep, :]
+        if cfg.TEST.SEQ_NMS==False:
+            # nms already applies max_per_image over all classes
+            for j, (cls_dets, keep) in enumerate(zip(dets_list, nms(dets_list)), 1):
+                all_boxes[j][idx + delta] = cls_dets[keep, :]
 
             boxes_this_image = [[]] + [all_boxes[j][idx + delta] for j in range(1, num_classes)]
 
@@ -85,6 +79,14 @@ def save_image(output_dir, count, out_im):
     filename = str(count) + '.JPEG'
     cv2.imwrite(output_dir + filename, out_im)
 
+
+def save_seq_nms_result(output_dir, finalized, data, classes, nms, scales, cfg):
+    # draw the frames finalized by the online Seq-NMS
+    for frame_idx, dets_frame in finalized:
+        boxes_this_image = [[]] + [dets[nms(dets), :] for dets in dets_frame]
+        out_im = draw_all_detection(data[frame_idx][0].asnumpy(), boxes_this_image, classes, scales[0], cfg)
+        save_image(output_dir, frame_idx, out_im)
+
 def main():
     # get symbol
     pprint.pprint(cfg)
@@ -127,14 +129,17 @@ def main():
         im_info = np.array([[im_tensor.shape[2], im_tensor.shape[3], im_scale]], dtype=np.float32)
 
         feat_stride = float(cfg.network.RCNN_FEAT_STRIDE)
-        data.append({'data': im_tensor, 'im_info': im_info,  'data_cache': im_tensor,    'feat_cache': im_tensor})
+        data.append({'data': im_tensor, 'im_info': im_info, 'center_index': np.zeros((1,)), 'data_cache': im_tensor, 'feat_cache': im_tensor,
+                     'flow_cache': im_tensor})
 
 
 
     # get predictor
 
     print 'get-predictor'
-    data_names = ['data', 'im_info', 'data_cache', 'feat_cache']
+    data_names = ['data', 'im_info', 'center_index', 'data_cache', 'feat_cache']
+    if cfg.TEST.COMPOSE_FLOW:
+        data_names.append('flow_cache')
     label_names = []
 
     t1 = time.time()
@@ -157,7 +162,15 @@ def main():
                           context=[mx.gpu(0)], max_data_shapes=max_data_shape,
                           provide_data=provide_data, provide_label=provide_label,
                           arg_params=arg_params, aux_params=aux_params)
-    nms = py_nms_wrapper(cfg.TEST.NMS)
+    nms = cpu_batched_nms_wrapper(cfg.TEST.NMS, max_per_image)
+    seq_nms_post = py_nms_wrapper(cfg.TEST.NMS)
+    if cfg.TEST.COMPOSE_FLOW:
+        flow_sym = eval(cfg.symbol + '.' + cfg.symbol)().get_flow_symbol(cfg)
+        max_flow_shape = (1, 3, max([v[0] for v in cfg.SCALES]), max([v[1] for v in cfg.SCALES]))
+        flow_predictors = Predictor(flow_sym, ['data', 'data_prev'], label_names,
+                              context=[mx.gpu(0)], max_data_shapes=[[('data', max_flow_shape), ('data_prev', max_flow_shape)]],
+                              provide_data=[[('data', data[0][0].shape), ('data_prev', data[0][0].shape)]], provide_label=[None],
+                              arg_params=arg_params, aux_params=aux_params)
 
 
     # First frame of the video
@@ -168,17 +181,25 @@ def main():
     scales = [data_batch.data[i][1].asnumpy()[0, 2] for i in xrange(len(data_batch.data))]
     all_boxes = [[[] for _ in range(len(data))]
                  for _ in range(num_classes)]
-    data_list = deque(maxlen=all_frame_interval)
-    feat_list = deque(maxlen=all_frame_interval)
+    # the window lives in the input arrays of the aggregation network
+    storage = WindowStorage(aggr_predictors)
+    if cfg.TEST.COMPOSE_FLOW:
+        feat_ring = FlowRingBuffer(cfg.TEST.KEY_FRAME_INTERVAL, flow_predictors, storage)
+    else:
+        feat_ring = FeatureRingBuffer(cfg.TEST.KEY_FRAME_INTERVAL, storage)
     image, feat = get_resnet_output(feat_predictors, data_batch, data_names)
+    feat_ring.reset(image, feat)
     # append cfg.TEST.KEY_FRAME_INTERVAL padding images in the front (first frame)
-    while len(data_list) < cfg.TEST.KEY_FRAME_INTERVAL:
-        data_list.append(image)
-        feat_list.append(feat)
+    while len(feat_ring) < cfg.TEST.KEY_FRAME_INTERVAL:
+        feat_ring.append(image, feat)
 
     vis = False
     file_idx = 0
     thresh = 1e-3
+    if cfg.TEST.SEQ_NMS and cfg.TEST.SEQ_NMS_ONLINE:
+        seq_nms_online = OnlineSeqNMS(cfg.TEST.SEQ_NMS_LOOKAHEAD, cfg.TEST.SEQ_NMS_HISTORY)
+    else:
+        seq_nms_online = None
     for idx, element in enumerate(data):
 
         data_batch = mx.io.DataBatch(data=[element], label=[], pad=0, index=idx,
@@ -188,32 +209,29 @@ def main():
 
         if(idx != len(data)-1):
 
-            if len(data_list) < all_frame_interval - 1:
+            if len(feat_ring) < all_frame_interval - 1:
                 image, feat = get_resnet_output(feat_predictors, data_batch, data_names)
-                data_list.append(image)
-                feat_list.append(feat)
+                feat_ring.append(image, feat)
 
             else:
                 #################################################
                 # main part of the loop
                 #################################################
                 image, feat = get_resnet_output(feat_predictors, data_batch, data_names)
-                data_list.append(image)
-                feat_list.append(feat)
+                feat_ring.append(image, feat)
 
-                prepare_data(data_list, feat_list, data_batch)
+                feat_ring.im_info[:] = element[1]
+                feat_ring.fill_batch(data_batch)
                 pred_result = im_detect(aggr_predictors, data_batch, data_names, scales, cfg)
 
-                data_batch.data[0][-2] = None
-                data_batch.provide_data[0][-2] = ('data_cache', None)
-                data_batch.data[0][-1] = None
-                data_batch.provide_data[0][-1] = ('feat_cache', None)
-
                 out_im = process_pred_result(classes, pred_result, num_classes, thresh, cfg, nms, all_boxes, file_idx, max_per_image, vis,
-                                    data_list[cfg.TEST.KEY_FRAME_INTERVAL].asnumpy(), scales)
+                                    feat_ring.center_data().asnumpy(), scales)
                 total_time = time.time()-t1
                 if (cfg.TEST.SEQ_NMS==False):
                     save_image(output_dir, file_idx, out_im)
+                elif seq_nms_online is not None:
+                    finalized = seq_nms_online.push([all_boxes[j][file_idx] for j in range(1, num_classes)], file_idx)
+                    save_seq_nms_result(output_dir, finalized, data, classes, seq_nms_post, scales, cfg)
                 print 'testing {} {:.4f}s'.format(str(file_idx)+'.JPEG', total_time /(file_idx+1))
                 file_idx += 1
         else:
@@ -223,28 +241,33 @@ def main():
 
             end_counter = 0
             image, feat = get_resnet_output(feat_predictors, data_batch, data_names)
+            feat_ring.im_info[:] = element[1]
             while end_counter < cfg.TEST.KEY_FRAME_INTERVAL + 1:
-                data_list.append(image)
-                feat_list.append(feat)
-                prepare_data(data_list, feat_list, data_batch)
+                feat_ring.append(image, feat)
+                feat_ring.fill_batch(data_batch)
                 pred_result = im_detect(aggr_predictors, data_batch, data_names, scales, cfg)
 
                 out_im = process_pred_result(classes, pred_result, num_classes, thresh, cfg, nms, all_boxes, file_idx, max_per_image, vis,
-                                    data_list[cfg.TEST.KEY_FRAME_INTERVAL].asnumpy(), scales)
+                                    feat_ring.center_data().asnumpy(), scales)
 
                 total_time = time.time() - t1
                 if (cfg.TEST.SEQ_NMS == False):
                     save_image(output_dir, file_idx, out_im)
+                elif seq_nms_online is not None:
+                    finalized = seq_nms_online.push([all_boxes[j][file_idx] for j in range(1, num_classes)], file_idx)
+                    save_seq_nms_result(output_dir, finalized, data, classes, seq_nms_post, scales, cfg)
                 print 'testing {} {:.4f}s'.format(str(file_idx)+'.JPEG', total_time / (file_idx+1))
                 file_idx += 1
                 end_counter+=1
 
-    if(cfg.TEST.SEQ_NMS):
+    if seq_nms_online is not None:
+        save_seq_nms_result(output_dir, seq_nms_online.flush(), data, classes, seq_nms_post, scales, cfg)
+    elif(cfg.TEST.SEQ_NMS):
         video = [all_boxes[j][:] for j in range(1, num_classes)]
         dets_all = seq_nms(video)
         for cls_ind, dets_cls in enumerate(dets_all):
             for frame_ind, dets in enumerate(dets_cls):
-                keep = nms(dets)
+                keep = seq_nms_post(dets)
                 all_boxes[cls_ind + 1][frame_ind] = dets[keep, :]
         for idx in range(len(data)):
             boxes_this_image = [[]] + [all_boxes[j][idx] for j in range(1, num_classes)]
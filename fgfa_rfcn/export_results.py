@@ -0,0 +1,35 @@
+# --------------------------------------------------------
+# Flow-Guided Feature Aggregation
+# Copyright (c) 2017 Microsoft
+# Licensed under The Apache-2.0 License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Convert binary detection results (det_*.npy, see lib/dataset/vid_results.py) to the
+ImageNet VID text format, one 'frame_id cls score x1 y1 x2 y2' line per detection.
+"""
+
+import _init_paths
+
+import argparse
+import os
+from dataset.vid_results import read_results, write_text
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export detection results as text')
+    parser.add_argument('results', help='result files (.npy), concatenated in the given order', nargs='+', type=str)
+    parser.add_argument('--output', help='text file to write, <first result file>.txt by default', default='', type=str)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    output = args.output or os.path.splitext(args.results[0])[0] + '.txt'
+    records = read_results(args.results)
+    write_text(output, records)
+    print 'wrote {} detections to {}'.format(len(records), output)
+
+if __name__ == '__main__':
+    main()
@@ -7,16 +7,18 @@
 # --------------------------------------------------------
 
 import argparse
+import copy
 import pprint
 import logging
 import time
 import os
 import numpy as np
 import mxnet as mx
+from multiprocessing import Pool, cpu_count
 
 from symbols import *
 from dataset import *
-from core.loader import TestLoader
+from core.loader import TestLoader, VideoQueue
 from core.tester import Predictor, pred_eval, pred_eval_multiprocess
 from utils.load_model import load_param
 
@@ -30,7 +32,7 @@ def get_predictor(sym, sym_instance, cfg, arg_params, aux_params, test_data, ctx
     data_names = [k[0] for k in test_data.provide_data_single]
     label_names = None
     max_data_shape = [[('data', (1, 3, max([v[0] for v in cfg.SCALES]), max([v[1] for v in cfg.SCALES]))),
-                       ('data_cache', (19, 3, max([v[0] for v in cfg.SCALES]), max([v[1] for v in cfg.SCALES]))),
+                       ('data_cache', (19 * cfg.TEST.BATCH_IMAGES, 3, max([v[0] for v in cfg.SCALES]), max([v[1] for v in cfg.SCALES]))),
                        ]]
 
     # create predictor
@@ -40,6 +42,24 @@ def get_predictor(sym, sym_instance, cfg, arg_params, aux_params, test_data, ctx
                           arg_params=arg_params, aux_params=aux_params)
     return predictor
 
+def get_flow_predictor(sym, sym_instance, cfg, arg_params, aux_params, test_data, ctx):
+    # adjacent frame flows take the newest frame and its predecessor
+    data_shape = dict(test_data.provide_data_single)['data']
+    data_shape_dict = {'data': data_shape, 'data_prev': data_shape}
+    sym_instance.infer_shape(data_shape_dict)
+    sym_instance.check_parameter_shapes(arg_params, aux_params, data_shape_dict, is_train=False)
+
+    data_names = ['data', 'data_prev']
+    max_shape = (1, 3, max([v[0] for v in cfg.SCALES]), max([v[1] for v in cfg.SCALES]))
+    max_data_shape = [[('data', max_shape), ('data_prev', max_shape)]]
+    provide_data = [[(k, data_shape) for k in data_names]]
+
+    predictor = Predictor(sym, data_names, None,
+                          context=ctx, max_data_shapes=max_data_shape,
+                          provide_data=provide_data, provide_label=[None],
+                          arg_params=arg_params, aux_params=aux_params)
+    return predictor
+
 def test_rcnn(cfg, dataset, image_set, root_path, dataset_path, motion_iou_path,
               ctx, prefix, epoch,
               vis, ignore_cache, shuffle, has_rpn, proposal, thresh, logger=None, output_path=None, enable_detailed_eval=True):
@@ -50,36 +70,79 @@ def test_rcnn(cfg, dataset, image_set, root_path, dataset_path, motion_iou_path,
     pprint.pprint(cfg)
     logger.info('testing cfg:{}\n'.format(pprint.pformat(cfg)))
 
-    # load symbol and testing data
-
+    # offline Seq-NMS forks its workers here, before MXNet, CUDA and the loader threads are started
+    if cfg.TEST.SEQ_NMS and not cfg.TEST.SEQ_NMS_ONLINE:
+        seq_nms_pool = Pool(processes=cpu_count())
+    else:
+        seq_nms_pool = None
+
+    try:
+        # load testing data
+        imdb = eval(dataset)(image_set, root_path, dataset_path, motion_iou_path, result_path=output_path, enable_detailed_eval=enable_detailed_eval)
+        roidb = imdb.gt_roidb()
+
+        # load model
+        arg_params, aux_params = load_param(prefix, epoch, process=True)
+
+        if cfg.TEST.COMPOSE_FLOW:
+            logger.info('aggregating with flows composed from adjacent frame pairs')
+        ap = test_videos(cfg, imdb, roidb, ctx, arg_params, aux_params, vis, ignore_cache, shuffle, has_rpn, thresh, logger,
+                         seq_nms_pool)
+
+        if cfg.TEST.COMPOSE_FLOW and cfg.TEST.COMPOSE_FLOW_REFERENCE:
+            # composed flows approximate the ones FlowNet computes for every (center, neighbor) pair,
+            # test the same model with those as well and report the difference
+            ref_cfg = copy.deepcopy(cfg)
+            ref_cfg.TEST.COMPOSE_FLOW = False
+            ref_output_path = os.path.join(output_path, 'direct_flow')
+            if not os.path.exists(ref_output_path):
+                os.makedirs(ref_output_path)
+            ref_imdb = eval(dataset)(image_set, root_path, dataset_path, motion_iou_path, result_path=ref_output_path,
+                                     enable_detailed_eval=enable_detailed_eval)
+            logger.info('testing the reference with direct flows')
+            ref_ap = test_videos(ref_cfg, ref_imdb, ref_imdb.gt_roidb(), ctx, arg_params, aux_params, vis, ignore_cache,
+                                 shuffle, has_rpn, thresh, logger, seq_nms_pool)
+            mean_ap, ref_mean_ap = np.mean(ap[0][0][ap[0][0] >= 0]), np.mean(ref_ap[0][0][ref_ap[0][0] >= 0])
+            logger.info('Mean AP@0.5 composed flow {:.4f}, direct flow {:.4f}, difference {:+.4f}'.format(
+                mean_ap, ref_mean_ap, mean_ap - ref_mean_ap))
+    finally:
+        if seq_nms_pool is not None:
+            seq_nms_pool.close()
+            seq_nms_pool.join()
+
+
+def test_videos(cfg, imdb, roidb, ctx, arg_params, aux_params, vis, ignore_cache, shuffle, has_rpn, thresh, logger,
+                seq_nms_pool=None):
+    """
+    detect and evaluate all videos of roidb
+    :param seq_nms_pool: process Pool of offline Seq-NMS
+    :return: ap, see VIDMotionEvaluator.ap
+    """
     feat_sym_instance = eval(cfg.symbol + '.' + cfg.symbol)()
     aggr_sym_instance = eval(cfg.symbol + '.' + cfg.symbol)()
 
     feat_sym = feat_sym_instance.get_feat_symbol(cfg)
     aggr_sym = aggr_sym_instance.get_aggregation_symbol(cfg)
 
-    imdb = eval(dataset)(image_set, root_path, dataset_path, motion_iou_path, result_path=output_path, enable_detailed_eval=enable_detailed_eval)
-    roidb = imdb.gt_roidb()
-
     # get test data iter
-    # split roidbs
+    # every GPU aggregates cfg.TEST.BATCH_IMAGES videos at once, each of them with its own loader,
+    # a loader takes the next (longest remaining) video once it is done with its current one
     gpu_num = len(ctx)
-    roidbs = [[] for x in range(gpu_num)]
-    roidbs_seg_lens = np.zeros(gpu_num, dtype=np.int)
-    for x in roidb:
-        gpu_id = np.argmin(roidbs_seg_lens)
-        roidbs[gpu_id].append(x)
-        roidbs_seg_lens[gpu_id] += x['frame_seg_len']
-
-    # get test data iter
-    test_datas = [TestLoader(x, cfg, batch_size=1, shuffle=shuffle, has_rpn=has_rpn) for x in roidbs]
-
-    # load model
-    arg_params, aux_params = load_param(prefix, epoch, process=True)
+    video_queue = VideoQueue(roidb)
+    test_datas = [[TestLoader(None, cfg, batch_size=1, shuffle=shuffle, has_rpn=has_rpn, video_queue=video_queue)
+                   for _ in range(cfg.TEST.BATCH_IMAGES)] for _ in range(gpu_num)]
 
     # create predictor
-    feat_predictors = [get_predictor(feat_sym, feat_sym_instance, cfg, arg_params, aux_params, test_datas[i], [ctx[i]]) for i in range(gpu_num)]
-    aggr_predictors = [get_predictor(aggr_sym, aggr_sym_instance, cfg, arg_params, aux_params, test_datas[i], [ctx[i]]) for i in range(gpu_num)]
+    feat_predictors = [get_predictor(feat_sym, feat_sym_instance, cfg, arg_params, aux_params, test_datas[i][0], [ctx[i]]) for i in range(gpu_num)]
+    aggr_predictors = [get_predictor(aggr_sym, aggr_sym_instance, cfg, arg_params, aux_params, test_datas[i][0], [ctx[i]]) for i in range(gpu_num)]
+
+    if cfg.TEST.COMPOSE_FLOW:
+        flow_sym_instance = eval(cfg.symbol + '.' + cfg.symbol)()
+        flow_sym = flow_sym_instance.get_flow_symbol(cfg)
+        flow_predictors = [get_flow_predictor(flow_sym, flow_sym_instance, cfg, arg_params, aux_params, test_datas[i][0], [ctx[i]]) for i in range(gpu_num)]
+    else:
+        flow_predictors = None
 
     # start detection
-    pred_eval_multiprocess(gpu_num, feat_predictors, aggr_predictors, test_datas, imdb, cfg, vis=vis, ignore_cache=ignore_cache, thresh=thresh, logger=logger)
+    return pred_eval_multiprocess(gpu_num, feat_predictors, aggr_predictors, test_datas, imdb, cfg, vis=vis, ignore_cache=ignore_cache, thresh=thresh, logger=logger,
+                                  flow_predictors=flow_predictors, seq_nms_pool=seq_nms_pool)
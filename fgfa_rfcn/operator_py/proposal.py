@@ -8,8 +8,8 @@ import numpy as np
 import numpy.random as npr
 from distutils.util import strtobool
 
-from bbox.bbox_transform import bbox_pred, clip_boxes
-from rpn.generate_anchor import generate_anchors
+from bbox.bbox_transform import bbox_pred
+from rpn.generate_anchor import generate_anchors, anchor_grid
 from nms.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper
 
 DEBUG = False
@@ -36,11 +36,11 @@ class ProposalOperator(mx.operator.CustomOp):
             print self._anchors
 
     def forward(self, is_train, req, in_data, out_data, aux):
-        nms = gpu_nms_wrapper(self._threshold, in_data[0].context.device_id)
-
-        batch_size = in_data[0].shape[0]
-        if batch_size > 1:
-            raise ValueError("Sorry, multiple images each device is not implemented")
+        ctx = in_data[0].context
+        if ctx.device_type == 'gpu':
+            nms = gpu_nms_wrapper(self._threshold, ctx.device_id)
+        else:
+            nms = cpu_nms_wrapper(self._threshold)
 
         # for each (H, W) location i
         #   generate A anchor boxes centered on cell i
@@ -52,6 +52,7 @@ class ProposalOperator(mx.operator.CustomOp):
         # apply NMS with threshold 0.7 to remaining proposals
         # take after_nms_topN proposals after NMS
         # return the top proposals (-> RoIs top, scores top)
+        # steps up to the filtering are done for all images at once, sorting and NMS image by image
 
         pre_nms_topN = self._rpn_pre_nms_top_n
         post_nms_topN = self._rpn_post_nms_top_n
@@ -61,128 +62,98 @@ class ProposalOperator(mx.operator.CustomOp):
         # keep the second part
         scores = in_data[0].asnumpy()[:, self._num_anchors:, :, :]
         bbox_deltas = in_data[1].asnumpy()
-        im_info = in_data[2].asnumpy()[0, :]
-
-        if DEBUG:
-            print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
-            print 'scale: {}'.format(im_info[2])
-
-        # 1. Generate proposals from bbox_deltas and shifted anchors
-        # use real image size instead of padded feature map sizes
-        height, width = int(im_info[0] / self._feat_stride), int(im_info[1] / self._feat_stride)
+        im_info = in_data[2].asnumpy()
+        batch_size, A, H, W = scores.shape
 
         if DEBUG:
+            print 'im_info: {}'.format(im_info)
             print 'score map size: {}'.format(scores.shape)
-            print "resudial: {}".format((scores.shape[2] - height, scores.shape[3] - width))
-
-        # Enumerate all shifts
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
 
-        # Enumerate all shifted anchors:
-        #
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
-        A = self._num_anchors
-        K = shifts.shape[0]
-        anchors = self._anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-        anchors = anchors.reshape((K * A, 4))
+        # 1. Generate proposals from bbox_deltas and shifted anchors
+        # Enumerate all shifted anchors of the (padded) feature map, (K*A, 4) ordered by (h, w, a)
+        anchors = anchor_grid(H, W, self._feat_stride, self._scales, self._ratios)
+        K = H * W
 
         # Transpose and reshape predicted bbox transformations to get them
         # into the same order as the anchors:
         #
-        # bbox deltas will be (1, 4 * A, H, W) format
-        # transpose to (1, H, W, 4 * A)
-        # reshape to (1 * H * W * A, 4) where rows are ordered by (h, w, a)
+        # bbox deltas will be (N, 4 * A, H, W) format
+        # transpose to (N, H, W, 4 * A)
+        # reshape to (N * H * W * A, 4) where rows are ordered by (n, h, w, a)
         # in slowest to fastest order
-        bbox_deltas = self._clip_pad(bbox_deltas, (height, width))
         bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
 
         # Same story for the scores:
         #
-        # scores are (1, A, H, W) format
-        # transpose to (1, H, W, A)
-        # reshape to (1 * H * W * A, 1) where rows are ordered by (h, w, a)
-        scores = self._clip_pad(scores, (height, width))
-        scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
+        # scores are (N, A, H, W) format
+        # transpose to (N, H, W, A)
+        # reshape to (N, H * W * A) where columns are ordered by (h, w, a)
+        scores = scores.transpose((0, 2, 3, 1)).reshape((batch_size, K * A))
 
         # Convert anchors into proposals via bbox transformations
-        proposals = bbox_pred(anchors, bbox_deltas)
+        proposals = bbox_pred(np.tile(anchors, (batch_size, 1)), bbox_deltas).reshape((batch_size, K * A, 4))
 
-        # 2. clip predicted boxes to image
-        proposals = clip_boxes(proposals, im_info[:2])
+        # 2. clip predicted boxes to their image
+        im_heights = im_info[:, 0].reshape((batch_size, 1, 1))
+        im_widths = im_info[:, 1].reshape((batch_size, 1, 1))
+        proposals[:, :, 0::2] = np.maximum(np.minimum(proposals[:, :, 0::2], im_widths - 1), 0)
+        proposals[:, :, 1::2] = np.maximum(np.minimum(proposals[:, :, 1::2], im_heights - 1), 0)
 
-        # 3. remove predicted boxes with either height or width < threshold
+        # 3. remove predicted boxes of the padded area of the feature map
+        # use real image size instead of padded feature map sizes
+        feat_heights = (im_info[:, 0] / self._feat_stride).astype(np.int64)
+        feat_widths = (im_info[:, 1] / self._feat_stride).astype(np.int64)
+        cell_y = np.repeat(np.arange(H), W * A)
+        cell_x = np.tile(np.repeat(np.arange(W), A), H)
+        valid = (cell_y < feat_heights[:, np.newaxis]) & (cell_x < feat_widths[:, np.newaxis])
+        # and those with either height or width < threshold
         # (NOTE: convert min_size to input image scale stored in im_info[2])
-        keep = self._filter_boxes(proposals, min_size * im_info[2])
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # 4. sort all (proposal, score) pairs by score from highest to lowest
-        # 5. take top pre_nms_topN (e.g. 6000)
-        order = scores.ravel().argsort()[::-1]
-        if pre_nms_topN > 0:
-            order = order[:pre_nms_topN]
-        proposals = proposals[order, :]
-        scores = scores[order]
-
-        # 6. apply nms (e.g. threshold = 0.7)
-        # 7. take after_nms_topN (e.g. 300)
-        # 8. return the top proposals (-> RoIs top)
-        det = np.hstack((proposals, scores)).astype(np.float32)
-        keep = nms(det)
-        if post_nms_topN > 0:
-            keep = keep[:post_nms_topN]
-        # pad to ensure output size remains unchanged
-        if len(keep) < post_nms_topN:
-            pad = npr.choice(keep, size=post_nms_topN - len(keep))
-            keep = np.hstack((keep, pad))
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # Output rois array
-        # Our RPN implementation only supports a single input image, so all
-        # batch inds are 0
-        batch_inds = np.zeros((proposals.shape[0], 1), dtype=np.float32)
-        blob = np.hstack((batch_inds, proposals.astype(np.float32, copy=False)))
-        self.assign(out_data[0], req[0], blob)
+        min_sizes = (min_size * im_info[:, 2]).reshape((batch_size, 1))
+        ws = proposals[:, :, 2] - proposals[:, :, 0] + 1
+        hs = proposals[:, :, 3] - proposals[:, :, 1] + 1
+        valid &= (ws >= min_sizes) & (hs >= min_sizes)
+
+        blobs = []
+        scores_all = []
+        for i in range(batch_size):
+            keep = np.where(valid[i])[0]
+            im_proposals = proposals[i, keep, :]
+            im_scores = scores[i, keep].reshape((-1, 1))
+
+            # 4. sort all (proposal, score) pairs by score from highest to lowest
+            # 5. take top pre_nms_topN (e.g. 6000)
+            order = im_scores.ravel().argsort()[::-1]
+            if pre_nms_topN > 0:
+                order = order[:pre_nms_topN]
+            im_proposals = im_proposals[order, :]
+            im_scores = im_scores[order]
+
+            # 6. apply nms (e.g. threshold = 0.7)
+            # 7. take after_nms_topN (e.g. 300)
+            # 8. return the top proposals (-> RoIs top)
+            det = np.hstack((im_proposals, im_scores)).astype(np.float32)
+            keep = nms(det)
+            if post_nms_topN > 0:
+                keep = keep[:post_nms_topN]
+            # pad to ensure output size remains unchanged
+            if len(keep) < post_nms_topN:
+                pad = npr.choice(keep, size=post_nms_topN - len(keep))
+                keep = np.hstack((keep, pad))
+
+            # Output rois array, rois of image i carry batch index i
+            batch_inds = np.full((len(keep), 1), i, dtype=np.float32)
+            blobs.append(np.hstack((batch_inds, im_proposals[keep, :].astype(np.float32, copy=False))))
+            scores_all.append(im_scores[keep].astype(np.float32, copy=False))
+        self.assign(out_data[0], req[0], np.vstack(blobs))
 
         if self._output_score:
-            self.assign(out_data[1], req[1], scores.astype(np.float32, copy=False))
+            self.assign(out_data[1], req[1], np.vstack(scores_all))
 
     def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
         self.assign(in_grad[0], req[0], 0)
         self.assign(in_grad[1], req[1], 0)
         self.assign(in_grad[2], req[2], 0)
 
-    @staticmethod
-    def _filter_boxes(boxes, min_size):
-        """ Remove all boxes with any side smaller than min_size """
-        ws = boxes[:, 2] - boxes[:, 0] + 1
-        hs = boxes[:, 3] - boxes[:, 1] + 1
-        keep = np.where((ws >= min_size) & (hs >= min_size))[0]
-        return keep
-
-    @staticmethod
-    def _clip_pad(tensor, pad_shape):
-        """
-        Clip boxes of the pad area.
-        :param tensor: [n, c, H, W]
-        :param pad_shape: [h, w]
-        :return: [n, c, h, w]
-        """
-        H, W = tensor.shape[2:]
-        h, w = pad_shape
-
-        if h < H or w < W:
-            tensor = tensor[:, :, :h, :w].copy()
-
-        return tensor
-
 
 @mx.operator.register("proposal")
 class ProposalProp(mx.operator.CustomOpProp):
@@ -214,8 +185,8 @@ class ProposalProp(mx.operator.CustomOpProp):
 
         batch_size = cls_prob_shape[0]
         im_info_shape = (batch_size, 3)
-        output_shape = (self._rpn_post_nms_top_n, 5)
-        score_shape = (self._rpn_post_nms_top_n, 1)
+        output_shape = (batch_size * self._rpn_post_nms_top_n, 5)
+        score_shape = (batch_size * self._rpn_post_nms_top_n, 1)
 
         if self._output_score:
             return [cls_prob_shape, bbox_pred_shape, im_info_shape], [output_shape, score_shape]
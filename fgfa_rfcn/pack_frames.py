@@ -0,0 +1,104 @@
+# --------------------------------------------------------
+# Flow-Guided Feature Aggregation
+# Copyright (c) 2017 Microsoft
+# Licensed under The Apache-2.0 License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Pack the frames of every VID snippet, resized to each of the configured SCALES, into
+memory-mappable frame store files (see lib/utils/frame_store.py). Loaders read them
+instead of the JPEGs once config.dataset.frame_store_path points to the written index.
+"""
+
+import _init_paths
+
+import cv2
+import argparse
+import cPickle
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from config.config import config, update_config
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pack VID frames into a frame store')
+    # general
+    parser.add_argument('--cfg', help='experiment configure file name', required=True, type=str)
+
+    args, rest = parser.parse_known_args()
+    update_config(args.cfg)
+
+    parser.add_argument('--image_set', help='image sets to pack, + separated',
+                        default='+'.join([config.dataset.image_set, config.dataset.test_image_set]), type=str)
+    parser.add_argument('--output', help='index file to write', default=config.dataset.frame_store_path, type=str)
+    parser.add_argument('--threads', help='decode threads', default=8, type=int)
+    args = parser.parse_args()
+    return args
+
+args = parse_args()
+
+from dataset import *
+from utils.image import resize
+from utils.frame_store import write_video
+
+
+def load_frame(job):
+    path, target_size, max_size = job
+    assert os.path.exists(path), '%s does not exist'.format(path)
+    im = cv2.imread(path, cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION)
+    return resize(im, target_size, max_size)
+
+
+def get_videos(image_sets):
+    """
+    :return: list of (snippet directory, frame paths), one entry per snippet in image set order
+    """
+    videos = []
+    seen = set()
+    for image_set in image_sets:
+        imdb = eval(config.dataset.dataset)(image_set, config.dataset.root_path, config.dataset.dataset_path,
+                                            config.dataset.motion_iou_path)
+        if not hasattr(imdb, 'pattern'):
+            print 'skip {}, it has no video snippets'.format(image_set)
+            continue
+        for pattern, seg_len in zip(imdb.pattern, imdb.frame_seg_len):
+            paths = [imdb.image_path_from_index(pattern % i) for i in range(seg_len)]
+            video = os.path.dirname(paths[0])
+            if video not in seen:
+                seen.add(video)
+                videos.append((video, paths))
+    return videos
+
+
+def main():
+    assert args.output, 'set config.dataset.frame_store_path or pass --output'
+    videos = get_videos(args.image_set.split('+'))
+    num_frames = sum([len(paths) for _, paths in videos])
+    print 'packing {} snippets, {} frames'.format(len(videos), num_frames)
+
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    prefix = os.path.splitext(os.path.basename(args.output))[0]
+
+    pool = ThreadPool(processes=args.threads)
+    index = {}
+    for target_size, max_size in config.SCALES:
+        data_file = '{}_{}x{}.bin'.format(prefix, target_size, max_size)
+        entry = {'file': data_file, 'videos': {}}
+        t = time.time()
+        with open(os.path.join(output_dir, data_file), 'wb') as f:
+            for i, (video, paths) in enumerate(videos):
+                frames = pool.imap(load_frame, [(path, target_size, max_size) for path in paths], chunksize=4)
+                entry['videos'][video] = write_video(f, frames)
+                if (i + 1) % 100 == 0:
+                    print 'scale {}x{}: {}/{} snippets, {:.1f}s'.format(target_size, max_size, i + 1, len(videos),
+                                                                       time.time() - t)
+        index[(target_size, max_size)] = entry
+
+    with open(args.output, 'wb') as f:
+        cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+    print 'wrote frame store index {}'.format(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -1029,6 +1029,7 @@ class resnet_v1_101_flownet_rfcn(Symbol):
 
         data = mx.sym.Variable(name="data")
         im_info = mx.sym.Variable(name="im_info")
+        center_index = mx.sym.Variable(name="center_index")
         data_cache = mx.sym.Variable(name="data_cache")
         feat_cache = mx.sym.Variable(name="feat_cache")
 
@@ -1037,7 +1038,26 @@ class resnet_v1_101_flownet_rfcn(Symbol):
         embed_feat = self.get_embednet(conv_feat)
         conv_embed = mx.sym.Concat(conv_feat, embed_feat, name="conv_embed")
 
-        group = mx.sym.Group([conv_embed, im_info, data_cache, feat_cache])
+        outputs = [conv_embed, im_info, center_index, data_cache, feat_cache]
+        if cfg.TEST.COMPOSE_FLOW:
+            outputs.append(mx.sym.Variable(name="flow_cache"))
+        group = mx.sym.Group(outputs)
+        self.sym = group
+        return group
+
+    def get_flow_symbol(self, cfg):
+        data = mx.sym.Variable(name="data")
+        data_prev = mx.sym.Variable(name="data_prev")
+
+        # flows between the newest frame and its predecessor in both directions
+        # flow[0]: newest -> previous, flow[1]: previous -> newest
+        flow_input_1 = mx.symbol.Concat(data / 255.0, data_prev / 255.0, dim=1)
+        flow_input_2 = mx.symbol.Concat(data_prev / 255.0, data / 255.0, dim=1)
+        flow_input = mx.symbol.Concat(flow_input_1, flow_input_2, dim=0)
+        flow = self.get_flownet(flow_input)
+        flow = mx.sym.BlockGrad(data=flow, name='flow')
+
+        group = mx.sym.Group([flow])
         self.sym = group
         return group
 
@@ -1050,15 +1070,22 @@ class resnet_v1_101_flownet_rfcn(Symbol):
 
         data_cur = mx.sym.Variable(name="data")                 # not used
         im_info = mx.sym.Variable(name="im_info")
-        data_cache = mx.sym.Variable(name="data_cache")         # data_cache contains data_range images
+        # TEST.BATCH_IMAGES windows of different videos are stacked along the first axis of the caches,
+        # window b takes the rows b * data_range:(b + 1) * data_range
+        center_index = mx.sym.Variable(name="center_index")     # row of every center frame in the (ring buffer) caches
+        data_cache = mx.sym.Variable(name="data_cache")         # data_cache contains data_range images per window
         feat_cache = mx.sym.Variable(name="feat_cache")         # feat_cache contains the data_range feature maps of the images
 
-        # make data_range copies of the center frame to pass through FlowNet
-        cur_data = mx.symbol.slice_axis(data_cache, axis=0, begin=cfg.TEST.KEY_FRAME_INTERVAL, end=cfg.TEST.KEY_FRAME_INTERVAL+1)
-        cur_data_copies = mx.sym.tile(cur_data, reps=(data_range, 1, 1, 1))
-        flow_input = mx.symbol.Concat(cur_data_copies / 255.0, data_cache / 255.0, dim=1)
-        flow = self.get_flownet(flow_input)
-        
+        if cfg.TEST.COMPOSE_FLOW:
+            # center-to-neighbor flows are composed outside from the cached flows of adjacent frames
+            flow = mx.sym.Variable(name="flow_cache")
+        else:
+            # make data_range copies of every center frame to pass through FlowNet
+            cur_data = mx.sym.take(data_cache, center_index)
+            cur_data_copies = mx.sym.repeat(cur_data, repeats=data_range, axis=0)
+            flow_input = mx.symbol.Concat(cur_data_copies / 255.0, data_cache / 255.0, dim=1)
+            flow = self.get_flownet(flow_input)
+
         flow_grid = mx.sym.GridGenerator(data=flow, transform_type='warp', name='flow_grid')
         conv_feat = mx.sym.BilinearSampler(data=feat_cache, grid=flow_grid, name='warping_feat')  # warped result
 
@@ -1066,16 +1093,20 @@ class resnet_v1_101_flownet_rfcn(Symbol):
         conv_feat = mx.symbol.slice_axis(conv_feat, axis=1, begin=0, end=1024)
         
         # compute weight
-        cur_embed = mx.symbol.slice_axis(embed_output, axis=0, begin=cfg.TEST.KEY_FRAME_INTERVAL, end=cfg.TEST.KEY_FRAME_INTERVAL+1)
-        cur_embed = mx.sym.tile(cur_embed, reps=(data_range, 1, 1, 1))
+        cur_embed = mx.sym.take(embed_output, center_index)
+        cur_embed = mx.sym.repeat(cur_embed, repeats=data_range, axis=0)
         unnormalize_weight = self.compute_weight(embed_output, cur_embed)
 
-        weights = mx.symbol.softmax(data=unnormalize_weight, axis=0)
+        # [batch * data_range, 1, h, w] -> [batch, data_range, h, w], normalized over the frames of each window
+        unnormalize_weight = mx.sym.Reshape(unnormalize_weight, shape=(-1, data_range, 0, 0))
+        weights = mx.symbol.softmax(data=unnormalize_weight, axis=1)
 
-        weights = mx.sym.SliceChannel(weights, axis=0, num_outputs=data_range)
+        weights = mx.sym.SliceChannel(weights, axis=1, num_outputs=data_range)
+        # [batch * data_range, 1024, h, w] -> [batch, data_range, 1024, h, w]
+        conv_feat = mx.sym.Reshape(mx.sym.expand_dims(conv_feat, axis=0), shape=(-1, data_range, 0, 0, 0))
         # tile part
         aggregated_conv_feat = 0
-        warp_list = mx.sym.SliceChannel(conv_feat, axis=0, num_outputs=data_range)
+        warp_list = mx.sym.SliceChannel(conv_feat, axis=1, num_outputs=data_range, squeeze_axis=True)
         for i in range(data_range):
             tiled_weight = mx.symbol.tile(data=weights[i], reps=(1, 1024, 1, 1))
             aggregated_conv_feat += tiled_weight * warp_list[i]
@@ -1105,8 +1136,11 @@ class resnet_v1_101_flownet_rfcn(Symbol):
             data=rpn_cls_score_reshape, mode="channel", name="rpn_cls_prob")
         rpn_cls_prob_reshape = mx.sym.Reshape(
             data=rpn_cls_prob, shape=(0, 2 * num_anchors, -1, 0), name='rpn_cls_prob_reshape')
-        if cfg.TEST.CXX_PROPOSAL:
-            rois = mx.contrib.sym.Proposal(
+        # the C++ Proposal takes a single image, MultiProposal (if this mxnet has it) a batch of them
+        cxx_proposal = mx.contrib.sym.Proposal if cfg.TEST.BATCH_IMAGES == 1 \
+            else getattr(mx.contrib.sym, 'MultiProposal', None)
+        if cfg.TEST.CXX_PROPOSAL and cxx_proposal is not None:
+            rois = cxx_proposal(
                 cls_prob=rpn_cls_prob_reshape, bbox_pred=rpn_bbox_pred, im_info=im_info, name='rois',
                 feature_stride=cfg.network.RPN_FEAT_STRIDE, scales=tuple(cfg.network.ANCHOR_SCALES),
                 ratios=tuple(cfg.network.ANCHOR_RATIOS),
@@ -1151,7 +1185,10 @@ class resnet_v1_101_flownet_rfcn(Symbol):
                                    name='bbox_pred_reshape')
 
         # group output
-        group = mx.sym.Group([data_cur, rois, cls_prob, bbox_pred])
+        outputs = [data_cur, rois, cls_prob, bbox_pred]
+        if cfg.TEST.COMPOSE_FLOW:
+            outputs.append(data_cache)     # not used
+        group = mx.sym.Group(outputs)
         self.sym = group
         return group
 
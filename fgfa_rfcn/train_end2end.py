@@ -154,14 +154,20 @@ def train_net(args, ctx, pretrained, pretrained_flow, epoch, prefix, begin_epoch
                         'rescale_grad': 1.0,
                         'clip_gradient': None}
 
+    if train_data.frame_cache is not None:
+        epoch_end_callback.append(callback.frame_cache_stats(train_data.frame_cache))
+    anchor_loader = train_data
     if not isinstance(train_data, PrefetchingIter):
-        train_data = PrefetchingIter(train_data)
+        train_data = PrefetchingIter(train_data, prefetch_depth=config.TRAIN.PREFETCH_DEPTH)
+    epoch_end_callback.append(callback.prefetch_stats(train_data))
 
     # train
     mod.fit(train_data, eval_metric=eval_metrics, epoch_end_callback=epoch_end_callback,
             batch_end_callback=batch_end_callback, kvstore=config.default.kvstore,
             optimizer='sgd', optimizer_params=optimizer_params,
             arg_params=arg_params, aux_params=aux_params, begin_epoch=begin_epoch, num_epoch=end_epoch)
+    train_data.close()
+    anchor_loader.close()
 
 
 def main():
@@ -0,0 +1,194 @@
+# --------------------------------------------------------
+# Flow-Guided Feature Aggregation
+# Copyright (c) 2017 Microsoft
+# Licensed under The Apache-2.0 License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Column store of parsed ImageNet VID/DET XML annotations, shared by gt_roidb and the evaluation.
+Every annotation file is parsed once (in parallel) and kept with its raw values; users derive
+their own view (clipped uint16 boxes for training, per-object IoU thresholds for evaluation).
+
+columns (one .npy file each, loaded with mmap):
+    index       [n]      annotation key, e.g. 'VID/val/ILSVRC2015_val_00000000/000000'
+    height      [n]      image height
+    width       [n]      image width
+    obj_offsets [n + 1]  objects of image i are obj_offsets[i]:obj_offsets[i + 1]
+    boxes       [m, 4]   xmin, ymin, xmax, ymax as written in the XML file
+    names       [m]      wnid of every object
+    thr         [m]      IoU threshold of every object used by the ImageNet VID evaluation
+"""
+
+import multiprocessing as mp
+import os
+import shutil
+import time
+import numpy as np
+
+COLUMNS = ['index', 'height', 'width', 'obj_offsets', 'boxes', 'names', 'thr']
+
+
+def parse_annotation(filename, defaultIOUthr=0.5, pixelTolerance=10):
+    """
+    parse one ImageNet VID/DET XML file
+    :param filename: xml file path
+    :return: height, width, boxes [n, 4], names [n], thr [n]
+    """
+    import xml.etree.ElementTree as ET
+    tree = ET.parse(filename)
+    size = tree.find('size')
+    height = float(size.find('height').text)
+    width = float(size.find('width').text)
+
+    boxes = []
+    names = []
+    for obj in tree.findall('object'):
+        bbox = obj.find('bndbox')
+        boxes.append([float(bbox.find('xmin').text),
+                      float(bbox.find('ymin').text),
+                      float(bbox.find('xmax').text),
+                      float(bbox.find('ymax').text)])
+        names.append(obj.find('name').text)
+    boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+
+    gt_w = boxes[:, 2] - boxes[:, 0] + 1
+    gt_h = boxes[:, 3] - boxes[:, 1] + 1
+    thr = np.minimum((gt_w * gt_h) / ((gt_w + pixelTolerance) * (gt_h + pixelTolerance)), defaultIOUthr)
+    return height, width, boxes, names, thr
+
+
+def gather_rows(columns, rows):
+    """
+    select images (and their objects) from a set of columns
+    :param rows: image rows to take, in the order wanted
+    :return: columns of the selected images
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = columns['obj_offsets'][rows]
+    counts = columns['obj_offsets'][rows + 1] - starts
+    obj_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=obj_offsets[1:])
+    # position of every selected object in the source columns
+    objs = np.arange(obj_offsets[-1], dtype=np.int64) + np.repeat(starts - obj_offsets[:-1], counts)
+    return {'index': columns['index'][rows],
+            'height': columns['height'][rows],
+            'width': columns['width'][rows],
+            'obj_offsets': obj_offsets,
+            'boxes': columns['boxes'][objs].reshape(-1, 4),
+            'names': columns['names'][objs],
+            'thr': columns['thr'][objs]}
+
+
+def name_labels(names, classhash):
+    """
+    :param names: wnid of every object
+    :param classhash: wnid -> class index
+    :return: class index of every object, -1 for wnids not in classhash
+    """
+    uniq, inv = np.unique(names, return_inverse=True)
+    return np.array([classhash.get(name, -1) for name in uniq.tolist()] + [-1], dtype=np.int64)[inv]
+
+
+class AnnotationStore(object):
+    def __init__(self, cache_dir, annotation_root):
+        """
+        :param cache_dir: directory of the columns, shared by all image sets of a dataset
+        :param annotation_root: directory the annotation keys are relative to, <dataset_path>/Annotations
+        """
+        self.cache_dir = cache_dir
+        self.annotation_root = annotation_root
+        self.columns = None
+        self.rows = None
+
+    def _load(self):
+        if self.columns is None and os.path.isdir(self.cache_dir):
+            self.columns = dict([(name, np.load(os.path.join(self.cache_dir, name + '.npy'), mmap_mode='r'))
+                                 for name in COLUMNS])
+            self.rows = dict(zip(self.columns['index'].tolist(), range(len(self.columns['index']))))
+
+    def _parse(self, keys, processes=None):
+        filenames = [os.path.join(self.annotation_root, key + '.xml') for key in keys]
+        pool = mp.Pool(processes=processes)
+        try:
+            annos = pool.map(parse_annotation, filenames, chunksize=max(len(filenames) // (8 * len(pool._pool)), 1))
+        finally:
+            pool.close()
+            pool.join()
+
+        obj_offsets = np.zeros(len(annos) + 1, dtype=np.int64)
+        np.cumsum([len(anno[3]) for anno in annos], out=obj_offsets[1:])
+        names = [name for anno in annos for name in anno[3]]
+        return {'index': np.array(keys, dtype=np.str_),
+                'height': np.array([anno[0] for anno in annos], dtype=np.float32),
+                'width': np.array([anno[1] for anno in annos], dtype=np.float32),
+                'obj_offsets': obj_offsets,
+                'boxes': np.concatenate([anno[2] for anno in annos] + [np.zeros((0, 4))]),
+                'names': np.array(names, dtype=np.str_) if names else np.zeros(0, dtype='S1'),
+                'thr': np.concatenate([anno[4] for anno in annos] + [np.zeros(0)])}
+
+    def _save(self, columns):
+        # written to a temporary directory first so that an interrupted run never leaves a partial store
+        tmp_dir = '{}.tmp{}'.format(self.cache_dir, os.getpid())
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+        for name in COLUMNS:
+            np.save(os.path.join(tmp_dir, name + '.npy'), columns[name])
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        os.rename(tmp_dir, self.cache_dir)
+        self.columns = None
+        self._load()
+
+    def add(self, keys, processes=None):
+        """
+        parse the annotation files not in the store yet and add them
+        :param keys: annotation keys
+        :param processes: number of parsing processes, cpu count by default
+        """
+        self._load()
+        missing = sorted(set(keys) if self.rows is None else set(keys).difference(self.rows))
+        if len(missing) == 0:
+            return
+        tic = time.time()
+        parsed = self._parse(missing, processes)
+        if self.columns is not None:
+            old = gather_rows(self.columns, np.arange(len(self.columns['index'])))
+            width = max(old['names'].dtype.itemsize, parsed['names'].dtype.itemsize)
+            parsed = {'index': np.concatenate([old['index'], parsed['index']]),
+                      'height': np.concatenate([old['height'], parsed['height']]),
+                      'width': np.concatenate([old['width'], parsed['width']]),
+                      'obj_offsets': np.concatenate([old['obj_offsets'], parsed['obj_offsets'][1:] + old['obj_offsets'][-1]]),
+                      'boxes': np.concatenate([old['boxes'], parsed['boxes']]),
+                      'names': np.concatenate([old['names'].astype('S{}'.format(width)),
+                                               parsed['names'].astype('S{}'.format(width))]),
+                      'thr': np.concatenate([old['thr'], parsed['thr']])}
+        self._save(parsed)
+        print 'parsed {} annotations in {:.1f}s, {} in {}'.format(len(missing), time.time() - tic,
+                                                                 len(self.rows), self.cache_dir)
+
+    def lookup(self, keys, processes=None):
+        """
+        :param keys: annotation keys, parsed first if they are not in the store yet
+        :return: columns of keys in the given order
+        """
+        self.add(keys, processes)
+        return gather_rows(self.columns, [self.rows[key] for key in keys])
+
+    def vid_recs(self, keys, classhash, img_ids):
+        """
+        records in the format of the ImageNet VID evaluation
+        :param keys: annotation keys of the evaluated frames
+        :param classhash: wnid -> class index
+        :param img_ids: image id of every frame
+        :return: list of dict['bbox', 'label', 'thr', 'img_ids']
+        """
+        columns = self.lookup(keys)
+        labels = name_labels(columns['names'], classhash)
+        assert (labels >= 0).all(), 'unknown class in {}'.format(self.cache_dir)
+        boxes = np.array(columns['boxes'])
+        thr = np.array(columns['thr'])
+        offsets = columns['obj_offsets'].tolist()
+        return [{'bbox': boxes[offsets[i]:offsets[i + 1]],
+                 'label': labels[offsets[i]:offsets[i + 1]],
+                 'thr': thr[offsets[i]:offsets[i + 1]],
+                 'img_ids': img_ids[i]} for i in range(len(keys))]
@@ -13,16 +13,17 @@ function. Results are written as the ImageNet VID format. Evaluation is based on
 criterion.
 """
 
-import cPickle
 import cv2
 import os
 import numpy as np
 import time
 from imdb import IMDB
+from annotation_store import AnnotationStore, name_labels
+from vid_results import detections_to_records, write_results
 from imagenet_vid_eval import vid_eval
-from imagenet_vid_eval_motion import vid_eval_motion
+from imagenet_vid_eval_motion import vid_eval_motion, load_motion_iou, VIDMotionEvaluator
 from ds_utils import unique_boxes, filter_small_boxes
-from nms.seq_nms import seq_nms
+from nms.seq_nms import seq_nms_multiprocess
 from nms.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper
 
 
@@ -98,23 +99,93 @@ class ImageNetVID(IMDB):
         # assert os.path.exists(image_file), 'Path does not exist: {}'.format(image_file)
         return image_file
 
+    def annotation_key_from_index(self, index):
+        """
+        given image index, find out its key in the annotation store
+        :param index: index of a specific image
+        :return: path of its XML file relative to Annotations, without extension
+        """
+        return self.det_vid + '/' + index
+
+    @property
+    def annotation_store(self):
+        """
+        parsed annotations shared by all image sets (and the evaluation) under cache_path
+        :return: AnnotationStore
+        """
+        if not hasattr(self, '_annotation_store'):
+            self._annotation_store = AnnotationStore(os.path.join(self.cache_path, 'ImageNetVID_annotations'),
+                                                     os.path.join(self.data_path, 'Annotations'))
+        return self._annotation_store
+
     def gt_roidb(self):
         """
         return ground truth image regions database
+        the XML files are parsed in parallel into the shared annotation store on the first run
         :return: imdb[image_index]['boxes', 'gt_classes', 'gt_overlaps', 'flipped']
         """
-        cache_file = os.path.join(self.cache_path, self.name + '_gt_roidb.pkl')
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = cPickle.load(fid)
-            print '{} gt roidb loaded from {}'.format(self.name, cache_file)
-            return roidb
+        tic = time.time()
+        annos = self.annotation_store.lookup([self.annotation_key_from_index(index) for index in self.image_set_index])
+        gt_roidb = self.roidb_from_annotations(annos)
+        print '{} gt roidb loaded from {} in {:.1f}s'.format(self.name, self.annotation_store.cache_dir, time.time() - tic)
+        return gt_roidb
 
-        gt_roidb = [self.load_vid_annotation(index) for index in range(0, len(self.image_set_index))]
-        with open(cache_file, 'wb') as fid:
-            cPickle.dump(gt_roidb, fid, cPickle.HIGHEST_PROTOCOL)
-        print 'wrote gt roidb to {}'.format(cache_file)
+    def roidb_from_annotations(self, annos, iindices=None):
+        """
+        build per-image records from annotation store columns, objects of unknown classes are skipped
+        the arrays of a record are views into arrays shared by all records
+        :param annos: columns returned by AnnotationStore.lookup
+        :param iindices: positions in image_set_index the columns describe, all images by default
+        :return: imdb[image_index]['boxes', 'gt_classes', 'gt_overlaps', 'flipped']
+        """
+        class_to_index = dict(zip(self.classes_map, range(self.num_classes)))
+        num_images = len(annos['height'])
+        num_objs = np.diff(annos['obj_offsets'])
+        obj_images = np.repeat(np.arange(num_images), num_objs)
+        gt_classes = name_labels(annos['names'], class_to_index).astype(np.int32)
+        valid_objs = gt_classes >= 0
+        gt_classes = gt_classes[valid_objs]
+        obj_images = obj_images[valid_objs]
+        offsets = np.zeros(num_images + 1, dtype=np.int64)
+        np.cumsum(np.bincount(obj_images, minlength=num_images), out=offsets[1:])
+
+        # Make pixel indexes 0-based
+        boxes = annos['boxes'][valid_objs]
+        boxes[:, :2] = np.maximum(boxes[:, :2], 0)
+        boxes[:, 2] = np.minimum(boxes[:, 2], annos['width'][obj_images].astype(np.float64) - 1)
+        boxes[:, 3] = np.minimum(boxes[:, 3], annos['height'][obj_images].astype(np.float64) - 1)
+        boxes = boxes.astype(np.uint16)
+        assert (boxes[:, 2] >= boxes[:, 0]).all()
 
+        overlaps = np.zeros((len(gt_classes), self.num_classes), dtype=np.float32)
+        overlaps[np.arange(len(gt_classes)), gt_classes] = 1.0
+        max_classes = overlaps.argmax(axis=1)
+        max_overlaps = overlaps.max(axis=1)
+        heights = annos['height'].tolist()
+        widths = annos['width'].tolist()
+        offsets = offsets.tolist()
+        has_pattern = hasattr(self, 'frame_seg_id')
+        if iindices is None:
+            iindices = range(len(self.image_set_index))
+
+        gt_roidb = []
+        for i, iindex in enumerate(iindices):
+            s, e = offsets[i], offsets[i + 1]
+            roi_rec = {'image': self.image_path_from_index(self.image_set_index[iindex]),
+                       'frame_id': self.frame_id[iindex],
+                       'height': heights[i],
+                       'width': widths[i],
+                       'boxes': boxes[s:e],
+                       'gt_classes': gt_classes[s:e],
+                       'gt_overlaps': overlaps[s:e],
+                       'max_classes': max_classes[s:e],
+                       'max_overlaps': max_overlaps[s:e],
+                       'flipped': False}
+            if has_pattern:
+                roi_rec['pattern'] = self.image_path_from_index(self.pattern[iindex])
+                roi_rec['frame_seg_id'] = self.frame_seg_id[iindex]
+                roi_rec['frame_seg_len'] = self.frame_seg_len[iindex]
+            gt_roidb.append(roi_rec)
         return gt_roidb
 
     def load_vid_annotation(self, iindex):
@@ -123,67 +194,8 @@ class ImageNetVID(IMDB):
         :param index: index of a specific image
         :return: record['boxes', 'gt_classes', 'gt_overlaps', 'flipped']
         """
-        index = self.image_set_index[iindex]
-
-        import xml.etree.ElementTree as ET
-        roi_rec = dict()
-        roi_rec['image'] = self.image_path_from_index(index)
-        roi_rec['frame_id'] = self.frame_id[iindex]
-        if hasattr(self,'frame_seg_id'):
-            roi_rec['pattern'] = self.image_path_from_index(self.pattern[iindex])
-            roi_rec['frame_seg_id'] = self.frame_seg_id[iindex]
-            roi_rec['frame_seg_len'] = self.frame_seg_len[iindex]
-
-        if self.det_vid == 'DET':
-            filename = os.path.join(self.data_path, 'Annotations', 'DET', index + '.xml')
-        else:
-            filename = os.path.join(self.data_path, 'Annotations', 'VID', index + '.xml')
-
-        tree = ET.parse(filename)
-        size = tree.find('size')
-        roi_rec['height'] = float(size.find('height').text)
-        roi_rec['width'] = float(size.find('width').text)
-        #im_size = cv2.imread(roi_rec['image'], cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION).shape
-        #assert im_size[0] == roi_rec['height'] and im_size[1] == roi_rec['width']
-
-        objs = tree.findall('object')
-        num_objs = len(objs)
-
-        boxes = np.zeros((num_objs, 4), dtype=np.uint16)
-        gt_classes = np.zeros((num_objs), dtype=np.int32)
-        overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
-        valid_objs = np.zeros((num_objs), dtype=np.bool)
-
-        class_to_index = dict(zip(self.classes_map, range(self.num_classes)))
-        # Load object bounding boxes into a data frame.
-        for ix, obj in enumerate(objs):
-            bbox = obj.find('bndbox')
-            # Make pixel indexes 0-based
-            x1 = np.maximum(float(bbox.find('xmin').text), 0)
-            y1 = np.maximum(float(bbox.find('ymin').text), 0)
-            x2 = np.minimum(float(bbox.find('xmax').text), roi_rec['width']-1)
-            y2 = np.minimum(float(bbox.find('ymax').text), roi_rec['height']-1)
-            if not class_to_index.has_key(obj.find('name').text):
-                continue
-            valid_objs[ix] = True
-            cls = class_to_index[obj.find('name').text.lower().strip()]
-            boxes[ix, :] = [x1, y1, x2, y2]
-            gt_classes[ix] = cls
-            overlaps[ix, cls] = 1.0
-
-        boxes = boxes[valid_objs, :]
-        gt_classes = gt_classes[valid_objs]
-        overlaps = overlaps[valid_objs, :]
-
-        assert (boxes[:, 2] >= boxes[:, 0]).all()
-
-        roi_rec.update({'boxes': boxes,
-                        'gt_classes': gt_classes,
-                        'gt_overlaps': overlaps,
-                        'max_classes': overlaps.argmax(axis=1),
-                        'max_overlaps': overlaps.max(axis=1),
-                        'flipped': False})
-        return roi_rec
+        annos = self.annotation_store.lookup([self.annotation_key_from_index(self.image_set_index[iindex])])
+        return self.roidb_from_annotations(annos, [iindex])[0]
 
 ###################################################################################################
     def evaluate_detections(self, detections):
@@ -201,21 +213,6 @@ class ImageNetVID(IMDB):
         info = self.do_python_eval()
         return info
 
-    def evaluate_detections_multiprocess_seqnms(self, detections, gpu_id):
-        """
-        top level evaluations
-        :param detections: result matrix, [bbox, confidence]
-        :return: None
-        """
-        # make all these folders for results
-
-        result_dir = os.path.join(self.result_path, 'results')
-        if not os.path.exists(result_dir):
-            os.mkdir(result_dir)
-
-        self.write_vid_results_multiprocess(detections, gpu_id)
-        return 1
-
     def evaluate_detections_multiprocess(self, detections):
         """
         top level evaluations
@@ -231,145 +228,78 @@ class ImageNetVID(IMDB):
         info = self.do_python_eval_gen()
         return info
 
-    def get_result_file_template(self, gpu_id):
-        """
-        :return: a string template
-        """
-        res_file_folder = os.path.join(self.result_path, 'results')
-        filename = 'det_' + self.image_set + str(gpu_id) + '_{:s}.txt'
-        path = os.path.join(res_file_folder, filename)
-        return path
-
     def get_result_file_template(self):
         """
         :return: a string template
         """
         res_file_folder = os.path.join(self.result_path, 'results')
-        filename = 'det_' + self.image_set + '_{:s}.txt'
+        filename = 'det_' + self.image_set + '_{:s}.npy'
         path = os.path.join(res_file_folder, filename)
         return path
 
-    def write_vid_results_multiprocess(self, detection, gpu_id):
+    def seq_nms_multiprocess(self, detections, processes=None, pool=None):
         """
-        write results files in pascal devkit path
-        :param all_boxes: boxes to be processed [bbox, confidence]
+        rescore raw detections with Seq-NMS, (video, class) units are spread over a process pool
+        :param detections: list of (all_boxes, frame_ids) raw detections, all_boxes are updated in place
+        :param processes: pool size, all cores by default
+        :param pool: Pool to run on instead, see nms.seq_nms.seq_nms_multiprocess
         :return: None
         """
+        t = time.time()
+        sum_frame_ids = np.cumsum(self.frame_seg_len)
+        units = []
+        unit_index = []
+        for det_ind, (all_boxes, frame_ids) in enumerate(detections):
+            if len(frame_ids) == 0:
+                continue
+            video_index = np.searchsorted(sum_frame_ids, frame_ids)
+            bounds = np.concatenate(([0], np.where(np.diff(video_index) != 0)[0] + 1, [len(frame_ids)]))
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                for j in range(1, self.num_classes):
+                    units.append(all_boxes[j][start:end])
+                    unit_index.append((det_ind, j, start))
+
+        dets_units = seq_nms_multiprocess(units, processes, pool)
 
-        print 'Writing {} ImageNetVID results file'.format('all')
-        filename = self.get_result_file_template(gpu_id).format('all')
-        frame_seg_len = self.frame_seg_len
         nms = py_nms_wrapper(0.3)
-        data_time = 0
-        all_boxes = detection[0]
-        frame_ids = detection[1]
-        start_idx = 0
-        sum_frame_ids = np.cumsum(frame_seg_len)
-        first_true_id = frame_ids[0]
-        start_video = np.searchsorted(sum_frame_ids, first_true_id)
-
-        for im_ind in range(1, len(frame_ids)):
-            t = time.time()
-            true_id = frame_ids[im_ind]
-            video_index = np.searchsorted(sum_frame_ids, true_id)
-            if (video_index != start_video):  # reprensents a new video
-                t1 = time.time()
-                video = [all_boxes[j][start_idx:im_ind] for j in range(1, self.num_classes)]
-                dets_all = seq_nms(video)
-                for j in xrange(1, self.num_classes):
-                    for frame_ind, dets in enumerate(dets_all[j - 1]):
-                        keep = nms(dets)
-                        all_boxes[j][frame_ind + start_idx] = dets[keep, :]
-                start_idx = im_ind
-                start_video = video_index
-                t2 = time.time()
-                print 'video_index=', video_index, '  time=', t2 - t1
-            data_time += time.time() - t
-            if (im_ind % 100 == 0):
-                print '{} seq_nms testing {} data {:.4f}s'.format(frame_ids[im_ind - 1], im_ind, data_time / im_ind)
-
-        # the last video
-        video = [all_boxes[j][start_idx:im_ind] for j in range(1, self.num_classes)]
-        dets_all = seq_nms(video)
-        for j in xrange(1, self.num_classes):
-            for frame_ind, dets in enumerate(dets_all[j - 1]):
+        for (det_ind, j, start), dets_cls in zip(unit_index, dets_units):
+            all_boxes = detections[det_ind][0]
+            for frame_ind, dets in enumerate(dets_cls):
                 keep = nms(dets)
-                all_boxes[j][frame_ind + start_idx] = dets[keep, :]
-
-        with open(filename, 'wt') as f:
-            for im_ind in range(len(frame_ids)):
-                for cls_ind, cls in enumerate(self.classes):
-                    if cls == '__background__':
-                        continue
-                    dets = all_boxes[cls_ind][im_ind]
-                    if len(dets) == 0:
-                        continue
-                    # the imagenet expects 0-based indices
-                    for k in range(dets.shape[0]):
-                        f.write('{:d} {:d} {:.4f} {:.2f} {:.2f} {:.2f} {:.2f}\n'.
-                                format(frame_ids[im_ind], cls_ind, dets[k, -1],
-                                       dets[k, 0], dets[k, 1], dets[k, 2], dets[k, 3]))
-        return
+                all_boxes[j][start + frame_ind] = dets[keep, :]
+        print 'seq_nms {} units time={:.4f}s'.format(len(units), time.time() - t)
 
     def write_vid_results(self, all_boxes):
         """
-        write results files in pascal devkit path
+        write results file, see vid_results
         :param all_boxes: boxes to be processed [bbox, confidence]
         :return: None
         """
         print 'Writing {} ImageNetVID results file'.format('all')
         filename = self.get_result_file_template().format('all')
-        with open(filename, 'wt') as f:
-            for im_ind, index in enumerate(self.image_set_index):
-                for cls_ind, cls in enumerate(self.classes):
-                    if cls == '__background__':
-                        continue
-                    dets = all_boxes[cls_ind][im_ind]
-                    if len(dets) == 0:
-                        continue
-                    # the imagenet expects 0-based indices
-                    for k in range(dets.shape[0]):
-                        f.write('{:d} {:d} {:.4f} {:.2f} {:.2f} {:.2f} {:.2f}\n'.
-                                format(self.frame_id[im_ind], cls_ind, dets[k, -1],
-                                       dets[k, 0], dets[k, 1], dets[k, 2], dets[k, 3]))
+        write_results(filename, detections_to_records(all_boxes, self.frame_id, self.num_classes))
 
     def write_vid_results_multiprocess(self, detections):
         """
-        write results files in pascal devkit path
-        :param all_boxes: boxes to be processed [bbox, confidence]
+        write results file, see vid_results
+        :param detections: list of (all_boxes, frame_ids)
         :return: None
         """
         print 'Writing {} ImageNetVID results file'.format('all')
         filename = self.get_result_file_template().format('all')
-        with open(filename, 'wt') as f:
-            for detection in detections:
-                all_boxes = detection[0]
-                frame_ids = detection[1]
-                for im_ind in range(len(frame_ids)):
-                    for cls_ind, cls in enumerate(self.classes):
-                        if cls == '__background__':
-                            continue
-                        dets = all_boxes[cls_ind][im_ind]
-                        if len(dets) == 0:
-                            continue
-                        # the imagenet expects 0-based indices
-                        for k in range(dets.shape[0]):
-                            f.write('{:d} {:d} {:.4f} {:.2f} {:.2f} {:.2f} {:.2f}\n'.
-                                    format(frame_ids[im_ind], cls_ind, dets[k, -1],
-                                           dets[k, 0], dets[k, 1], dets[k, 2], dets[k, 3]))
-    
+        write_results(filename, np.concatenate([detections_to_records(all_boxes, frame_ids, self.num_classes)
+                                                for all_boxes, frame_ids in detections]))
+
     def do_python_eval(self):
         """
         python evaluation wrapper
         :return: info_str
         """
         info_str = ''
-        annopath = os.path.join(self.data_path, 'Annotations', '{0!s}.xml')
         imageset_file = os.path.join(self.data_path, 'ImageSets', self.image_set + '.txt')
-        annocache = os.path.join(self.cache_path, self.name + '_annotations.pkl')
 
         filename = self.get_result_file_template().format('all')
-        ap = vid_eval(filename, annopath, imageset_file, self.classes_map, annocache, ovthresh=0.5)
+        ap = vid_eval(filename, imageset_file, self.classes_map, self.annotation_store, ovthresh=0.5)
         for cls_ind, cls in enumerate(self.classes):
             if cls == '__background__':
                 continue
@@ -379,31 +309,10 @@ class ImageNetVID(IMDB):
         info_str += 'Mean AP@0.5 = {:.4f}\n\n'.format(np.mean(ap))
         return info_str
 
-    def do_python_eval_gen(self, gpu_number=None):
+    def eval_ranges(self):
         """
-        python evaluation wrapper
-        :return: info_str
+        :return: motion_ranges, area_ranges of the evaluation
         """
-        info_str = ''
-        annopath = os.path.join(self.data_path, 'Annotations', '{0!s}.xml')
-        imageset_file = os.path.join(self.data_path, 'ImageSets', self.image_set + '_eval.txt')
-        annocache = os.path.join(self.cache_path, self.name + '_annotations.pkl')
-
-        with open(imageset_file, 'w') as f:
-            for i in range(len(self.pattern)):
-                for j in range(self.frame_seg_len[i]):
-                    f.write((self.pattern[i] % (self.frame_seg_id[i] + j)) + ' ' + str(self.frame_id[i] + j) + '\n')
-                    
-        if gpu_number != None:
-            filenames = []
-            for i in range(gpu_number):
-                filename = self.get_result_file_template(i).format('all')
-                filenames.append(filename)
-            multifiles = True  # contains multi cache results of all boxes
-        else:
-            filenames = self.get_result_file_template().format('all')
-            multifiles = False
-
         if self.enable_detailed_eval:
             # init motion areas and area ranges
             motion_ranges = [[0.0, 1.0], [0.0, 0.7], [0.7, 0.9], [0.9, 1.0]]
@@ -412,10 +321,61 @@ class ImageNetVID(IMDB):
         else:
             motion_ranges = [[0.0, 1.0]]
             area_ranges = [[0, 1e5 * 1e5]]
+        return motion_ranges, area_ranges
 
-        ap = vid_eval_motion(multifiles, filenames, annopath, imageset_file, self.classes_map, annocache, self.motion_iou_path,
-                             motion_ranges, area_ranges, ovthresh=0.5)
+    def vid_evaluator(self):
+        """
+        evaluator of all frames of the video image set, fed video by video while testing
+        :return: VIDMotionEvaluator
+        """
+        keys, img_ids = [], []
+        for i in range(len(self.pattern)):
+            for j in range(self.frame_seg_len[i]):
+                keys.append('VID/' + self.pattern[i] % (self.frame_seg_id[i] + j))
+                img_ids.append(self.frame_id[i] + j)
+        classhash = dict(zip(self.classes_map, range(self.num_classes)))
+        recs = self.annotation_store.vid_recs(keys, classhash, img_ids)
+        motion_ranges, area_ranges = self.eval_ranges()
+        return VIDMotionEvaluator(recs, load_motion_iou(self.motion_iou_path, self.cache_path), self.classes_map,
+                                  motion_ranges, area_ranges)
+
+    def evaluate_detections_online(self, evaluator, detections):
+        """
+        write the results file and report the ap of an evaluator that has seen all detections
+        :param evaluator: VIDMotionEvaluator
+        :param detections: list of (all_boxes, frame_ids)
+        :return: info_str
+        """
+        result_dir = os.path.join(self.result_path, 'results')
+        if not os.path.exists(result_dir):
+            os.mkdir(result_dir)
+        self.write_vid_results_multiprocess(detections)
+        return self.format_motion_ap(evaluator.ap(), evaluator.motion_ranges, evaluator.area_ranges)
+
+    def do_python_eval_gen(self):
+        """
+        python evaluation wrapper
+        :return: info_str
+        """
+        imageset_file = os.path.join(self.data_path, 'ImageSets', self.image_set + '_eval.txt')
 
+        with open(imageset_file, 'w') as f:
+            for i in range(len(self.pattern)):
+                for j in range(self.frame_seg_len[i]):
+                    f.write((self.pattern[i] % (self.frame_seg_id[i] + j)) + ' ' + str(self.frame_id[i] + j) + '\n')
+
+        filename = self.get_result_file_template().format('all')
+        motion_ranges, area_ranges = self.eval_ranges()
+        ap = vid_eval_motion(filename, imageset_file, self.classes_map, self.annotation_store,
+                             self.motion_iou_path, motion_ranges, area_ranges, ovthresh=0.5, cache_dir=self.cache_path)
+        return self.format_motion_ap(ap, motion_ranges, area_ranges)
+
+    def format_motion_ap(self, ap, motion_ranges, area_ranges):
+        """
+        print the mean ap of every motion / area range
+        :return: info_str
+        """
+        info_str = ''
         for motion_index, motion_range in enumerate(motion_ranges):
             for area_index, area_range in enumerate(area_ranges):
                 print '================================================='
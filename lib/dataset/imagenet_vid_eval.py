@@ -10,36 +10,7 @@ given a imagenet vid imdb, compute mAP
 """
 
 import numpy as np
-import os
-import cPickle
-
-
-def parse_vid_rec(filename, classhash, img_ids, defaultIOUthr=0.5, pixelTolerance=10):
-    """
-    parse imagenet vid record into a dictionary
-    :param filename: xml file path
-    :return: list of dict
-    """
-    import xml.etree.ElementTree as ET
-    tree = ET.parse(filename)
-    objects = []
-    for obj in tree.findall('object'):
-        obj_dict = dict()
-        obj_dict['label'] = classhash[obj.find('name').text]
-        bbox = obj.find('bndbox')
-        obj_dict['bbox'] = [float(bbox.find('xmin').text),
-                            float(bbox.find('ymin').text),
-                            float(bbox.find('xmax').text),
-                            float(bbox.find('ymax').text)]
-        gt_w = obj_dict['bbox'][2] - obj_dict['bbox'][0] + 1
-        gt_h = obj_dict['bbox'][3] - obj_dict['bbox'][1] + 1
-        thr = (gt_w*gt_h)/((gt_w+pixelTolerance)*(gt_h+pixelTolerance))
-        obj_dict['thr'] = np.min([thr, defaultIOUthr])
-        objects.append(obj_dict)
-    return {'bbox' : np.array([x['bbox'] for x in objects]),
-             'label': np.array([x['label'] for x in objects]),
-             'thr'  : np.array([x['thr'] for x in objects]),
-             'img_ids': img_ids}
+from vid_results import read_results, group_by_frame
 
 
 def vid_ap(rec, prec):
@@ -67,13 +38,12 @@ def vid_ap(rec, prec):
     return ap
 
 
-def vid_eval(multifiles, detpath, annopath, imageset_file, classname_map, annocache, ovthresh=0.5):
+def vid_eval(detpath, imageset_file, classname_map, annotations, ovthresh=0.5):
     """
     imagenet vid evaluation
-    :param detpath: detection results detpath.format(classname)
-    :param annopath: annotations annopath.format(classname)
+    :param detpath: detection result file(s), see vid_results
     :param imageset_file: text file containing list of images
-    :param annocache: caching annotations
+    :param annotations: AnnotationStore holding the annotations of the image set
     :param ovthresh: overlap threshold
     :return: rec, prec, ap
     """
@@ -83,19 +53,7 @@ def vid_eval(multifiles, detpath, annopath, imageset_file, classname_map, annoca
     gt_img_ids = [int(x[1]) for x in lines]
     classhash = dict(zip(classname_map, range(0,len(classname_map))))
 
-    # load annotations from cache
-    if not os.path.isfile(annocache):
-        recs = []
-        for ind, image_filename in enumerate(img_basenames):
-            recs.append(parse_vid_rec(annopath.format('VID/' + image_filename), classhash, gt_img_ids[ind]))
-            if ind % 100 == 0:
-                print 'reading annotations for {:d}/{:d}'.format(ind + 1, len(img_basenames))
-        print 'saving annotations cache to {:s}'.format(annocache)
-        with open(annocache, 'wb') as f:
-            cPickle.dump(recs, f, protocol=cPickle.HIGHEST_PROTOCOL)
-    else:
-        with open(annocache, 'rb') as f:
-            recs = cPickle.load(f)
+    recs = annotations.vid_recs(['VID/' + x for x in img_basenames], classhash, gt_img_ids)
 
     # extract objects in :param classname:
     npos = np.zeros(len(classname_map))
@@ -105,49 +63,9 @@ def vid_eval(multifiles, detpath, annopath, imageset_file, classname_map, annoca
             npos[x] += 1
 
     # read detections
-    splitlines = []
-    if (multifiles == False):
-        with open(detpath, 'r') as f:
-            lines = f.readlines()
-        splitlines = [x.strip().split(' ') for x in lines]
-    else:
-        for det in detpath:
-            with open(det, 'r') as f:
-                lines = f.readlines()
-            splitlines += [x.strip().split(' ') for x in lines]
-
-    img_ids = np.array([int(x[0]) for x in splitlines])
-    obj_labels = np.array([int(x[1]) for x in splitlines])
-    obj_confs = np.array([float(x[2]) for x in splitlines])
-    obj_bboxes = np.array([[float(z) for z in x[3:]] for x in splitlines])
-
-    # sort by confidence
-    if obj_bboxes.shape[0] > 0:
-        sorted_inds = np.argsort(img_ids)
-        img_ids = img_ids[sorted_inds]
-        obj_labels = obj_labels[sorted_inds]
-        obj_confs = obj_confs[sorted_inds]
-        obj_bboxes = obj_bboxes[sorted_inds, :]
-
-    num_imgs = max(max(gt_img_ids),max(img_ids)) + 1
-    obj_labels_cell = [None] * num_imgs
-    obj_confs_cell = [None] * num_imgs
-    obj_bboxes_cell = [None] * num_imgs
-    start_i = 0
-    id = img_ids[0]
-    for i in range(0, len(img_ids)):
-        if i == len(img_ids)-1 or img_ids[i+1] != id:
-            conf = obj_confs[start_i:i+1]
-            label = obj_labels[start_i:i+1]
-            bbox = obj_bboxes[start_i:i+1, :]
-            sorted_inds = np.argsort(-conf)
-
-            obj_labels_cell[id] = label[sorted_inds]
-            obj_confs_cell[id] = conf[sorted_inds]
-            obj_bboxes_cell[id] = bbox[sorted_inds, :]
-            if i < len(img_ids)-1:
-                id = img_ids[i+1]
-                start_i = i+1
+    records = read_results(detpath)
+    num_imgs = max(max(gt_img_ids), np.max(records['frame_id']) if len(records) else 0) + 1
+    obj_labels_cell, obj_confs_cell, obj_bboxes_cell = group_by_frame(records, num_imgs)
 
 
     # go down detections and mark true positives and false positives
@@ -11,37 +11,9 @@ given a imagenet vid imdb, compute mAP
 
 import numpy as np
 import os
-import cPickle
+import threading
+from vid_results import read_results, group_by_frame
 import scipy.io as sio
-import copy
-
-
-def parse_vid_rec(filename, classhash, img_ids, defaultIOUthr=0.5, pixelTolerance=10):
-    """
-    parse imagenet vid record into a dictionary
-    :param filename: xml file path
-    :return: list of dict
-    """
-    import xml.etree.ElementTree as ET
-    tree = ET.parse(filename)
-    objects = []
-    for obj in tree.findall('object'):
-        obj_dict = dict()
-        obj_dict['label'] = classhash[obj.find('name').text]
-        bbox = obj.find('bndbox')
-        obj_dict['bbox'] = [float(bbox.find('xmin').text),
-                            float(bbox.find('ymin').text),
-                            float(bbox.find('xmax').text),
-                            float(bbox.find('ymax').text)]
-        gt_w = obj_dict['bbox'][2] - obj_dict['bbox'][0] + 1
-        gt_h = obj_dict['bbox'][3] - obj_dict['bbox'][1] + 1
-        thr = (gt_w*gt_h)/((gt_w+pixelTolerance)*(gt_h+pixelTolerance))
-        obj_dict['thr'] = np.min([thr, defaultIOUthr])
-        objects.append(obj_dict)
-    return {'bbox' : np.array([x['bbox'] for x in objects]),
-             'label': np.array([x['label'] for x in objects]),
-             'thr'  : np.array([x['thr'] for x in objects]),
-             'img_ids': img_ids}
 
 
 def vid_ap(rec, prec):
@@ -58,8 +30,7 @@ def vid_ap(rec, prec):
     mpre = np.concatenate(([0.], prec, [0.]))
 
     # compute precision integration ladder
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # look for recall value changes
     i = np.where(mrec[1:] != mrec[:-1])[0]
@@ -69,15 +40,265 @@ def vid_ap(rec, prec):
     return ap
 
 
-def vid_eval_motion(multifiles, detpath, annopath, imageset_file, classname_map, annocache, motion_iou_file, motion_ranges, area_ranges, ovthresh=0.5):
+# flattened motion iou tables by (path, modification time), loaded once per process
+_motion_iou_memo = {}
+
+
+class MotionIoU(object):
+    def __init__(self, values, offsets):
+        """
+        :param values: motion iou of every gt object, objects of frame i are values[offsets[i]:offsets[i + 1]]
+        :param offsets: [num_frames + 1], frames in the order of the evaluated image set
+        """
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def per_object(self, num_gt_objs):
+        """
+        :param num_gt_objs: number of gt objects of every frame, frames without gt may still have a placeholder value
+        :return: motion iou of the first num_gt_objs[i] objects of every frame i, concatenated
+        """
+        num_gt_objs = np.asarray(num_gt_objs, dtype=np.int64)
+        assert len(num_gt_objs) == len(self), 'motion iou has {} frames, not {}'.format(len(self), len(num_gt_objs))
+        assert (np.diff(self.offsets) >= num_gt_objs).all(), 'missing motion iou of gt objects'
+        gt_offsets = np.concatenate(([0], np.cumsum(num_gt_objs)))
+        inds = np.arange(gt_offsets[-1]) + np.repeat(self.offsets[:-1] - gt_offsets[:-1], num_gt_objs)
+        return np.asarray(self.values[inds], dtype=np.float64)
+
+
+def load_motion_iou(motion_iou_file, cache_dir=None):
+    """
+    read the motion iou of the gt objects of every evaluated frame
+    the MATLAB cell array is converted once and kept as flat .npy files in cache_dir
+    :return: MotionIoU
+    """
+    stat = os.stat(motion_iou_file)
+    key = (os.path.abspath(motion_iou_file), stat.st_mtime)
+    if key in _motion_iou_memo:
+        return _motion_iou_memo[key]
+
+    name = os.path.splitext(os.path.basename(motion_iou_file))[0]
+    cache_files = [os.path.join(cache_dir, name + suffix) for suffix in ('_values.npy', '_offsets.npy')] \
+        if cache_dir else None
+    if cache_files and all([os.path.exists(f) and os.path.getmtime(f) >= stat.st_mtime for f in cache_files]):
+        values, offsets = [np.load(f, mmap_mode='r') for f in cache_files]
+    else:
+        cells = sio.loadmat(motion_iou_file)['motion_iou']
+        frames = [cells[i][0] for i in range(len(cells))]
+        values = np.array([x[0] if len(x) != 0 else 0 for frame in frames for x in frame], dtype=np.float64)
+        offsets = np.concatenate(([0], np.cumsum([len(frame) for frame in frames]))).astype(np.int64)
+        if cache_files:
+            for f, arr in zip(cache_files, (values, offsets)):
+                np.save(f, arr)
+    _motion_iou_memo[key] = MotionIoU(values, offsets)
+    return _motion_iou_memo[key]
+
+
+class VIDMotionEvaluator(object):
+    """
+    ImageNet VID evaluation per motion and area range, fed with the detections of one video (or any set of frames)
+    at a time. Detections are matched once when they are added, ap() can be asked for at any point.
+    """
+    def __init__(self, recs, motion_iou, classname_map, motion_ranges, area_ranges):
+        """
+        :param recs: annotations of the evaluated frames, see AnnotationStore.vid_recs
+        :param motion_iou: MotionIoU of the frames in recs, see load_motion_iou
+        :param motion_ranges: list of [min, max] motion iou
+        :param area_ranges: list of [min, max] gt area
+        """
+        self.num_classes = len(classname_map)
+        self.motion_ranges = motion_ranges
+        self.area_ranges = area_ranges
+        self.rec_index = dict([(rec['img_ids'], index) for index, rec in enumerate(recs)])
+        self.recs = recs
+        self.lock = threading.Lock()
+
+        self.num_gt_objs = np.array([len(rec['label']) for rec in recs], dtype=np.int64)
+        self.gt_offsets = np.concatenate(([0], np.cumsum(self.num_gt_objs)))
+        self.gt_rec = np.repeat(np.arange(len(recs)), self.num_gt_objs)
+        self.gt_labels = np.concatenate([rec['label'] for rec in recs] + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+        gt_bboxes = np.concatenate([rec['bbox'].reshape(-1, 4) for rec in recs] + [np.zeros((0, 4))])
+        gt_areas = (gt_bboxes[:, 3] - gt_bboxes[:, 1] + 1) * (gt_bboxes[:, 2] - gt_bboxes[:, 0] + 1)
+        gt_motion_iou = motion_iou.per_object(self.num_gt_objs)
+        all_motion_iou = np.asarray(motion_iou.values)
+
+        self.ig_gt_motion = [(gt_motion_iou < r[0]) | (gt_motion_iou > r[1]) for r in motion_ranges]
+        self.ig_gt_area = [(gt_areas < r[0]) | (gt_areas > r[1]) for r in area_ranges]
+        self.num_ig_gt = [np.bincount(self.gt_rec[ig], minlength=len(recs)) for ig in self.ig_gt_motion]
+        self.empty_weight = [np.sum((all_motion_iou >= r[0]) & (all_motion_iou <= r[1])) / float(len(all_motion_iou))
+                             for r in motion_ranges]
+
+        self.rec_done = np.zeros(len(recs), dtype=np.bool)
+        # per chunk of added frames: det_rec, labels, confs, [[tp, fp] per area range] per motion range
+        self.chunks = []
+
+    def add(self, frame_ids, labels_cell, confs_cell, bboxes_cell):
+        """
+        add the detections of a set of frames, frames outside recs are ignored
+        :param frame_ids: frame id (img_ids) of every frame
+        :param labels_cell, confs_cell, bboxes_cell: detections of every frame, in descending order of confidence
+        :return: number of sets of frames added so far
+        """
+        det_rec, det_match, det_areas, det_labels, det_confs = [], [], [], [], []
+        # detection / gt pairs with a positive overlap
+        pair_det, pair_gt, pair_ov = [], [], []
+        num_dets = 0
+        done = []
+        for id, labels, confs, bboxes in zip(frame_ids, labels_cell, confs_cell, bboxes_cell):
+            index = self.rec_index.get(id)
+            if index is None:
+                continue
+            done.append(index)
+            if labels is None or len(labels) == 0:
+                continue
+            rec = self.recs[index]
+            num_obj = len(labels)
+            match = -np.ones(num_obj, dtype=np.int64)
+
+            # match detections to gt once: which gt a detection takes does not depend on the motion / area range,
+            # only which matches count and how unmatched detections are weighted does
+            if self.num_gt_objs[index] > 0:
+                ov = overlaps(bboxes, rec['bbox'])
+                cand = (ov >= rec['thr'][None, :]) & (labels[:, None] == rec['label'][None, :])
+                gt_detected = np.zeros(self.num_gt_objs[index], dtype=np.bool)
+                # greedy in order of confidence, each gt is taken by the best overlapping detection left
+                for j in np.flatnonzero(cand.any(axis=1)):
+                    cand_j = cand[j] & ~gt_detected
+                    if cand_j.any():
+                        kmax = np.argmax(np.where(cand_j, ov[j], -1))
+                        gt_detected[kmax] = True
+                        match[j] = self.gt_offsets[index] + kmax
+                dets, gts = np.nonzero(ov > 0)
+                pair_det.append(dets + num_dets)
+                pair_gt.append(gts + self.gt_offsets[index])
+                pair_ov.append(ov[dets, gts])
+
+            det_rec.append(np.full(num_obj, index, dtype=np.int64))
+            det_match.append(match)
+            det_areas.append((bboxes[:, 3] - bboxes[:, 1] + 1) * (bboxes[:, 2] - bboxes[:, 0] + 1))
+            det_labels.append(labels)
+            det_confs.append(confs)
+            num_dets += num_obj
+
+        det_rec = np.concatenate(det_rec + [np.zeros(0, dtype=np.int64)])
+        det_match = np.concatenate(det_match + [np.zeros(0, dtype=np.int64)])
+        det_areas = np.concatenate(det_areas + [np.zeros(0)])
+        pair_det = np.concatenate(pair_det + [np.zeros(0, dtype=np.int64)])
+        pair_gt = np.concatenate(pair_gt + [np.zeros(0, dtype=np.int64)])
+        pair_ov = np.concatenate(pair_ov + [np.zeros(0)])
+        matched = det_match >= 0
+        num_gt_objs = self.num_gt_objs[det_rec]
+
+        tp_fp = []
+        for motion_range_id in range(len(self.motion_ranges)):
+            ig_gt_motion = self.ig_gt_motion[motion_range_id]
+            num_ig_gt = self.num_ig_gt[motion_range_id][det_rec]
+
+            # best overlap of every detection with an ignored / a kept gt, -1 if the image has none of them,
+            # 0 if it has some but none overlapping
+            ovmax_ig = np.where(num_ig_gt > 0, 0., -1.)
+            ovmax_nig = np.where(num_gt_objs - num_ig_gt > 0, 0., -1.)
+            pair_ig = ig_gt_motion[pair_gt]
+            segment_maximum(ovmax_ig, pair_det, np.where(pair_ig, pair_ov, -1.))
+            segment_maximum(ovmax_nig, pair_det, np.where(pair_ig, -1., pair_ov))
+
+            # unmatched detections with equal overlaps are weighted by the share of ignored gt in their image
+            fp_tie = np.where(num_gt_objs == 0, self.empty_weight[motion_range_id],
+                              num_ig_gt / np.maximum(num_gt_objs, 1).astype(np.float64))
+            fp_unmatched = np.where(ovmax_nig > ovmax_ig, 1., np.where(ovmax_ig > ovmax_nig, 0., fp_tie))
+
+            tp_fp_motion = []
+            for area_range_id, area_range in enumerate(self.area_ranges):
+                ig_gt = ig_gt_motion | self.ig_gt_area[area_range_id]
+                ig_det_area = (det_areas < area_range[0]) | (det_areas > area_range[1])
+                tp = np.zeros(num_dets)
+                tp[matched] = ~ig_gt[det_match[matched]]
+                fp = np.where(matched | ig_det_area, 0., fp_unmatched)
+                tp_fp_motion.append((tp, fp))
+            tp_fp.append(tp_fp_motion)
+
+        chunk = (det_rec, np.concatenate(det_labels + [np.zeros(0, dtype=np.int64)]),
+                 np.concatenate(det_confs + [np.zeros(0)]), tp_fp)
+        # the gt of the frames only counts for ap(final=False) together with their detections
+        with self.lock:
+            self.rec_done[done] = True
+            self.chunks.append(chunk)
+            return len(self.chunks)
+
+    def add_records(self, records):
+        """
+        add the detections of all frames in recs
+        :param records: detection results, see vid_results
+        """
+        num_imgs = max(max(self.rec_index), np.max(records['frame_id']) if len(records) else 0) + 1
+        labels_cell, confs_cell, bboxes_cell = group_by_frame(records, num_imgs)
+        frame_ids = [rec['img_ids'] for rec in self.recs]
+        return self.add(frame_ids, [labels_cell[id] for id in frame_ids], [confs_cell[id] for id in frame_ids],
+                        [bboxes_cell[id] for id in frame_ids])
+
+    def add_detections(self, all_boxes, frame_ids, start=0, end=None):
+        """
+        :param all_boxes: all_boxes[cls][image] = N x 5 array of detections in (x1, y1, x2, y2, score)
+        :param frame_ids: frame id of every image
+        :param start, end: range of images to add, all by default
+        """
+        end = len(frame_ids) if end is None else end
+        labels_cell, confs_cell, bboxes_cell = [], [], []
+        for i in range(start, end):
+            dets = [np.asarray(all_boxes[j][i], dtype=np.float64).reshape(-1, 5) for j in range(1, self.num_classes)]
+            labels = np.repeat(np.arange(1, self.num_classes), [len(d) for d in dets])
+            dets = np.concatenate(dets)
+            # same order as group_by_frame
+            order = np.argsort(-dets[:, 4], kind='mergesort')
+            labels_cell.append(labels[order])
+            confs_cell.append(dets[order, 4])
+            bboxes_cell.append(dets[order, :4])
+        return self.add(frame_ids[start:end], labels_cell, confs_cell, bboxes_cell)
+
+    def num_frames(self):
+        return int(np.sum(self.rec_done))
+
+    def ap(self, final=True):
+        """
+        :param final: count the gt of all frames, otherwise only of frames added so far
+        :return: ap [motion range, area range, class], -1 for classes without gt
+        """
+        with self.lock:
+            chunks = list(self.chunks)
+            rec_done = self.rec_done.copy()
+        # detections in frame order, which makes the result independent of the order frames were added in
+        det_rec = np.concatenate([c[0] for c in chunks] + [np.zeros(0, dtype=np.int64)])
+        order = np.argsort(det_rec, kind='mergesort')
+        det_labels = np.concatenate([c[1] for c in chunks] + [np.zeros(0, dtype=np.int64)])[order]
+        det_confs = np.concatenate([c[2] for c in chunks] + [np.zeros(0)])[order]
+        counted = np.ones(len(self.gt_labels), dtype=np.bool) if final else rec_done[self.gt_rec]
+        npos = np.bincount(self.gt_labels[counted], minlength=self.num_classes).astype(np.float64)
+
+        ap = np.zeros((len(self.motion_ranges), len(self.area_ranges), self.num_classes - 1))
+        for motion_range_id in range(len(self.motion_ranges)):
+            for area_range_id in range(len(self.area_ranges)):
+                tp = np.concatenate([c[3][motion_range_id][area_range_id][0] for c in chunks] + [np.zeros(0)])[order]
+                fp = np.concatenate([c[3][motion_range_id][area_range_id][1] for c in chunks] + [np.zeros(0)])[order]
+                ig_gt = self.ig_gt_motion[motion_range_id] | self.ig_gt_area[area_range_id]
+                npos_range = npos - np.bincount(self.gt_labels[ig_gt & counted], minlength=self.num_classes)
+                ap[motion_range_id][area_range_id] = calculate_ap(tp, fp, det_labels, det_confs, range(self.num_classes),
+                                                                  npos_range)
+        return ap
+
+
+def vid_eval_motion(detpath, imageset_file, classname_map, annotations, motion_iou_file, motion_ranges, area_ranges, ovthresh=0.5,
+                    cache_dir=None):
     """
     imagenet vid evaluation
-    :param detpath: detection results detpath.format(classname)
-    :param annopath: annotations annopath.format(classname)
+    :param detpath: detection result file(s), see vid_results
     :param imageset_file: text file containing list of images
-    :param annocache: caching annotations
+    :param annotations: AnnotationStore holding the annotations of the image set
     :param ovthresh: overlap threshold
-    :return: rec, prec, ap
+    :param cache_dir: where the flattened motion iou is kept, see load_motion_iou
+    :return: ap [motion range, area range, class]
     """
 
     with open(imageset_file, 'r') as f:
@@ -86,193 +307,36 @@ def vid_eval_motion(multifiles, detpath, annopath, imageset_file, classname_map,
     gt_img_ids = [int(x[1]) for x in lines]
     classhash = dict(zip(classname_map, range(0,len(classname_map))))
 
-   # load annotations from cache
-    if not os.path.isfile(annocache):
-        recs = []
-        for ind, image_filename in enumerate(img_basenames):
-            recs.append(parse_vid_rec(annopath.format('VID/' + image_filename), classhash, gt_img_ids[ind]))
-            if ind % 100 == 0:
-                print 'reading annotations for {:d}/{:d}'.format(ind + 1, len(img_basenames))
-        print 'saving annotations cache to {:s}'.format(annocache)
-        with open(annocache, 'wb') as f:
-            cPickle.dump(recs, f, protocol=cPickle.HIGHEST_PROTOCOL)
-    else:
-        with open(annocache, 'rb') as f:
-            recs = cPickle.load(f)
-
-    # read detections
-    splitlines = []
-    if (multifiles == False):
-        with open(detpath, 'r') as f:
-            lines = f.readlines()
-        splitlines = [x.strip().split(' ') for x in lines]
-    else:
-        for det in detpath:
-            with open(det, 'r') as f:
-                lines = f.readlines()
-            splitlines += [x.strip().split(' ') for x in lines]
-
-    splitlines=np.array(splitlines)
-    img_ids = splitlines[:,0].astype(int)
-    obj_labels = splitlines[:,1].astype(int)
-    obj_confs = splitlines[:,2].astype(float)
-    obj_bboxes = splitlines[:,3:].astype(float)
-
-    # sort by img_ids
-    if obj_bboxes.shape[0] > 0:
-        sorted_inds = np.argsort(img_ids)
-        img_ids = img_ids[sorted_inds]
-        obj_labels = obj_labels[sorted_inds]
-        obj_confs = obj_confs[sorted_inds]
-        obj_bboxes = obj_bboxes[sorted_inds, :]
-
-    num_imgs = max(max(gt_img_ids),max(img_ids)) + 1
-    obj_labels_cell = [None] * num_imgs
-    obj_confs_cell = [None] * num_imgs
-    obj_bboxes_cell = [None] * num_imgs
-    start_i = 0
-    id = img_ids[0]
-    # sort by confidence
-    for i in range(0, len(img_ids)):
-        if i == len(img_ids)-1 or img_ids[i+1] != id:
-            conf = obj_confs[start_i:i+1]
-            label = obj_labels[start_i:i+1]
-            bbox = obj_bboxes[start_i:i+1, :]
-            sorted_inds = np.argsort(-conf)
-
-            obj_labels_cell[id] = label[sorted_inds]
-            obj_confs_cell[id] = conf[sorted_inds]
-            obj_bboxes_cell[id] = bbox[sorted_inds, :]
-            if i < len(img_ids)-1:
-                id = img_ids[i+1]
-                start_i = i+1
-
-    ov_all = [None] * num_imgs
-    # extract objects in :param classname:
-    npos = np.zeros(len(classname_map))
-    for index, rec in enumerate(recs):
-        id = rec['img_ids']
-        gt_labels = rec['label']
-        gt_bboxes = rec['bbox']
-        num_gt_obj = len(gt_labels)
-
-        # calculate total gt for each class
-        for x in gt_labels:
-            npos[x] += 1  # class: number
-
-        labels = obj_labels_cell[id]
-        bboxes = obj_bboxes_cell[id]
-
-        num_obj = 0 if labels is None else len(labels)
-        ov_obj = [None] * num_obj
-        for j in range(0, num_obj):
-            bb = bboxes[j, :]
-            ov_gt = np.zeros(num_gt_obj)
-            for k in range(0, num_gt_obj):
-                bbgt = gt_bboxes[k, :]
-                bi = [np.max((bb[0], bbgt[0])), np.max((bb[1], bbgt[1])), np.min((bb[2], bbgt[2])),
-                      np.min((bb[3], bbgt[3]))]
-                iw = bi[2] - bi[0] + 1
-                ih = bi[3] - bi[1] + 1
-                if iw > 0 and ih > 0:
-                    # compute overlap as area of intersection / area of union
-                    ua = (bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) + \
-                         (bbgt[2] - bbgt[0] + 1.) * \
-                         (bbgt[3] - bbgt[1] + 1.) - iw * ih
-                    ov_gt[k] = iw * ih / ua
-            ov_obj[j] = ov_gt
-        ov_all[id] = ov_obj
-
-    # read motion iou
-    motion_iou = sio.loadmat(motion_iou_file)
-    motion_iou = np.array([[motion_iou['motion_iou'][i][0][j][0] if len(motion_iou['motion_iou'][i][0][j]) != 0 else 0 \
-                            for j in range(len(motion_iou['motion_iou'][i][0]))] \
-                                for i in range(len(motion_iou['motion_iou']))])
-
-    ap = np.zeros((len(motion_ranges), len(area_ranges), len(classname_map) - 1))
-    gt_precent = np.zeros((len(motion_ranges), len(area_ranges), len(classname_map)+1))
-
-    npos_bak = copy.deepcopy(npos)
-
-    for motion_range_id, motion_range in enumerate(motion_ranges):
-        for area_range_id, area_range in enumerate(area_ranges):
-            tp_cell = [None] * num_imgs
-            fp_cell = [None] * num_imgs
-            print '==========================================='
-            print 'eval_vid_detection :: accumulating: motion [{0:.1f} {1:.1f}], area [{2} {3} {4} {5}]'.format(
-                motion_range[0], motion_range[1], np.sqrt(area_range[0]), np.sqrt(area_range[0]), np.sqrt(area_range[1]), np.sqrt(area_range[1]))
-
-            all_motion_iou = np.concatenate(motion_iou, axis=0)
-            empty_weight = sum([(all_motion_iou[i] >= motion_range[0]) & (all_motion_iou[i] <= motion_range[1]) for i in range(len(all_motion_iou))]) / float(len(all_motion_iou))
-
-            for index, rec in enumerate(recs):
-                id = rec['img_ids']
-                gt_labels = rec['label']
-                gt_bboxes = rec['bbox']
-                gt_thr = rec['thr']
-                num_gt_obj = len(gt_labels)
-                gt_detected = np.zeros(num_gt_obj)
-
-                gt_motion_iou = motion_iou[index]
-                ig_gt_motion = [(gt_motion_iou[i] < motion_range[0]) | (gt_motion_iou[i] > motion_range[1]) for i in range(len(gt_motion_iou))]
-                gt_area = [(x[3] - x[1] + 1) * (x[2] - x[0] + 1) for x in gt_bboxes]
-                ig_gt_area = [(area < area_range[0]) | (area > area_range[1]) for area in gt_area]
-
-                labels = obj_labels_cell[id]
-                bboxes = obj_bboxes_cell[id]
-
-                num_obj = 0 if labels is None else len(labels)
-                tp = np.zeros(num_obj)
-                fp = np.zeros(num_obj)
-
-                for j in range(0, num_obj):
-                    bb = bboxes[j, :]
-                    ovmax = -1
-                    kmax = -1
-                    ovmax_ig = -1
-                    ovmax_nig = -1
-                    for k in range(0, num_gt_obj):
-                        ov = ov_all[id][j][k]
-                        if (ov >= gt_thr[k]) & (ov > ovmax) & (not gt_detected[k]) & (labels[j] == gt_labels[k]):
-                            ovmax = ov
-                            kmax = k
-                        if ig_gt_motion[k] & (ov > ovmax_ig):
-                            ovmax_ig = ov
-                        if (not ig_gt_motion[k]) & (ov > ovmax_nig):
-                            ovmax_nig = ov
-
-                    if kmax >= 0:
-                        gt_detected[kmax] = 1
-                        if (not ig_gt_motion[kmax]) & (not ig_gt_area[kmax]):
-                            tp[j] = 1.0
-                    else:
-                        bb_area = (bb[3] - bb[1] + 1) * (bb[2] - bb[0] + 1)
-                        if (bb_area < area_range[0]) | (bb_area > area_range[1]):
-                            fp[j] = 0
-                            continue
-
-                        if ovmax_nig > ovmax_ig:
-                            fp[j] = 1
-                        elif ovmax_ig > ovmax_nig:
-                            fp[j] = 0
-                        elif num_gt_obj == 0:
-                            fp[j] = empty_weight
-                        else:
-                            fp[j] = sum([1 if ig_gt_motion[i] else 0 for i in range(len(ig_gt_motion))]) / float(num_gt_obj)
-
-                tp_cell[id] = tp
-                fp_cell[id] = fp
-
-                for k in range(0, num_gt_obj):
-                    label = gt_labels[k]
-                    if (ig_gt_motion[k]) | (ig_gt_area[k]):
-                        npos[label] = npos[label] - 1
-
-            ap[motion_range_id][area_range_id] = calculate_ap(tp_cell, fp_cell, gt_img_ids, obj_labels_cell, obj_confs_cell, classname_map, npos)
-            gt_precent[motion_range_id][area_range_id][len(classname_map)] = sum([float(npos[i]) for i in range(len(npos))]) / sum([float(npos_bak[i]) for i in range(len(npos_bak))])
-            npos = copy.deepcopy(npos_bak)
+    recs = annotations.vid_recs(['VID/' + x for x in img_basenames], classhash, gt_img_ids)
+    evaluator = VIDMotionEvaluator(recs, load_motion_iou(motion_iou_file, cache_dir), classname_map, motion_ranges, area_ranges)
+    evaluator.add_records(read_results(detpath))
+    return evaluator.ap()
 
-    return ap
+
+def segment_maximum(out, inds, values):
+    """
+    out[i] = max(out[i], values[inds == i]) in place
+    :param inds: sorted indexes into out
+    """
+    if len(inds) == 0:
+        return
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(inds)) + 1))
+    out[inds[starts]] = np.maximum(out[inds[starts]], np.maximum.reduceat(values, starts))
+
+
+def overlaps(bboxes, gt_bboxes):
+    """
+    overlaps of detections with ground truth, same rule as boxoverlap
+    :param bboxes: [n, 4]
+    :param gt_bboxes: [k, 4]
+    :return: [n, k]
+    """
+    iw = np.minimum(bboxes[:, 2:3], gt_bboxes[None, :, 2]) - np.maximum(bboxes[:, 0:1], gt_bboxes[None, :, 0]) + 1
+    ih = np.minimum(bboxes[:, 3:4], gt_bboxes[None, :, 3]) - np.maximum(bboxes[:, 1:2], gt_bboxes[None, :, 1]) + 1
+    ua = ((bboxes[:, 2:3] - bboxes[:, 0:1] + 1.) * (bboxes[:, 3:4] - bboxes[:, 1:2] + 1.) +
+          (gt_bboxes[None, :, 2] - gt_bboxes[None, :, 0] + 1.) * (gt_bboxes[None, :, 3] - gt_bboxes[None, :, 1] + 1.) -
+          iw * ih)
+    return np.where((iw > 0) & (ih > 0), iw * ih / ua, 0.)
 
 
 def boxoverlap(bb, bbgt):
@@ -288,12 +352,12 @@ def boxoverlap(bb, bbgt):
         ov = intersect / ua
     return ov
 
-def calculate_ap(tp_cell, fp_cell, gt_img_ids, obj_labels_cell, obj_confs_cell, classname_map, npos):
-    tp_all = np.concatenate([x for x in np.array(tp_cell)[gt_img_ids] if x is not None])
-    fp_all = np.concatenate([x for x in np.array(fp_cell)[gt_img_ids] if x is not None])
-    obj_labels = np.concatenate([x for x in np.array(obj_labels_cell)[gt_img_ids] if x is not None])
-    confs = np.concatenate([x for x in np.array(obj_confs_cell)[gt_img_ids] if x is not None])
-
+def calculate_ap(tp_all, fp_all, obj_labels, confs, classname_map, npos):
+    """
+    :param tp_all, fp_all, obj_labels, confs: per detection, detections of an image in order of confidence
+    :param npos: number of gt per class
+    :return: ap per class, -1 for classes without gt
+    """
     sorted_inds = np.argsort(-confs)
     tp_all = tp_all[sorted_inds]
     fp_all = fp_all[sorted_inds]
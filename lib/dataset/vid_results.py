@@ -0,0 +1,100 @@
+# --------------------------------------------------------
+# Flow-Guided Feature Aggregation
+# Copyright (c) 2017 Microsoft
+# Licensed under The Apache-2.0 License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Binary ImageNet VID detection results.
+A result file is a .npy array of DET_DTYPE records, one per detection, which the evaluation
+memory-maps instead of parsing text. write_text exports the ImageNet VID text format
+'frame_id cls score x1 y1 x2 y2'.
+"""
+
+import numpy as np
+
+DET_DTYPE = np.dtype([('frame_id', np.int64), ('cls', np.int32), ('score', np.float32), ('bbox', np.float32, (4,))])
+
+
+def detections_to_records(all_boxes, frame_ids, num_classes):
+    """
+    :param all_boxes: all_boxes[cls][image] = N x 5 array of detections in (x1, y1, x2, y2, score)
+    :param frame_ids: frame id of every image
+    :param num_classes: number of classes including background, which is skipped
+    :return: records ordered by image, then class
+    """
+    frame_ids = np.asarray(frame_ids, dtype=np.int64)
+    num_dets = np.array([[len(all_boxes[cls_ind][im_ind]) for cls_ind in range(1, num_classes)]
+                         for im_ind in range(len(frame_ids))], dtype=np.int64).reshape(len(frame_ids), num_classes - 1)
+    records = np.zeros(num_dets.sum(), dtype=DET_DTYPE)
+    if len(records) == 0:
+        return records
+    records['frame_id'] = np.repeat(frame_ids, num_dets.sum(axis=1))
+    records['cls'] = np.repeat(np.tile(np.arange(1, num_classes), len(frame_ids)), num_dets.ravel())
+    dets = np.concatenate([np.asarray(all_boxes[cls_ind][im_ind], dtype=np.float32).reshape(-1, 5)
+                           for im_ind in range(len(frame_ids)) for cls_ind in range(1, num_classes)])
+    records['score'] = dets[:, -1]
+    records['bbox'] = dets[:, :4]
+    return records
+
+
+def write_results(filename, records):
+    """
+    :param filename: .npy result file
+    :param records: DET_DTYPE array
+    """
+    np.save(filename, np.asarray(records, dtype=DET_DTYPE))
+
+
+def read_results(filenames):
+    """
+    :param filenames: a result file or a list of them
+    :return: DET_DTYPE records, memory-mapped if there is a single file
+    """
+    if isinstance(filenames, basestring):
+        filenames = [filenames]
+    records = [np.load(filename, mmap_mode='r') for filename in filenames]
+    for r in records:
+        assert r.dtype == DET_DTYPE, 'not a detection result file'
+    return records[0] if len(records) == 1 else np.concatenate(records)
+
+
+def group_by_frame(records, num_imgs):
+    """
+    split detections per frame, in descending order of score within a frame
+    :param num_imgs: size of the returned lists, larger than every frame id
+    :return: labels, scores, boxes lists indexed by frame id, None for frames without detections
+    """
+    frame_ids = np.asarray(records['frame_id'])
+    scores = np.asarray(records['score'], dtype=np.float64)
+    order = np.lexsort((-scores, frame_ids))
+    frame_ids = frame_ids[order]
+    labels = np.asarray(records['cls'], dtype=np.int64)[order]
+    scores = scores[order]
+    boxes = np.asarray(records['bbox'], dtype=np.float64)[order]
+
+    labels_cell = [None] * num_imgs
+    scores_cell = [None] * num_imgs
+    boxes_cell = [None] * num_imgs
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(frame_ids)) + 1, [len(frame_ids)])) if len(frame_ids) else []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        id = frame_ids[start]
+        labels_cell[id] = labels[start:end]
+        scores_cell[id] = scores[start:end]
+        boxes_cell[id] = boxes[start:end]
+    return labels_cell, scores_cell, boxes_cell
+
+
+def write_text(filename, records):
+    """
+    export records in the ImageNet VID text format
+    :param filename: text result file
+    :param records: DET_DTYPE records
+    """
+    with open(filename, 'wt') as f:
+        for start in range(0, len(records), 1 << 20):
+            r = records[start:start + (1 << 20)]
+            bbox = r['bbox']
+            np.savetxt(f, np.column_stack((r['frame_id'], r['cls'], r['score'],
+                                           bbox[:, 0], bbox[:, 1], bbox[:, 2], bbox[:, 3])),
+                       fmt=['%d', '%d', '%.4f', '%.2f', '%.2f', '%.2f', '%.2f'])
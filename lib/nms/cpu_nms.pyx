@@ -14,6 +14,12 @@ cdef inline np.float32_t max(np.float32_t a, np.float32_t b):
 cdef inline np.float32_t min(np.float32_t a, np.float32_t b):
     return a if a <= b else b
 
+cdef inline np.float64_t max64(np.float64_t a, np.float64_t b):
+    return a if a >= b else b
+
+cdef inline np.float64_t min64(np.float64_t a, np.float64_t b):
+    return a if a <= b else b
+
 def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
     cdef np.ndarray[np.float32_t, ndim=1] x1 = dets[:, 0]
     cdef np.ndarray[np.float32_t, ndim=1] y1 = dets[:, 1]
@@ -66,3 +72,86 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
                 suppressed[j] = 1
 
     return keep
+
+def cpu_batched_nms(np.ndarray[np.float64_t, ndim=2] dets, np.ndarray[np.int32_t, ndim=1] labels,
+                    np.float thresh, int max_per_image=0):
+    """
+    per-label greedy nms over the boxes of all labels in one pass
+    boxes are visited in global score order and only suppress lower scored boxes of the same label,
+    once max_per_image boxes are kept only boxes tied with the last kept score are still accepted
+    overlaps are computed in float64 and tied scores of a label are visited in the scores.argsort()[::-1]
+    order of the boxes of that label, as nms.nms does
+    :param dets: [[x1, y1, x2, y2 score]]
+    :param labels: label of each box
+    :param thresh: retain overlap <= thresh
+    :param max_per_image: cap on kept boxes over all labels, 0 for no cap
+    :return: indexes to keep, in descending score order
+    """
+    cdef np.ndarray[np.float64_t, ndim=1] x1 = dets[:, 0]
+    cdef np.ndarray[np.float64_t, ndim=1] y1 = dets[:, 1]
+    cdef np.ndarray[np.float64_t, ndim=1] x2 = dets[:, 2]
+    cdef np.ndarray[np.float64_t, ndim=1] y2 = dets[:, 3]
+    cdef np.ndarray[np.float64_t, ndim=1] scores = dets[:, 4]
+
+    cdef np.ndarray[np.float64_t, ndim=1] areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    # score order grouped by label, then the global score order that keeps it for ties
+    cdef np.ndarray[np.int_t, ndim=1] label_order = np.argsort(labels, kind='mergesort').astype(np.int)
+    bounds = np.flatnonzero(np.diff(labels[label_order])) + 1
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(labels)]):
+        segment = label_order[start:stop]
+        label_order[start:stop] = segment[scores[segment].argsort()[::-1]]
+    cdef np.ndarray[np.int_t, ndim=1] order = \
+            label_order[np.argsort(-scores[label_order], kind='mergesort')].astype(np.int)
+
+    cdef int ndets = dets.shape[0]
+    cdef np.ndarray[np.int_t, ndim=1] suppressed = np.zeros((ndets), dtype=np.int)
+    # position of each box in label_order and end of its label segment
+    cdef np.ndarray[np.int_t, ndim=1] label_pos = np.empty((ndets), dtype=np.int)
+    cdef np.ndarray[np.int_t, ndim=1] label_end = np.empty((ndets), dtype=np.int)
+
+    cdef int _i, _j, i, j, end, nkeep = 0
+    cdef np.float64_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float64_t xx1, yy1, xx2, yy2
+    cdef np.float64_t w, h
+    cdef np.float64_t inter, ovr
+    cdef np.float64_t last_score = 0
+
+    end = ndets
+    for _j in range(ndets - 1, -1, -1):
+        j = label_order[_j]
+        if _j < ndets - 1 and labels[j] != labels[label_order[_j + 1]]:
+            end = _j + 1
+        label_pos[j] = _j
+        label_end[j] = end
+
+    keep = []
+    for _i in range(ndets):
+        i = order[_i]
+        if suppressed[i] == 1:
+            continue
+        if max_per_image > 0 and nkeep >= max_per_image and scores[i] < last_score:
+            break
+        keep.append(i)
+        nkeep += 1
+        last_score = scores[i]
+        ix1 = x1[i]
+        iy1 = y1[i]
+        ix2 = x2[i]
+        iy2 = y2[i]
+        iarea = areas[i]
+        for _j in range(label_pos[i] + 1, label_end[i]):
+            j = label_order[_j]
+            if suppressed[j] == 1:
+                continue
+            xx1 = max64(ix1, x1[j])
+            yy1 = max64(iy1, y1[j])
+            xx2 = min64(ix2, x2[j])
+            yy2 = min64(iy2, y2[j])
+            w = max64(0.0, xx2 - xx1 + 1)
+            h = max64(0.0, yy2 - yy1 + 1)
+            inter = w * h
+            ovr = inter / (iarea + areas[j] - inter)
+            if ovr > thresh:
+                suppressed[j] = 1
+
+    return np.array(keep, dtype=np.int)
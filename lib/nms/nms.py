@@ -1,7 +1,11 @@
 import numpy as np
 
-from cpu_nms import cpu_nms
-from gpu_nms import gpu_nms
+from cpu_nms import cpu_nms, cpu_batched_nms
+try:
+    from gpu_nms import gpu_nms
+except ImportError:
+    # cpu only build, gpu_nms_wrapper is unavailable
+    gpu_nms = None
 
 def py_nms_wrapper(thresh):
     def _nms(dets):
@@ -15,12 +19,42 @@ def cpu_nms_wrapper(thresh):
     return _nms
 
 
+def cpu_batched_nms_wrapper(thresh, max_per_image=0):
+    def _nms(dets_list):
+        return batched_nms(dets_list, thresh, max_per_image)
+    return _nms
+
+
 def gpu_nms_wrapper(thresh, device_id):
+    assert gpu_nms is not None, 'gpu_nms is not built'
     def _nms(dets):
         return gpu_nms(dets, thresh, device_id)
     return _nms
 
 
+def batched_nms(dets_list, thresh, max_per_image=0):
+    """
+    per-class nms of one image, all classes are handled by a single cpu_batched_nms call
+    :param dets_list: list of [[x1, y1, x2, y2 score]], one entry per class
+    :param thresh: retain overlap <= thresh
+    :param max_per_image: keep at most max_per_image boxes over all classes (plus score ties), 0 for no cap
+    :return: list of indexes to keep, one entry per class
+    """
+    counts = np.array([dets.shape[0] for dets in dets_list])
+    if counts.sum() == 0:
+        return [np.zeros((0,), dtype=np.int) for _ in dets_list]
+
+    dets = np.vstack([dets.reshape(-1, 5) for dets in dets_list]).astype(np.float64)
+    labels = np.repeat(np.arange(len(dets_list), dtype=np.int32), counts)
+    keep = cpu_batched_nms(dets, labels, thresh, max_per_image)
+
+    # group by class, keeping score order inside each class
+    keep = keep[np.argsort(labels[keep], kind='mergesort')]
+    splits = np.cumsum(np.bincount(labels[keep], minlength=len(dets_list)))[:-1]
+    starts = np.cumsum(counts) - counts
+    return [cls_keep - start for cls_keep, start in zip(np.split(keep, splits), starts)]
+
+
 def nms(dets, thresh):
     """
     greedily select boxes with high confidence and overlap with current maximum <= thresh
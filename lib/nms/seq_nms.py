@@ -11,10 +11,11 @@ import numpy as np
 
 import profile
 import cv2
-import time
 import copy
 import cPickle as pickle
 import os
+from collections import deque
+from multiprocessing import Pool, cpu_count
 
 CLASSES = ('__background__',
            'airplane', 'antelope', 'bear', 'bicycle', 'bird', 'bus',
@@ -29,46 +30,74 @@ IOU_THRESH = 0.5
 MAX_THRESH=1e-2
 
 
-def createLinks(dets_all):
-    links_all = []
+def _stack_frame(dets_all, frame_ind):
+    """
+    pad the boxes of one frame for all classes into a single array
+    :return: boxes [cls_num, max_boxes, 4], valid [cls_num, max_boxes]
+    """
+    cls_num = len(dets_all)
+    box_nums = [len(dets_all[cls_ind][frame_ind]) for cls_ind in range(cls_num)]
+    max_boxes = max(box_nums) if cls_num > 0 else 0
+    dtype = np.float32
+    for cls_ind in range(cls_num):
+        if box_nums[cls_ind] > 0:
+            dtype = dets_all[cls_ind][frame_ind].dtype
+            break
+    boxes = np.zeros((cls_num, max_boxes, 4), dtype=dtype)
+    valid = np.zeros((cls_num, max_boxes), dtype=np.bool)
+    for cls_ind in range(cls_num):
+        if box_nums[cls_ind] > 0:
+            boxes[cls_ind, :box_nums[cls_ind]] = dets_all[cls_ind][frame_ind][:, :4]
+            valid[cls_ind, :box_nums[cls_ind]] = True
+    return boxes, valid
+
+
+def _box_areas(boxes):
+    return ((boxes[..., 2] - boxes[..., 0] + 1) * (boxes[..., 3] - boxes[..., 1] + 1)).astype(np.float64)
+
+
+def _link_sources(indptr):
+    """ source box of every link in a CSR link table """
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
 
+
+def createLinks(dets_all):
+    """
+    link boxes of adjacent frames whose IoU >= IOU_THRESH, for all classes at once
+    :param dets_all: dets_all[cls][frame] = N x 5 array of detections
+    :return: links_all[cls][frame] = (indptr, indices), CSR table of the links from the boxes of
+             frame to the boxes of frame + 1, box i links to indices[indptr[i]:indptr[i + 1]]
+    """
+    cls_num = len(dets_all)
     frame_num = len(dets_all[0])
-    cls_num = len(CLASSES) - 1
-    for cls_ind in range(cls_num):
-        links_cls = []
-        for frame_ind in range(frame_num - 1):
-            dets1 = dets_all[cls_ind][frame_ind]
-            dets2 = dets_all[cls_ind][frame_ind + 1]
-            box1_num = len(dets1)
-            box2_num = len(dets2)
-            
-            if frame_ind == 0:
-                areas1 = np.empty(box1_num)
-                for box1_ind, box1 in enumerate(dets1):
-                    areas1[box1_ind] = (box1[2] - box1[0] + 1) * (box1[3] - box1[1] + 1)
-            else:
-                areas1 = areas2
-
-            areas2 = np.empty(box2_num)
-            for box2_ind, box2 in enumerate(dets2):
-                areas2[box2_ind] = (box2[2] - box2[0] + 1) * (box2[3] - box2[1] + 1)
-
-            links_frame = []
-            for box1_ind, box1 in enumerate(dets1):
-                area1 = areas1[box1_ind]
-                x1 = np.maximum(box1[0], dets2[:, 0])
-                y1 = np.maximum(box1[1], dets2[:, 1])
-                x2 = np.minimum(box1[2], dets2[:, 2])
-                y2 = np.minimum(box1[3], dets2[:, 3])
-                w = np.maximum(0.0, x2 - x1 + 1)
-                h = np.maximum(0.0, y2 - y1 + 1)
-                inter = w * h
-                ovrs = inter / (area1 + areas2 - inter)
-                links_box = [ovr_ind for ovr_ind, ovr in enumerate(ovrs) if
-                             ovr >= IOU_THRESH]
-                links_frame.append(links_box)
-            links_cls.append(links_frame)
-        links_all.append(links_cls)
+    links_all = [[] for _ in range(cls_num)]
+    if frame_num == 0:
+        return links_all
+
+    boxes2, valid2 = _stack_frame(dets_all, 0)
+    areas2 = _box_areas(boxes2)
+    for frame_ind in range(frame_num - 1):
+        boxes1, valid1, areas1 = boxes2, valid2, areas2
+        boxes2, valid2 = _stack_frame(dets_all, frame_ind + 1)
+        areas2 = _box_areas(boxes2)
+
+        # [cls_num, box1_num, box2_num] overlaps
+        x1 = np.maximum(boxes1[:, :, np.newaxis, 0], boxes2[:, np.newaxis, :, 0])
+        y1 = np.maximum(boxes1[:, :, np.newaxis, 1], boxes2[:, np.newaxis, :, 1])
+        x2 = np.minimum(boxes1[:, :, np.newaxis, 2], boxes2[:, np.newaxis, :, 2])
+        y2 = np.minimum(boxes1[:, :, np.newaxis, 3], boxes2[:, np.newaxis, :, 3])
+        w = np.maximum(0.0, x2 - x1 + 1)
+        h = np.maximum(0.0, y2 - y1 + 1)
+        inter = w * h
+        ovrs = inter / (areas1[:, :, np.newaxis] + areas2[:, np.newaxis, :] - inter)
+        linked = (ovrs >= IOU_THRESH) & valid1[:, :, np.newaxis] & valid2[:, np.newaxis, :]
+
+        for cls_ind in range(cls_num):
+            box1_num = len(dets_all[cls_ind][frame_ind])
+            rows, cols = np.nonzero(linked[cls_ind, :box1_num])
+            indptr = np.zeros(box1_num + 1, dtype=np.int64)
+            np.cumsum(np.bincount(rows, minlength=box1_num), out=indptr[1:])
+            links_all[cls_ind].append((indptr, cols.astype(np.int64)))
     return links_all
 
 
@@ -76,82 +105,94 @@ def maxPath(dets_all, links_all):
 
     for cls_ind, links_cls in enumerate(links_all):
 
-        max_begin = time.time()
-        delete_sets=[[]for i in range(0,len(dets_all[0]))]
-        delete_single_box=[]
         dets_cls = dets_all[cls_ind]
+        num_frame = len(dets_cls)
+        delete_masks = [np.zeros(len(frame), dtype=np.bool) for frame in dets_cls]
+        len_dets = [len(frame) for frame in dets_cls]
+        max_boxes = max(len_dets) if num_frame > 0 else 0
+        # boxes already taken by a path keep their rescored value but no longer start a path
+        used_boxes = np.zeros((num_frame, max_boxes), dtype=np.bool)
+        # alive[frame][k] is False once the k-th link of the frame is deleted
+        link_src = [_link_sources(indptr) for indptr, indices in links_cls]
+        alive = [np.ones(len(indices), dtype=np.bool) for indptr, indices in links_cls]
 
-        num_path=0
         # compute the number of links
-        sum_links=0
-        for frame_ind, frame in enumerate(links_cls):
-            for box_ind,box in enumerate(frame):
-                sum_links+=len(box)
+        sum_links = sum([len(indices) for indptr, indices in links_cls])
 
-        while True:
+        # a[i, j]: best path score ending at box j of frame i, b[i, j]: its predecessor in frame i - 1
+        a = np.zeros((num_frame, max_boxes))
+        b = np.full((num_frame, max_boxes), -1, dtype=np.int64)
+        row_max = np.zeros(num_frame)
+        for frame_ind in xrange(num_frame):
+            updateFrame(a, b, row_max, frame_ind, links_cls, link_src, alive, dets_cls, used_boxes)
 
-            num_path+=1
+        while True:
 
-            rootindex, maxpath, maxsum = findMaxPath(links_cls, dets_cls,delete_single_box)
+            rootindex, maxpath, maxsum = findMaxPath(a, b, row_max)
 
             if (maxsum<MAX_THRESH or sum_links==0 or len(maxpath) <1):
                 break
-            if (len(maxpath)==1):
-                delete=[rootindex,maxpath[0]]
-                delete_single_box.append(delete)
             rescore(dets_cls, rootindex, maxpath, maxsum)
-            t4=time.time()
-            delete_set,num_delete=deleteLink(dets_cls, links_cls, rootindex, maxpath, NMS_THRESH)
+            delete_set,num_delete=deleteLink(dets_cls, links_cls, link_src, alive, rootindex, maxpath, NMS_THRESH)
             sum_links-=num_delete
             for i, box_ind in enumerate(maxpath):
-                delete_set[i].remove(box_ind)
-                delete_single_box.append([[rootindex+i],box_ind])
-                for j in delete_set[i]:
-                    dets_cls[i+rootindex][j]=np.zeros(5)
-                delete_sets[i+rootindex]=delete_sets[i+rootindex]+delete_set[i]
+                deletes = delete_set[i][delete_set[i] != box_ind]
+                used_boxes[rootindex + i, box_ind] = True
+                dets_cls[i + rootindex][deletes] = 0
+                delete_masks[i + rootindex][deletes] = True
+
+            # the path only touched its own frames and the links into the frame after it,
+            # later frames are recomputed only as long as the change keeps propagating
+            last_touched = rootindex + len(maxpath)
+            for frame_ind in xrange(rootindex, num_frame):
+                changed = updateFrame(a, b, row_max, frame_ind, links_cls, link_src, alive, dets_cls, used_boxes)
+                if frame_ind >= last_touched and not changed:
+                    break
 
         for frame_idx,frame in enumerate(dets_all[cls_ind]):
-
-            a=range(0,len(frame))
-            keep=list(set(a).difference(set(delete_sets[frame_idx])))
-            dets_all[cls_ind][frame_idx]=frame[keep,:]
-
+            dets_all[cls_ind][frame_idx] = frame[np.logical_not(delete_masks[frame_idx]), :]
 
     return dets_all
 
 
-def findMaxPath(links,dets,delete_single_box):
-
-    len_dets=[len(dets[i]) for i in xrange(len(dets))]
-    max_boxes=np.max(len_dets)
-    num_frame=len(links)+1
-    a=np.zeros([num_frame,max_boxes])
-    new_dets=np.zeros([num_frame,max_boxes])
-    for delete_box in delete_single_box:
-        new_dets[delete_box[0],delete_box[1]]=1
-    if(max_boxes==0):
+def updateFrame(a, b, row_max, frame_ind, links, link_src, alive, dets, used_boxes):
+    """
+    recompute row frame_ind of the DP tables from row frame_ind - 1
+    :return: whether a[frame_ind] changed
+    """
+    old_row = a[frame_ind].copy()
+    num_boxes = len(dets[frame_ind])
+    a[frame_ind] = 0
+    a[frame_ind, :num_boxes] = dets[frame_ind][:, -1]
+    a[frame_ind, used_boxes[frame_ind]] = 0
+    b[frame_ind] = -1
+
+    if frame_ind > 0:
+        src = link_src[frame_ind - 1][alive[frame_ind - 1]]
+        dst = links[frame_ind - 1][1][alive[frame_ind - 1]]
+        if len(dst) > 0:
+            weights = a[frame_ind - 1, src] + dets[frame_ind][dst, -1]
+            # best predecessor of every box, the smallest box id wins a tie
+            order = np.lexsort((src, -weights, dst))
+            dst_sorted = dst[order]
+            best = order[np.concatenate(([True], dst_sorted[1:] != dst_sorted[:-1]))]
+            better = best[weights[best] > a[frame_ind, dst[best]]]
+            a[frame_ind, dst[better]] = weights[better]
+            b[frame_ind, dst[better]] = src[better]
+
+    row_max[frame_ind] = a[frame_ind].max() if a.shape[1] > 0 else 0
+    return not np.array_equal(old_row, a[frame_ind])
+
+
+def findMaxPath(a, b, row_max):
+
+    if a.size == 0:
         max_path=[]
         return 0,max_path,0
 
-    b=np.full((num_frame,max_boxes),-1)
-    for l in xrange(len(dets)):
-        for j in xrange(len(dets[l])):
-            if(new_dets[l,j]==0):
-                a[l,j]=dets[l][j][-1]
-
-
-
-    for i in xrange(1,num_frame):
-        l1=i-1;
-        for box_id,box in enumerate(links[l1]):
-            for next_box_id in box:
-
-                weight_new=a[i-1,box_id]+dets[i][next_box_id][-1]
-                if(weight_new>a[i,next_box_id]):
-                    a[i,next_box_id]=weight_new
-                    b[i,next_box_id]=box_id
-
-    i,j=np.unravel_index(a.argmax(),a.shape)
+    # first maximum in row-major order, same as a.argmax()
+    i = row_max.argmax()
+    j = a[i].argmax()
 
     maxpath=[j]
     maxscore=a[i,j]
@@ -174,42 +215,42 @@ def rescore(dets, rootindex, maxpath, maxsum):
         dets[rootindex + i][box_ind][4] = newscore
 
 
-def deleteLink(dets, links, rootindex, maxpath, thesh):
+def deleteLink(dets, links, link_src, alive, rootindex, maxpath, thesh):
 
     delete_set=[]
     num_delete_links=0
 
     for i, box_ind in enumerate(maxpath):
-        areas = [(box[2] - box[0] + 1) * (box[3] - box[1] + 1) for box in dets[rootindex + i]]
+        frame = dets[rootindex + i]
+        areas = (frame[:, 2] - frame[:, 0] + 1) * (frame[:, 3] - frame[:, 1] + 1)
         area1 = areas[box_ind]
-        box1 = dets[rootindex + i][box_ind]
-        x1 = np.maximum(box1[0], dets[rootindex + i][:, 0])
-        y1 = np.maximum(box1[1], dets[rootindex + i][:, 1])
-        x2 = np.minimum(box1[2], dets[rootindex + i][:, 2])
-        y2 = np.minimum(box1[3], dets[rootindex + i][:, 3])
+        box1 = frame[box_ind]
+        x1 = np.maximum(box1[0], frame[:, 0])
+        y1 = np.maximum(box1[1], frame[:, 1])
+        x2 = np.minimum(box1[2], frame[:, 2])
+        y2 = np.minimum(box1[3], frame[:, 3])
         w = np.maximum(0.0, x2 - x1 + 1)
         h = np.maximum(0.0, y2 - y1 + 1)
         inter = w * h
 
         ovrs = inter / (area1 + areas - inter)
         #saving the box need to delete
-        deletes = [ovr_ind for ovr_ind, ovr in enumerate(ovrs) if ovr >= 0.3]
+        deletes = np.where(ovrs >= thesh)[0]
         delete_set.append(deletes)
 
         #delete the links except for the last frame
         if rootindex + i < len(links):
-            for delete_ind in deletes:
-                num_delete_links+=len(links[rootindex+i][delete_ind])
-                links[rootindex + i][delete_ind] = []
+            outgoing = np.in1d(link_src[rootindex + i], deletes) & alive[rootindex + i]
+            num_delete_links += np.count_nonzero(outgoing)
+            alive[rootindex + i][outgoing] = False
 
         if i > 0 or rootindex > 0:
 
             #delete the links which point to box_ind
-            for priorbox in links[rootindex + i - 1]:
-                for delete_ind in deletes:
-                    if delete_ind in priorbox:
-                        priorbox.remove(delete_ind)
-                        num_delete_links+=1
+            indptr, indices = links[rootindex + i - 1]
+            incoming = np.in1d(indices, deletes) & alive[rootindex + i - 1]
+            num_delete_links += np.count_nonzero(incoming)
+            alive[rootindex + i - 1][incoming] = False
 
     return delete_set,num_delete_links
 
@@ -218,3 +259,88 @@ def seq_nms(dets):
     dets=maxPath(dets, links)
     return dets
 
+
+def seq_nms_cls(dets_cls):
+    """
+    Seq-NMS of a single class, classes do not interact
+    :param dets_cls: dets_cls[frame] = N x 5 array of detections of one class
+    """
+    return seq_nms([dets_cls])[0]
+
+
+def seq_nms_multiprocess(units, processes=None, pool=None):
+    """
+    run seq_nms_cls on independent (video, class) units over a process pool
+    units are dispatched largest first, by number of frames times number of boxes, so that
+    the long videos do not end up last
+    :param units: list of dets_cls
+    :param processes: pool size, all cores by default
+    :param pool: Pool to run on, forked by the caller before it started threads or MXNet,
+                 a new one is forked by default
+    :return: list of rescored dets_cls in the order of units
+    """
+    if len(units) == 0:
+        return []
+    costs = [len(dets_cls) * sum([len(dets) for dets in dets_cls]) for dets_cls in units]
+    order = np.argsort(costs, kind='mergesort')[::-1]
+
+    own_pool = pool is None
+    if own_pool:
+        pool = Pool(processes=processes or cpu_count())
+    results = [None] * len(units)
+    for unit_ind, dets_cls in zip(order, pool.imap(seq_nms_cls, [units[i] for i in order], chunksize=1)):
+        results[unit_ind] = dets_cls
+    if own_pool:
+        pool.close()
+        pool.join()
+    return results
+
+
+class OnlineSeqNMS(object):
+    """
+    Seq-NMS over a sliding temporal window for streams
+    the detections of frame t are finalized once frame t + lookahead has arrived, the window also keeps
+    up to history finalized frames before t as context, so memory is bounded by the window, not the video
+    """
+    def __init__(self, lookahead, history=None):
+        self.lookahead = lookahead
+        self.history = lookahead if history is None else history
+        self.window = deque(maxlen=self.history + 1 + self.lookahead)
+        self.keys = deque(maxlen=self.history + 1 + self.lookahead)
+        self.pending = 0
+
+    def reset(self):
+        """ start a new video, pending frames must be flushed before """
+        self.window.clear()
+        self.keys.clear()
+        self.pending = 0
+
+    def push(self, dets, key=None):
+        """
+        :param dets: dets[cls] = N x 5 array of detections of one frame
+        :param key: returned along with the finalized detections of this frame, e.g. its image index
+        :return: list of (key, dets) of the frames finalized by this one
+        """
+        self.window.append(dets)
+        self.keys.append(key)
+        self.pending += 1
+        if self.pending > self.lookahead:
+            return [self._finalize()]
+        return []
+
+    def flush(self):
+        """ end of the video, finalize the remaining frames with a shortened lookahead """
+        finalized = []
+        while self.pending > 0:
+            finalized.append(self._finalize())
+        return finalized
+
+    def _finalize(self):
+        target = len(self.window) - self.pending
+        cls_num = len(self.window[0])
+        # seq_nms rescores and suppresses in place
+        video = [[frame[cls_ind].copy() for frame in self.window] for cls_ind in range(cls_num)]
+        dets_all = seq_nms(video)
+        self.pending -= 1
+        return self.keys[target], [dets_all[cls_ind][target] for cls_ind in range(cls_num)]
+
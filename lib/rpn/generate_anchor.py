@@ -1,9 +1,15 @@
 """
-Generate base anchors on index 0
+Generate base anchors on index 0, and the shifted anchors of whole feature maps
 """
 
 import numpy as np
 
+# feature shapes only take a few values (fixed SCALES, aspect grouping), so the anchor grids and
+# inside-image indices are memoized; cached arrays are read-only as they are shared by all callers
+_MAX_CACHED = 64
+_anchor_grids = {}
+_inside_inds = {}
+
 
 def generate_anchors(base_size=16, ratios=[0.5, 1, 2],
                      scales=2 ** np.arange(3, 6)):
@@ -19,6 +25,63 @@ def generate_anchors(base_size=16, ratios=[0.5, 1, 2],
     return anchors
 
 
+def _cache_put(cache, key, value):
+    value.setflags(write=False)
+    if len(cache) >= _MAX_CACHED:
+        cache.clear()
+    cache[key] = value
+    return value
+
+
+def anchor_grid(feat_height, feat_width, feat_stride=16, scales=(8, 16, 32), ratios=(0.5, 1, 2)):
+    """
+    Return the anchors of every cell of a feature map, memoized by
+    (feat_height, feat_width, feat_stride, scales, ratios).
+    :return: read-only (feat_height * feat_width * A, 4) anchors, rows ordered by (h, w, a)
+    """
+    key = (int(feat_height), int(feat_width), float(feat_stride),
+           tuple([float(s) for s in scales]), tuple([float(r) for r in ratios]))
+    anchors = _anchor_grids.get(key)
+    if anchors is not None:
+        return anchors
+
+    base_anchors = generate_anchors(base_size=feat_stride, ratios=np.array(ratios, dtype=np.float64),
+                                    scales=np.array(scales, dtype=np.float64))
+    shift_x = np.arange(0, feat_width) * feat_stride
+    shift_y = np.arange(0, feat_height) * feat_stride
+    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
+    # add A anchors (1, A, 4) to
+    # cell K shifts (K, 1, 4) to get
+    # shift anchors (K, A, 4)
+    # reshape to (K*A, 4) shifted anchors
+    A = base_anchors.shape[0]
+    K = shifts.shape[0]
+    anchors = base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
+    return _cache_put(_anchor_grids, key, anchors.reshape((K * A, 4)))
+
+
+def inside_anchor_inds(feat_height, feat_width, im_height, im_width, feat_stride=16, scales=(8, 16, 32),
+                       ratios=(0.5, 1, 2), allowed_border=0):
+    """
+    Return the indices of the anchor_grid anchors lying inside an image, memoized like anchor_grid.
+    :param allowed_border: anchors may cross the image edges by up to allowed_border pixels
+    :return: read-only sorted indices into anchor_grid(feat_height, feat_width, feat_stride, scales, ratios)
+    """
+    key = (int(feat_height), int(feat_width), float(im_height), float(im_width), float(feat_stride),
+           tuple([float(s) for s in scales]), tuple([float(r) for r in ratios]), float(allowed_border))
+    inds = _inside_inds.get(key)
+    if inds is not None:
+        return inds
+
+    anchors = anchor_grid(feat_height, feat_width, feat_stride, scales, ratios)
+    inds = np.where((anchors[:, 0] >= -allowed_border) &
+                    (anchors[:, 1] >= -allowed_border) &
+                    (anchors[:, 2] < im_width + allowed_border) &
+                    (anchors[:, 3] < im_height + allowed_border))[0]
+    return _cache_put(_inside_inds, key, inds)
+
+
 def _whctrs(anchor):
     """
     Return width, height, x center, and y center for an anchor (window).
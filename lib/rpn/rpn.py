@@ -14,7 +14,7 @@ import numpy as np
 import numpy.random as npr
 
 from utils.image import get_image, get_triple_image, tensor_vstack
-from generate_anchor import generate_anchors
+from generate_anchor import anchor_grid, inside_anchor_inds
 from bbox.bbox_transform import bbox_overlaps, bbox_transform
 
 
@@ -124,12 +124,57 @@ def get_rpn_triple_batch(roidb, cfg):
 
     return data, label
 
+def _sample_inds(inds, num):
+    """
+    pick num of inds uniformly at random, without permuting all of them when num is small
+    :return: picked inds, all of them if there are no more than num
+    """
+    if len(inds) <= num:
+        return inds
+    if 2 * num > len(inds):
+        return inds[npr.permutation(len(inds))[:num]]
+    picked = np.zeros((0,), dtype=np.int64)
+    while len(picked) < num:
+        picked = np.union1d(picked, npr.randint(0, len(inds), size=num - len(picked)))
+    return inds[picked]
+
+
+def _near_gt_anchors(base_anchors, gt_boxes, feat_height, feat_width, feat_stride):
+    """
+    anchor grid indices of all anchors that may overlap a gt box, found from the cell range of every
+    (gt box, base anchor) pair instead of comparing every anchor with every gt box
+    :param base_anchors: (A, 4) anchors of cell (0, 0)
+    :return: sorted unique indices into anchor_grid, a superset of the anchors with a nonzero overlap
+    """
+    A = base_anchors.shape[0]
+    # the anchor of cell (h, w) is base_anchor + (w, h, w, h) * feat_stride, one cell of margin is kept
+    w_lo = np.floor((gt_boxes[:, np.newaxis, 0] - base_anchors[np.newaxis, :, 2]) / feat_stride) - 1
+    w_hi = np.ceil((gt_boxes[:, np.newaxis, 2] - base_anchors[np.newaxis, :, 0]) / feat_stride) + 1
+    h_lo = np.floor((gt_boxes[:, np.newaxis, 1] - base_anchors[np.newaxis, :, 3]) / feat_stride) - 1
+    h_hi = np.ceil((gt_boxes[:, np.newaxis, 3] - base_anchors[np.newaxis, :, 1]) / feat_stride) + 1
+    w_lo = np.maximum(w_lo, 0).astype(np.int64)
+    w_hi = np.minimum(w_hi, feat_width - 1).astype(np.int64)
+    h_lo = np.maximum(h_lo, 0).astype(np.int64)
+    h_hi = np.minimum(h_hi, feat_height - 1).astype(np.int64)
+
+    inds = []
+    for g, a in zip(*np.where((w_lo <= w_hi) & (h_lo <= h_hi))):
+        cells = np.arange(h_lo[g, a], h_hi[g, a] + 1)[:, np.newaxis] * feat_width + \
+            np.arange(w_lo[g, a], w_hi[g, a] + 1)[np.newaxis, :]
+        inds.append(cells.ravel() * A + a)
+    if len(inds) == 0:
+        return np.zeros((0,), dtype=np.int64)
+    return np.unique(np.concatenate(inds))
+
+
 def assign_anchor(feat_shape, gt_boxes, im_info, cfg, feat_stride=16,
                   scales=(8, 16, 32), ratios=(0.5, 1, 2), allowed_border=0,
                   normalize_target=False, bbox_mean=(0.0, 0.0, 0.0, 0.0),
                   bbox_std=(0.1, 0.1, 0.4, 0.4)):
     """
     assign ground truth boxes to anchor positions
+    overlaps are only computed for the inside anchors near a gt box, and targets only for the sampled
+    foreground anchors; everything else is -1 (label) or 0 (bbox_target, bbox_weight)
     :param feat_shape: infer output shape
     :param gt_boxes: assign ground truth
     :param im_info: filter out anchors overlapped with edges
@@ -146,154 +191,103 @@ def assign_anchor(feat_shape, gt_boxes, im_info, cfg, feat_stride=16,
     'bbox_inside_weight': *todo* mark the assigned anchors
     'bbox_outside_weight': used to normalize the bbox_loss, all weights sums to RPN_POSITIVE_WEIGHT
     """
-    def _unmap(data, count, inds, fill=0):
-        """" unmap a subset inds of data into original data of size count """
-        if len(data.shape) == 1:
-            ret = np.empty((count,), dtype=np.float32)
-            ret.fill(fill)
-            ret[inds] = data
-        else:
-            ret = np.empty((count,) + data.shape[1:], dtype=np.float32)
-            ret.fill(fill)
-            ret[inds, :] = data
-        return ret
-
     DEBUG = False
     im_info = im_info[0]
-    scales = np.array(scales, dtype=np.float32)
-    base_anchors = generate_anchors(base_size=feat_stride, ratios=list(ratios), scales=scales)
-    num_anchors = base_anchors.shape[0]
-    feat_height, feat_width = feat_shape[-2:]
-
-    if DEBUG:
-        print 'anchors:'
-        print base_anchors
-        print 'anchor shapes:'
-        print np.hstack((base_anchors[:, 2::4] - base_anchors[:, 0::4],
-                         base_anchors[:, 3::4] - base_anchors[:, 1::4]))
-        print 'im_info', im_info
-        print 'height', feat_height, 'width', feat_width
-        print 'gt_boxes shape', gt_boxes.shape
-        print 'gt_boxes', gt_boxes
+    feat_height, feat_width = [int(i) for i in feat_shape[-2:]]
 
     # 1. generate proposals from bbox deltas and shifted anchors
-    shift_x = np.arange(0, feat_width) * feat_stride
-    shift_y = np.arange(0, feat_height) * feat_stride
-    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
-    A = num_anchors
-    K = shifts.shape[0]
-    all_anchors = base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-    all_anchors = all_anchors.reshape((K * A, 4))
-    total_anchors = int(K * A)
+    all_anchors = anchor_grid(feat_height, feat_width, feat_stride, scales, ratios)
+    K = feat_height * feat_width
+    A = all_anchors.shape[0] // K
 
     # only keep anchors inside the image
-    inds_inside = np.where((all_anchors[:, 0] >= -allowed_border) &
-                           (all_anchors[:, 1] >= -allowed_border) &
-                           (all_anchors[:, 2] < im_info[1] + allowed_border) &
-                           (all_anchors[:, 3] < im_info[0] + allowed_border))[0]
-    if DEBUG:
-        print 'total_anchors', total_anchors
-        print 'inds_inside', len(inds_inside)
-
-    # keep only inside anchors
-    anchors = all_anchors[inds_inside, :]
+    inds_inside = inside_anchor_inds(feat_height, feat_width, im_info[0], im_info[1], feat_stride,
+                                     scales, ratios, allowed_border)
+    num_inside = len(inds_inside)
     if DEBUG:
-        print 'anchors shape', anchors.shape
-
-    # label: 1 is positive, 0 is negative, -1 is dont care
-    labels = np.empty((len(inds_inside),), dtype=np.float32)
-    labels.fill(-1)
+        print 'im_info', im_info
+        print 'height', feat_height, 'width', feat_width
+        print 'gt_boxes', gt_boxes
+        print 'total_anchors', A * K
+        print 'inds_inside', num_inside
 
+    # fg / bg masks over the inside anchors
     if gt_boxes.size > 0:
-        # overlap between the anchors and the gt boxes
-        # overlaps (ex, gt)
-        overlaps = bbox_overlaps(anchors.astype(np.float), gt_boxes.astype(np.float))
-        argmax_overlaps = overlaps.argmax(axis=1)
-        max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
-        gt_argmax_overlaps = overlaps.argmax(axis=0)
-        gt_max_overlaps = overlaps[gt_argmax_overlaps, np.arange(overlaps.shape[1])]
-        gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
-
-        if not cfg.TRAIN.RPN_CLOBBER_POSITIVES:
-            # assign bg labels first so that positive labels can clobber them
-            labels[max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
+        # overlaps (ex, gt) of the inside anchors near a gt box; all the others overlap no gt box
+        near = _near_gt_anchors(all_anchors[:A], gt_boxes, feat_height, feat_width, feat_stride)
+        near_pos = np.searchsorted(inds_inside, near)
+        near_pos = near_pos[inds_inside[np.minimum(near_pos, num_inside - 1)] == near] if num_inside else near_pos[:0]
+        overlaps = bbox_overlaps(all_anchors[inds_inside[near_pos], :].astype(np.float), gt_boxes.astype(np.float))
+        if len(near_pos) > 0:
+            near_argmax = overlaps.argmax(axis=1)
+            near_max = overlaps[np.arange(len(near_pos)), near_argmax]
+            gt_max_overlaps = overlaps.max(axis=0)
+        else:
+            near_argmax = np.zeros((0,), dtype=np.int64)
+            near_max = np.zeros((0,))
+            gt_max_overlaps = np.zeros((gt_boxes.shape[0],))
 
-        # fg label: for each gt, anchor with highest overlap
-        labels[gt_argmax_overlaps] = 1
+        max_overlaps = np.zeros((num_inside,))
+        max_overlaps[near_pos] = near_max
+        bg = max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP
 
+        # fg label: for each gt, anchor with highest overlap
+        fg = np.zeros((num_inside,), dtype=np.bool)
+        if (gt_max_overlaps == 0).any():
+            # a gt box overlapping no inside anchor ties with all of them
+            fg[:] = True
+        else:
+            fg[near_pos[(overlaps == gt_max_overlaps).any(axis=1)]] = True
         # fg label: above threshold IoU
-        labels[max_overlaps >= cfg.TRAIN.RPN_POSITIVE_OVERLAP] = 1
+        fg[near_pos[near_max >= cfg.TRAIN.RPN_POSITIVE_OVERLAP]] = True
 
         if cfg.TRAIN.RPN_CLOBBER_POSITIVES:
-            # assign bg labels last so that negative labels can clobber positives
-            labels[max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
+            # negative labels clobber positives
+            fg &= ~bg
+        else:
+            # positive labels clobber negatives
+            bg &= ~fg
     else:
-        labels[:] = 0
+        fg = np.zeros((num_inside,), dtype=np.bool)
+        bg = np.ones((num_inside,), dtype=np.bool)
 
     # subsample positive labels if we have too many
     num_fg = int(cfg.TRAIN.RPN_FG_FRACTION * cfg.TRAIN.RPN_BATCH_SIZE)
-    fg_inds = np.where(labels == 1)[0]
-    if len(fg_inds) > num_fg:
-        disable_inds = npr.choice(fg_inds, size=(len(fg_inds) - num_fg), replace=False)
-        if DEBUG:
-            disable_inds = fg_inds[:(len(fg_inds) - num_fg)]
-        labels[disable_inds] = -1
+    fg_pos = _sample_inds(np.where(fg)[0], num_fg)
 
     # subsample negative labels if we have too many
-    num_bg = cfg.TRAIN.RPN_BATCH_SIZE - np.sum(labels == 1)
-    bg_inds = np.where(labels == 0)[0]
-    if len(bg_inds) > num_bg:
-        disable_inds = npr.choice(bg_inds, size=(len(bg_inds) - num_bg), replace=False)
-        if DEBUG:
-            disable_inds = bg_inds[:(len(bg_inds) - num_bg)]
-        labels[disable_inds] = -1
-
-    bbox_targets = np.zeros((len(inds_inside), 4), dtype=np.float32)
-    if gt_boxes.size > 0:
-        bbox_targets[:] = bbox_transform(anchors, gt_boxes[argmax_overlaps, :4])
-
-    bbox_weights = np.zeros((len(inds_inside), 4), dtype=np.float32)
-    bbox_weights[labels == 1, :] = np.array(cfg.TRAIN.RPN_BBOX_WEIGHTS)
-
-    if DEBUG:
-        _sums = bbox_targets[labels == 1, :].sum(axis=0)
-        _squared_sums = (bbox_targets[labels == 1, :] ** 2).sum(axis=0)
-        _counts = np.sum(labels == 1)
-        means = _sums / (_counts + 1e-14)
-        stds = np.sqrt(_squared_sums / _counts - means ** 2)
-        print 'means', means
-        print 'stdevs', stds
-
+    num_bg = cfg.TRAIN.RPN_BATCH_SIZE - len(fg_pos)
+    bg_pos = _sample_inds(np.where(bg)[0], num_bg)
+
+    bbox_targets = np.zeros((len(fg_pos), 4), dtype=np.float32)
+    if len(fg_pos) > 0:
+        # best gt of every anchor, gt 0 for the anchors overlapping none
+        argmax_overlaps = np.zeros((num_inside,), dtype=np.int64)
+        argmax_overlaps[near_pos] = near_argmax
+        bbox_targets[:] = bbox_transform(all_anchors[inds_inside[fg_pos], :],
+                                         gt_boxes[argmax_overlaps[fg_pos], :4])
     if normalize_target:
         bbox_targets = ((bbox_targets - np.array(bbox_mean))
-                       / np.array(bbox_std))
-
-    # map up to original set of anchors
-    labels = _unmap(labels, total_anchors, inds_inside, fill=-1)
-    bbox_targets = _unmap(bbox_targets, total_anchors, inds_inside, fill=0)
-    bbox_weights = _unmap(bbox_weights, total_anchors, inds_inside, fill=0)
+                        / np.array(bbox_std))
 
     if DEBUG:
-        print 'rpn: max max_overlaps', np.max(max_overlaps)
-        print 'rpn: num_positives', np.sum(labels == 1)
-        print 'rpn: num_negatives', np.sum(labels == 0)
-        _fg_sum = np.sum(labels == 1)
-        _bg_sum = np.sum(labels == 0)
-        _count = 1
-        print 'rpn: num_positive avg', _fg_sum / _count
-        print 'rpn: num_negative avg', _bg_sum / _count
-
-    labels = labels.reshape((1, feat_height, feat_width, A)).transpose(0, 3, 1, 2)
-    labels = labels.reshape((1, A * feat_height * feat_width))
-    bbox_targets = bbox_targets.reshape((1, feat_height, feat_width, A * 4)).transpose(0, 3, 1, 2)
-    bbox_weights = bbox_weights.reshape((1, feat_height, feat_width, A * 4)).transpose((0, 3, 1, 2))
+        print 'rpn: num_positives', len(fg_pos)
+        print 'rpn: num_negatives', len(bg_pos)
+
+    # write labels and targets straight into the (A, H, W) layout, grid index = cell * A + a
+    labels = np.empty((1, A * K), dtype=np.float32)
+    labels.fill(-1)
+    labels[0, (inds_inside[fg_pos] % A) * K + inds_inside[fg_pos] // A] = 1
+    labels[0, (inds_inside[bg_pos] % A) * K + inds_inside[bg_pos] // A] = 0
+
+    rows = (inds_inside[fg_pos] % A)[:, np.newaxis] * 4 + np.arange(4)[np.newaxis, :]
+    cols = (inds_inside[fg_pos] // A)[:, np.newaxis]
+    full_bbox_targets = np.zeros((1, A * 4, feat_height, feat_width), dtype=np.float32)
+    full_bbox_targets.reshape((A * 4, K))[rows, cols] = bbox_targets
+    full_bbox_weights = np.zeros((1, A * 4, feat_height, feat_width), dtype=np.float32)
+    full_bbox_weights.reshape((A * 4, K))[rows, cols] = np.array(cfg.TRAIN.RPN_BBOX_WEIGHTS)
 
     label = {'label': labels,
-             'bbox_target': bbox_targets,
-             'bbox_weight': bbox_weights}
+             'bbox_target': full_bbox_targets,
+             'bbox_weight': full_bbox_weights}
     return label
@@ -10,6 +10,9 @@
 import mxnet as mx
 from mxnet.io import DataDesc, DataBatch
 import threading
+import time
+import sys
+import Queue
 
 
 class PrefetchingIter(mx.io.DataIter):
@@ -27,53 +30,91 @@ class PrefetchingIter(mx.io.DataIter):
         in iter[i].provide_data
     rename_label : None or list of dict
         Similar to rename_data
+    prefetch_depth : int
+        number of batches each iter may run ahead of the consumer
+
+    Each iter is driven by its own thread feeding a bounded queue. Batches of
+    several iters are merged into one DataBatch; a single iter may return any
+    object from next(). Call close() to stop the threads.
 
     Examples
     --------
     iter = PrefetchingIter([NDArrayIter({'data': X1}), NDArrayIter({'data': X2})],
                            rename_data=[{'data': 'data1'}, {'data': 'data2'}])
     """
-    def __init__(self, iters, rename_data=None, rename_label=None):
+    def __init__(self, iters, rename_data=None, rename_label=None, prefetch_depth=4):
         super(PrefetchingIter, self).__init__()
         if not isinstance(iters, list):
             iters = [iters]
         self.n_iter = len(iters)
-        assert self.n_iter ==1, "Our prefetching iter only support 1 DataIter"
         self.iters = iters
         self.rename_data = rename_data
         self.rename_label = rename_label
         self.batch_size = len(self.provide_data) * self.provide_data[0][0][1][0]
-        self.data_ready = [threading.Event() for i in range(self.n_iter)]
-        self.data_taken = [threading.Event() for i in range(self.n_iter)]
-        for e in self.data_taken:
-            e.set()
-        self.started = True
-        self.current_batch = [None for _ in range(self.n_iter)]
-        self.next_batch = [None for _ in range(self.n_iter)]
-        def prefetch_func(self, i):
-            """Thread entry"""
-            while True:
-                self.data_taken[i].wait()
-                if not self.started:
-                    break
+        self.prefetch_depth = max(prefetch_depth, 1)
+        self.queues = [Queue.Queue(maxsize=self.prefetch_depth) for _ in range(self.n_iter)]
+        self.stop_event = threading.Event()
+        self.prefetch_threads = []
+        self.current_batch = None
+        self.exhausted = False
+        self.reset_stats()
+        self.start()
+
+    def prefetch_func(self, i):
+        """Thread entry"""
+        while not self.stop_event.is_set():
+            try:
+                batch = self.iters[i].next()
+            except StopIteration:
+                batch = None
+            except Exception:
+                batch = _PrefetchError(sys.exc_info())
+            while not self.stop_event.is_set():
                 try:
-                    self.next_batch[i] = self.iters[i].next()
-                except StopIteration:
-                    self.next_batch[i] = None
-                self.data_taken[i].clear()
-                self.data_ready[i].set()
-        self.prefetch_threads = [threading.Thread(target=prefetch_func, args=[self, i]) \
+                    self.queues[i].put(batch, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if batch is None or isinstance(batch, _PrefetchError):
+                break
+
+    def start(self):
+        self.stop_event.clear()
+        self.exhausted = False
+        self.prefetch_threads = [threading.Thread(target=self.prefetch_func, args=[i]) \
                                  for i in range(self.n_iter)]
         for thread in self.prefetch_threads:
             thread.setDaemon(True)
             thread.start()
 
-    def __del__(self):
-        self.started = False
-        for e in self.data_taken:
-            e.set()
+    def close(self):
+        """stop the prefetch threads and drop prefetched batches"""
+        self.stop_event.set()
         for thread in self.prefetch_threads:
             thread.join()
+        self.prefetch_threads = []
+        for q in self.queues:
+            while not q.empty():
+                q.get_nowait()
+
+    def reset_stats(self):
+        self.num_fetch = 0
+        self.num_starved = 0
+        self.sum_occupancy = 0
+        self.wait_time = 0.0
+
+    def stats(self):
+        """
+        queue occupancy seen by the consumer since the last reset_stats, over all queues
+        starved is the fraction of fetches that found an empty queue (input bound)
+        :return: dict
+        """
+        num_fetch = max(self.num_fetch, 1)
+        return {'fetches': self.num_fetch,
+                'depth': self.prefetch_depth,
+                'mean_occupancy': float(self.sum_occupancy) / num_fetch,
+                'starved': float(self.num_starved) / num_fetch,
+                'wait_time': self.wait_time}
 
     @property
     def provide_data(self):
@@ -100,27 +141,43 @@ class PrefetchingIter(mx.io.DataIter):
             ] for r, i in zip(self.rename_label, self.iters)], [])
 
     def reset(self):
-        for e in self.data_ready:
-            e.wait()
+        self.close()
         for i in self.iters:
             i.reset()
-        for e in self.data_ready:
-            e.clear()
-        for e in self.data_taken:
-            e.set()
+        self.start()
+
+    def fetch(self, i):
+        q = self.queues[i]
+        occupancy = q.qsize()
+        self.num_fetch += 1
+        self.sum_occupancy += occupancy
+        if occupancy == 0:
+            self.num_starved += 1
+        tic = time.time()
+        batch = q.get()
+        self.wait_time += time.time() - tic
+        if isinstance(batch, _PrefetchError):
+            self.exhausted = True
+            batch.reraise()
+        return batch
 
     def iter_next(self):
-        for e in self.data_ready:
-            e.wait()
-        if self.next_batch[0] is None:
+        if self.exhausted:
+            return False
+        next_batch = [self.fetch(i) for i in range(self.n_iter)]
+        if any(batch is None for batch in next_batch):
+            self.exhausted = True
             return False
+        if self.n_iter == 1:
+            self.current_batch = next_batch[0]
+        elif all(isinstance(batch, DataBatch) for batch in next_batch):
+            self.current_batch = DataBatch(sum([batch.data for batch in next_batch], []),
+                                           sum([batch.label for batch in next_batch], []),
+                                           next_batch[0].pad, next_batch[0].index,
+                                           provide_data=self.provide_data, provide_label=self.provide_label)
         else:
-            self.current_batch = self.next_batch[0]
-            for e in self.data_ready:
-                e.clear()
-            for e in self.data_taken:
-                e.set()
-            return True
+            self.current_batch = next_batch
+        return True
 
     def next(self):
         if self.iter_next():
@@ -139,3 +196,12 @@ class PrefetchingIter(mx.io.DataIter):
 
     def getpad(self):
         return self.current_batch.pad
+
+
+class _PrefetchError(object):
+    """exception raised by an iter on a prefetch thread, re-raised to the consumer"""
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
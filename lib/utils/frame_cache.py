@@ -0,0 +1,106 @@
+# --------------------------------------------------------
+# Flow-Guided Feature Aggregation
+# Copyright (c) 2017 Microsoft
+# Licensed under The Apache-2.0 License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Size bounded LRU cache of decoded and resized frames in shared memory.
+Neighboring training samples of a VID snippet draw their bef/aft frames from the
+same interval, so the same JPEGs get decoded over and over. The cache is allocated
+before loader workers fork and is shared by all of them.
+"""
+
+import ctypes
+import hashlib
+import multiprocessing as mp
+import numpy as np
+
+
+def _key_hash(key):
+    """ stable 63 bit hash of a cache key, 0 marks an empty slot """
+    digest = hashlib.md5(repr(key)).digest()
+    return (int(np.frombuffer(digest[:8], dtype=np.int64)[0]) & 0x7fffffffffffffff) or 1
+
+
+class SharedFrameCache(object):
+    def __init__(self, capacity_mb, max_frame_shape):
+        """
+        :param capacity_mb: total size of the frame slots in MB
+        :param max_frame_shape: (height, width, channel) upper bound of a cached frame, any orientation
+        """
+        self.slot_size = int(np.prod(max_frame_shape))
+        self.num_slots = max(int(capacity_mb * 1024 * 1024 // self.slot_size), 1)
+        self.lock = mp.Lock()
+        self._data = mp.RawArray(ctypes.c_uint8, self.num_slots * self.slot_size)
+        self._keys = mp.RawArray(ctypes.c_int64, self.num_slots)
+        self._ticks = mp.RawArray(ctypes.c_int64, self.num_slots)
+        self._shapes = mp.RawArray(ctypes.c_int32, self.num_slots * 3)
+        self._scales = mp.RawArray(ctypes.c_double, self.num_slots)
+        # tick, hits, misses
+        self._counters = mp.RawArray(ctypes.c_int64, 3)
+        self._views = None
+
+    def _get_views(self):
+        # numpy views are created lazily so that every forked worker maps the shared buffers itself
+        if self._views is None:
+            self._views = (np.frombuffer(self._data, dtype=np.uint8).reshape(self.num_slots, self.slot_size),
+                           np.frombuffer(self._keys, dtype=np.int64),
+                           np.frombuffer(self._ticks, dtype=np.int64),
+                           np.frombuffer(self._shapes, dtype=np.int32).reshape(self.num_slots, 3),
+                           np.frombuffer(self._scales, dtype=np.float64),
+                           np.frombuffer(self._counters, dtype=np.int64))
+        return self._views
+
+    def get(self, key):
+        """
+        :param key: hashable description of the frame, e.g. (path, flipped, target_size, max_size, stride)
+        :return: (frame, scale) or None, frame is a private copy
+        """
+        data, keys, ticks, shapes, scales, counters = self._get_views()
+        h = _key_hash(key)
+        with self.lock:
+            slot = np.flatnonzero(keys == h)
+            if slot.size == 0:
+                counters[2] += 1
+                return None
+            slot = slot[0]
+            counters[0] += 1
+            counters[1] += 1
+            ticks[slot] = counters[0]
+            shape = tuple(shapes[slot])
+            frame = data[slot, :int(np.prod(shape))].reshape(shape).copy()
+            return frame, scales[slot]
+
+    def put(self, key, frame, scale):
+        """ insert a frame, evicting the least recently used slot """
+        if frame.size > self.slot_size:
+            return
+        data, keys, ticks, shapes, scales, counters = self._get_views()
+        h = _key_hash(key)
+        with self.lock:
+            if np.any(keys == h):
+                return
+            slot = np.argmin(ticks)
+            counters[0] += 1
+            keys[slot] = h
+            ticks[slot] = counters[0]
+            shapes[slot] = frame.shape
+            scales[slot] = scale
+            data[slot, :frame.size] = frame.ravel()
+
+    def stats(self):
+        """
+        :return: dict with hits, misses, hit_rate and the number of filled slots
+        """
+        data, keys, ticks, shapes, scales, counters = self._get_views()
+        hits, misses = int(counters[1]), int(counters[2])
+        return {'hits': hits, 'misses': misses,
+                'hit_rate': float(hits) / max(hits + misses, 1),
+                'slots': '{}/{}'.format(int(np.count_nonzero(keys)), self.num_slots)}
+
+    def reset_stats(self):
+        counters = self._get_views()[5]
+        with self.lock:
+            counters[1] = 0
+            counters[2] = 0
@@ -0,0 +1,71 @@
+# --------------------------------------------------------
+# Flow-Guided Feature Aggregation
+# Copyright (c) 2017 Microsoft
+# Licensed under The Apache-2.0 License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Pre-resized frames of ImageNet VID snippets packed into one memory-mappable file per scale.
+Written offline by fgfa_rfcn/pack_frames.py, read by utils.image.load_resized_frame.
+
+index file (pickle):
+    {(target_size, max_size): {'file': data file name next to the index,
+                               'videos': {snippet directory: (offsets, shapes, scales)}}}
+    offsets[i], shapes[i] = (height, width), scales[i]: frame i of the snippet, uint8 BGR, unpadded
+"""
+
+import cPickle
+import os
+import numpy as np
+
+
+class FrameStore(object):
+    def __init__(self, index_file):
+        with open(index_file, 'rb') as f:
+            self.index = cPickle.load(f)
+        self.root = os.path.dirname(os.path.abspath(index_file))
+        self.mmaps = {}
+
+    def _mmap(self, scale):
+        # opened lazily, so forked loader workers map the file themselves
+        if scale not in self.mmaps:
+            self.mmaps[scale] = np.memmap(os.path.join(self.root, self.index[scale]['file']), dtype=np.uint8, mode='r')
+        return self.mmaps[scale]
+
+    def get(self, path, target_size, max_size):
+        """
+        :param path: frame path, <snippet directory>/<frame number>.<ext>
+        :return: (im, im_scale) with im a read-only [height, width, 3] view into the store, or None if not packed
+        """
+        entry = self.index.get((target_size, max_size))
+        if entry is None:
+            return None
+        video, name = os.path.split(path)
+        name = os.path.splitext(name)[0]
+        if video not in entry['videos'] or not name.isdigit():
+            return None
+        offsets, shapes, scales = entry['videos'][video]
+        frame = int(name)
+        if frame >= len(offsets):
+            return None
+        height, width = shapes[frame]
+        offset = offsets[frame]
+        im = self._mmap((target_size, max_size))[offset:offset + height * width * 3].reshape((height, width, 3))
+        return im, float(scales[frame])
+
+
+def write_video(f, frames):
+    """
+    append the frames of one snippet to an open data file
+    :param f: data file opened for binary writing
+    :param frames: iterable of (im, im_scale)
+    :return: (offsets, shapes, scales) of the snippet
+    """
+    offsets, shapes, scales = [], [], []
+    for im, im_scale in frames:
+        offsets.append(f.tell())
+        shapes.append(im.shape[:2])
+        scales.append(im_scale)
+        f.write(np.ascontiguousarray(im, dtype=np.uint8).tostring())
+    return np.array(offsets, dtype=np.int64), np.array(shapes, dtype=np.int32).reshape(-1, 2), \
+        np.array(scales, dtype=np.float32)
@@ -1,4 +1,5 @@
 import numpy as np
+import mxnet as mx
 import os
 import cv2
 import random
@@ -22,18 +23,15 @@ def get_image(roidb, config):
     processed_roidb = []
     for i in range(num_images):
         roi_rec = roidb[i]
-        assert os.path.exists(roi_rec['image']), '%s does not exist'.format(roi_rec['image'])
-        im = cv2.imread(roi_rec['image'], cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION)
-        if roidb[i]['flipped']:
-            im = im[:, ::-1, :]
         new_rec = roi_rec.copy()
         scale_ind = random.randrange(len(config.SCALES))
         target_size = config.SCALES[scale_ind][0]
         max_size = config.SCALES[scale_ind][1]
-        im, im_scale = resize(im, target_size, max_size, stride=config.network.IMAGE_STRIDE)
-        im_tensor = transform(im, config.network.PIXEL_MEANS)
+        im, im_scale = load_resized_frame(roi_rec['image'], roi_rec['flipped'], target_size, max_size,
+                                          stride=config.network.IMAGE_STRIDE)
+        im_tensor = transform_uint8(im)
         processed_ims.append(im_tensor)
-        im_info = [im_tensor.shape[2], im_tensor.shape[3], im_scale]
+        im_info = [im_tensor.shape[1], im_tensor.shape[2], im_scale]
         new_rec['boxes'] = clip_boxes(np.round(roi_rec['boxes'].copy() * im_scale), im_info[:2])
         new_rec['im_info'] = im_info
         processed_roidb.append(new_rec)
@@ -83,12 +81,12 @@ def get_pair_image(roidb, config):
 
         im, im_scale = resize(im, target_size, max_size, stride=config.network.IMAGE_STRIDE)
         ref_im, im_scale = resize(ref_im, target_size, max_size, stride=config.network.IMAGE_STRIDE)
-        im_tensor = transform(im, config.network.PIXEL_MEANS)
-        ref_im_tensor = transform(ref_im, config.network.PIXEL_MEANS)
+        im_tensor = transform_uint8(im)
+        ref_im_tensor = transform_uint8(ref_im)
         processed_ims.append(im_tensor)
         processed_ref_ims.append(ref_im_tensor)
         processed_eq_flags.append(eq_flag)
-        im_info = [im_tensor.shape[2], im_tensor.shape[3], im_scale]
+        im_info = [im_tensor.shape[1], im_tensor.shape[2], im_scale]
         new_rec['boxes'] = roi_rec['boxes'].copy() * im_scale
         new_rec['im_info'] = im_info
         processed_roidb.append(new_rec)
@@ -111,8 +109,13 @@ def get_triple_image(roidb, config):
     processed_roidb = []
     for i in range(num_images):
         roi_rec = roidb[i]
-        assert os.path.exists(roi_rec['image']), '%s does not exist'.format(roi_rec['image'])
-        im = cv2.imread(roi_rec['image'], cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION)
+        new_rec = roi_rec.copy()
+        scale_ind = random.randrange(len(config.SCALES))
+        target_size = config.SCALES[scale_ind][0]
+        max_size = config.SCALES[scale_ind][1]
+        stride = config.network.IMAGE_STRIDE
+
+        im, im_scale = load_resized_frame(roi_rec['image'], roi_rec['flipped'], target_size, max_size, stride)
 
         if roi_rec.has_key('pattern'):
             # get two different frames from the interval [frame_id + MIN_OFFSET, frame_id + MAX_OFFSET]
@@ -122,39 +125,73 @@ def get_triple_image(roidb, config):
             bef_image = roi_rec['pattern'] % bef_id
             aft_image = roi_rec['pattern'] % aft_id
 
-            assert os.path.exists(bef_image), '%s does not exist'.format(bef_image)
-            assert os.path.exists(aft_image), '%s does not exist'.format(aft_image)
-            bef_im = cv2.imread(bef_image, cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION)
-            aft_im = cv2.imread(aft_image, cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION)
+            bef_im, _ = load_resized_frame(bef_image, roi_rec['flipped'], target_size, max_size, stride)
+            aft_im, _ = load_resized_frame(aft_image, roi_rec['flipped'], target_size, max_size, stride)
         else:
-            bef_im = im.copy()
-            aft_im = im.copy()
+            bef_im = im
+            aft_im = im
 
-        if roidb[i]['flipped']:
-            im = im[:, ::-1, :]
-            bef_im = bef_im[:, ::-1, :]
-            aft_im = aft_im[:, ::-1, :]
-
-        new_rec = roi_rec.copy()
-        scale_ind = random.randrange(len(config.SCALES))
-        target_size = config.SCALES[scale_ind][0]
-        max_size = config.SCALES[scale_ind][1]
-
-        im, im_scale = resize(im, target_size, max_size, stride=config.network.IMAGE_STRIDE)
-        bef_im, im_scale = resize(bef_im, target_size, max_size, stride=config.network.IMAGE_STRIDE)
-        aft_im, im_scale = resize(aft_im, target_size, max_size, stride=config.network.IMAGE_STRIDE)
-        im_tensor = transform(im, config.network.PIXEL_MEANS)
-        bef_im_tensor = transform(bef_im, config.network.PIXEL_MEANS)
-        aft_im_tensor = transform(aft_im, config.network.PIXEL_MEANS)
+        im_tensor = transform_uint8(im)
+        bef_im_tensor = transform_uint8(bef_im)
+        aft_im_tensor = transform_uint8(aft_im)
         processed_ims.append(im_tensor)
         processed_bef_ims.append(bef_im_tensor)
         processed_aft_ims.append(aft_im_tensor)
-        im_info = [im_tensor.shape[2], im_tensor.shape[3], im_scale]
+        im_info = [im_tensor.shape[1], im_tensor.shape[2], im_scale]
         new_rec['boxes'] = roi_rec['boxes'].copy() * im_scale
         new_rec['im_info'] = im_info
         processed_roidb.append(new_rec)
     return processed_ims, processed_bef_ims, processed_aft_ims, processed_roidb
 
+# decoded-frame cache shared by the training loader workers, see set_frame_cache
+_frame_cache = None
+# pre-resized frames packed by pack_frames.py, see set_frame_store
+_frame_store = None
+
+def set_frame_cache(cache):
+    """
+    :param cache: utils.frame_cache.SharedFrameCache used by get_triple_image, or None
+    """
+    global _frame_cache
+    _frame_cache = cache
+
+def get_frame_cache():
+    return _frame_cache
+
+def set_frame_store(store):
+    """
+    :param store: utils.frame_store.FrameStore consulted before decoding a frame, or None
+    """
+    global _frame_store
+    _frame_store = store
+
+def load_resized_frame(path, flipped, target_size, max_size, stride=0):
+    """
+    read, flip and resize one frame
+    packed frames come from the frame store, otherwise the decoded-frame cache is tried before the JPEG
+    :return: im [height, width, channel] in BGR, im_scale
+    """
+    if _frame_store is not None:
+        stored = _frame_store.get(path, target_size, max_size)
+        if stored is not None:
+            im, im_scale = stored
+            if flipped:
+                im = im[:, ::-1, :]
+            return pad(im, stride), im_scale
+    key = (path, bool(flipped), target_size, max_size, stride)
+    if _frame_cache is not None:
+        cached = _frame_cache.get(key)
+        if cached is not None:
+            return cached
+    assert os.path.exists(path), '%s does not exist'.format(path)
+    im = cv2.imread(path, cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION)
+    if flipped:
+        im = im[:, ::-1, :]
+    im, im_scale = resize(im, target_size, max_size, stride=stride)
+    if _frame_cache is not None:
+        _frame_cache.put(key, im, im_scale)
+    return im, im_scale
+
 def resize(im, target_size, max_size, stride=0, interpolation = cv2.INTER_LINEAR):
     """
     only resize input image to target size and return scale
@@ -174,16 +211,41 @@ def resize(im, target_size, max_size, stride=0, interpolation = cv2.INTER_LINEAR
         im_scale = float(max_size) / float(im_size_max)
     im = cv2.resize(im, None, None, fx=im_scale, fy=im_scale, interpolation=interpolation)
 
+    return pad(im, stride), im_scale
+
+def pad(im, stride):
+    """
+    pad the bottom and right of an image to a multiple of stride
+    :param im: [height, width, channel]
+    :param stride: 0 for no padding
+    :return: padded image, im itself if no padding is needed
+    """
     if stride == 0:
-        return im, im_scale
-    else:
-        # pad to product of stride
-        im_height = int(np.ceil(im.shape[0] / float(stride)) * stride)
-        im_width = int(np.ceil(im.shape[1] / float(stride)) * stride)
-        im_channel = im.shape[2]
-        padded_im = np.zeros((im_height, im_width, im_channel))
-        padded_im[:im.shape[0], :im.shape[1], :] = im
-        return padded_im, im_scale
+        return im
+    im_height = int(np.ceil(im.shape[0] / float(stride)) * stride)
+    im_width = int(np.ceil(im.shape[1] / float(stride)) * stride)
+    if (im_height, im_width) == im.shape[:2]:
+        return im
+    im_channel = im.shape[2]
+    padded_im = np.zeros((im_height, im_width, im_channel), dtype=im.dtype)
+    padded_im[:im.shape[0], :im.shape[1], :] = im
+    return padded_im
+
+def pad_to_shape(im, height, width, pad_value=0):
+    """
+    pad the bottom and right of an image to height x width
+    :param im: [height, width, channel]
+    :param pad_value: value of the padded pixels, scalar or one per channel
+    :return: padded image, im itself if it already has that shape
+    """
+    assert im.shape[0] <= height and im.shape[1] <= width, \
+        'image of shape {} does not fit in {}'.format(im.shape[:2], (height, width))
+    if (height, width) == im.shape[:2]:
+        return im
+    padded_im = np.empty((height, width, im.shape[2]), dtype=im.dtype)
+    padded_im[...] = np.asarray(pad_value, dtype=im.dtype)
+    padded_im[:im.shape[0], :im.shape[1], :] = im
+    return padded_im
 
 def transform(im, pixel_means):
     """
@@ -193,10 +255,37 @@ def transform(im, pixel_means):
     :param pixel_means: [B, G, R pixel means]
     :return: [batch, channel, height, width]
     """
-    im_tensor = np.zeros((1, 3, im.shape[0], im.shape[1]))
-    for i in range(3):
-        im_tensor[0, i, :, :] = im[:, :, 2 - i] - pixel_means[2 - i]
-    return im_tensor
+    im_tensor = (im[:, :, ::-1].astype(np.float32) - np.array(pixel_means[::-1], dtype=np.float32)).transpose((2, 0, 1))
+    return im_tensor[np.newaxis]
+
+def transform_uint8(im):
+    """
+    keep the image as uint8, mean subtraction and layout change are done on the device by image_to_tensor
+    :param im: [height, width, channel] in BGR
+    :return: [batch, height, width, channel] in BGR
+    """
+    return np.ascontiguousarray(im, dtype=np.uint8)[np.newaxis]
+
+def image_to_tensor(im, pixel_means):
+    """
+    device side counterpart of transform
+    :param im: uint8 NDArray [batch, height, width, channel] in BGR
+    :param pixel_means: [B, G, R pixel means]
+    :return: float32 NDArray [batch, channel, height, width] in RGB
+    """
+    im = mx.nd.transpose(mx.nd.Cast(im, dtype='float32'), axes=(0, 3, 1, 2))
+    channels = [mx.nd.slice_axis(im, axis=1, begin=2 - i, end=3 - i) - float(pixel_means[2 - i]) for i in range(3)]
+    return mx.nd.concatenate(channels, axis=1)
+
+def tensor_shape(arr):
+    """
+    shape of arr as seen by the network, uint8 images are fed as [batch, channel, height, width]
+    :param arr: numpy array or NDArray
+    :return: shape tuple
+    """
+    if arr.dtype == np.uint8 and len(arr.shape) == 4:
+        return (arr.shape[0], arr.shape[3], arr.shape[1], arr.shape[2])
+    return arr.shape
 
 def transform_seg_gt(gt):
     """
@@ -218,6 +307,9 @@ def transform_inverse(im_tensor, pixel_means):
     :return: im [height, width, channel(RGB)]
     """
     assert im_tensor.shape[0] == 1
+    if im_tensor.dtype == np.uint8:
+        # uint8 [batch, height, width, channel] in BGR
+        return im_tensor[0][:, :, ::-1].copy()
     im_tensor = im_tensor.copy()
     # put channel back
     channel_swap = (0, 2, 3, 1)
@@ -0,0 +1,73 @@
+# --------------------------------------------------------
+# Flow-Guided Feature Aggregation
+# Copyright (c) 2017 Microsoft
+# Licensed under The Apache-2.0 License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Fixed size shared memory slots that loader worker processes assemble batches in.
+A worker packs the numpy arrays of a batch into a slot and only sends the small
+descriptors back, the consumer reads them in place instead of unpickling copies.
+The slots are allocated before the workers fork.
+"""
+
+import ctypes
+import multiprocessing as mp
+import numpy as np
+
+_ALIGN = 64
+
+
+class SharedBatchSlots(object):
+    def __init__(self, num_slots, slot_bytes):
+        """
+        :param num_slots: number of batches that can be held at the same time
+        :param slot_bytes: size of a slot, arrays that do not fit are passed by value instead
+        """
+        self.num_slots = num_slots
+        self.slot_bytes = int(np.ceil(slot_bytes / float(_ALIGN)) * _ALIGN)
+        self._data = mp.RawArray(ctypes.c_uint8, self.num_slots * self.slot_bytes)
+        self._view = None
+
+    def _get_view(self):
+        # created lazily so that every forked worker maps the shared buffer itself
+        if self._view is None:
+            self._view = np.frombuffer(self._data, dtype=np.uint8).reshape(self.num_slots, self.slot_bytes)
+        return self._view
+
+    def pack(self, slot, arrays):
+        """
+        copy arrays into a slot
+        :param arrays: list of numpy arrays
+        :return: descriptors for unpack, (offset, dtype, shape) per packed array, the array itself otherwise
+        """
+        view = self._get_view()[slot]
+        descs = []
+        offset = 0
+        for arr in arrays:
+            arr = np.asarray(arr)
+            end = offset + arr.nbytes
+            if end > self.slot_bytes:
+                descs.append(arr)
+                continue
+            view[offset:end].view(arr.dtype)[:] = arr.ravel()
+            descs.append((offset, arr.dtype.str, arr.shape))
+            offset = int(np.ceil(end / float(_ALIGN)) * _ALIGN)
+        return descs
+
+    def unpack(self, slot, descs):
+        """
+        :param descs: as returned by pack
+        :return: list of arrays, the packed ones are views into the slot, valid until it is packed again
+        """
+        view = self._get_view()[slot]
+        arrays = []
+        for desc in descs:
+            if isinstance(desc, np.ndarray):
+                arrays.append(desc)
+                continue
+            offset, dtype, shape = desc
+            dtype = np.dtype(dtype)
+            size = int(np.prod(shape)) * dtype.itemsize
+            arrays.append(view[offset:offset + size].view(dtype).reshape(shape))
+        return arrays